@@ -1,2 +1,8 @@
 #!/bin/sh
 flask db upgrade
+
+# add the internal location of the stored files to the server block generated by the image (before its closing brace)
+NGINX_SERVER_CONF=/etc/nginx/conf.d/nginx.conf
+if [ -f "$NGINX_SERVER_CONF" ] && ! grep -q 'nginx-file-store.conf' "$NGINX_SERVER_CONF"; then
+    sed -i '$ s|^}|    include /app/nginx-file-store.conf;\n}|' "$NGINX_SERVER_CONF"
+fi
@@ -0,0 +1,26 @@
+"""Index file hashes for the blob store reference count
+
+Revision ID: 3b8f1d2c7a90
+Revises: e73f930d6f45
+Create Date: 2026-10-18 10:41:37.512093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b8f1d2c7a90'
+down_revision = 'e73f930d6f45'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('File', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_File_file_hash'), ['file_hash'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('File', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_File_file_hash'))
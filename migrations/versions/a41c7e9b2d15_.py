@@ -0,0 +1,65 @@
+"""Add visibility levels and indexes for the hot filter columns
+
+Revision ID: a41c7e9b2d15
+Revises: 3b8f1d2c7a90
+Create Date: 2026-10-18 13:27:50.381126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a41c7e9b2d15'
+down_revision = '3b8f1d2c7a90'
+branch_labels = None
+depends_on = None
+
+
+VISIBLE_TABLES = ['Item', 'File', 'ItemType', 'Tag', 'AttributeDefinition']
+
+
+def upgrade():
+    for table in VISIBLE_TABLES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('visibility_level', sa.Integer(), nullable=False, server_default='3'))
+
+        # 1: guest, 2: moderator, 3: admin (see db_models/visibility.py)
+        visible = sa.table(table, sa.column('visible_for'), sa.column('visibility_level'))
+        op.execute(visible.update().values(visibility_level=sa.case([(visible.c.visible_for == 'all', 1),
+                                                                    (visible.c.visible_for == 'moderator', 2)],
+                                                                   else_=3)))
+
+    with op.batch_alter_table('Item', schema=None) as batch_op:
+        batch_op.create_index('ix_Item_deleted_time_visibility_level_name',
+                              ['deleted_time', 'visibility_level', 'name'], unique=False)
+        batch_op.create_index(batch_op.f('ix_Item_lending_id'), ['lending_id'], unique=False)
+
+    with op.batch_alter_table('File', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_File_item_id'), ['item_id'], unique=False)
+
+    with op.batch_alter_table('ItemToTag', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_ItemToTag_tag_id'), ['tag_id'], unique=False)
+
+    with op.batch_alter_table('ItemToAttributeDefinition', schema=None) as batch_op:
+        batch_op.create_index('ix_ItemToAttributeDefinition_attribute_definition_id_value',
+                              ['attribute_definition_id', 'value'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('ItemToAttributeDefinition', schema=None) as batch_op:
+        batch_op.drop_index('ix_ItemToAttributeDefinition_attribute_definition_id_value')
+
+    with op.batch_alter_table('ItemToTag', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_ItemToTag_tag_id'))
+
+    with op.batch_alter_table('File', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_File_item_id'))
+
+    with op.batch_alter_table('Item', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_Item_lending_id'))
+        batch_op.drop_index('ix_Item_deleted_time_visibility_level_name')
+
+    for table in VISIBLE_TABLES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('visibility_level')
@@ -0,0 +1,107 @@
+"""Add typed copies of the attribute values
+
+Revision ID: d2a6c9e4b713
+Revises: b8e4f1a92c07
+Create Date: 2026-10-18 17:20:43.518027
+
+"""
+from datetime import date
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2a6c9e4b713'
+down_revision = 'b8e4f1a92c07'
+branch_labels = None
+depends_on = None
+
+
+TYPED_COLUMNS = [
+    ('value_int', sa.BigInteger()),
+    ('value_num', sa.Float()),
+    ('value_bool', sa.Boolean()),
+    ('value_date', sa.Date()),
+]
+
+
+def typed_values(definition_type, jsonschema, value):
+    """
+    The typed columns of a json encoded attribute value (a copy of db_models/typedAttributeValues.py).
+    """
+    result = {name: None for name, _ in TYPED_COLUMNS}
+    try:
+        schema = json.loads(jsonschema) if jsonschema else {}
+        decoded = json.loads(value) if value else None
+    except ValueError:
+        return result
+    string_format = schema.get('format') if isinstance(schema, dict) else None
+
+    if definition_type in ('integer', 'number'):
+        if isinstance(decoded, bool) or not isinstance(decoded, (int, float, str)):
+            return result
+        try:
+            number = float(decoded)
+        except ValueError:
+            return result
+        if definition_type == 'integer':
+            if not number.is_integer():
+                return result
+            result['value_int'] = int(number)
+        result['value_num'] = number
+    elif definition_type == 'boolean':
+        if isinstance(decoded, bool):
+            result['value_bool'] = decoded
+        elif decoded in ('true', 'false'):
+            result['value_bool'] = decoded == 'true'
+    elif definition_type == 'string' and string_format in ('date', 'date-time') and isinstance(decoded, str):
+        try:
+            result['value_date'] = date.fromisoformat(decoded[:10])
+        except ValueError:
+            pass
+    return result
+
+
+def upgrade():
+    with op.batch_alter_table('ItemToAttributeDefinition', schema=None) as batch_op:
+        for name, column_type in TYPED_COLUMNS:
+            batch_op.add_column(sa.Column(name, column_type, nullable=True))
+        for name, _ in TYPED_COLUMNS:
+            batch_op.create_index('ix_ItemToAttributeDefinition_attribute_definition_id_' + name,
+                                  ['attribute_definition_id', name], unique=False)
+
+    # fill the typed columns of the existing attributes
+    connection = op.get_bind()
+    item_to_attribute = sa.table('ItemToAttributeDefinition', sa.column('item_id'),
+                                 sa.column('attribute_definition_id'), sa.column('value'),
+                                 *(sa.column(name) for name, _ in TYPED_COLUMNS))
+    attribute_query = sa.text('SELECT ItemToAttributeDefinition.item_id, AttributeDefinition.id, '
+                              'AttributeDefinition.type, AttributeDefinition.jsonschema, '
+                              'ItemToAttributeDefinition.value FROM ItemToAttributeDefinition '
+                              'JOIN AttributeDefinition '
+                              'ON ItemToAttributeDefinition.attribute_definition_id = AttributeDefinition.id '
+                              "WHERE AttributeDefinition.type IN ('integer', 'number', 'boolean', 'string')")
+    rows = []
+    for item_id, definition_id, definition_type, jsonschema, value in connection.execute(attribute_query):
+        values = typed_values(definition_type, jsonschema, value)
+        if any(typed is not None for typed in values.values()):
+            rows.append({'b_item_id': item_id, 'b_definition_id': definition_id, **values})
+    if rows:
+        connection.execute(item_to_attribute.update()
+                           .where(item_to_attribute.c.item_id == sa.bindparam('b_item_id'))
+                           .where(item_to_attribute.c.attribute_definition_id == sa.bindparam('b_definition_id')),
+                           rows)
+
+    # range searches compare the typed values now, cached search responses are outdated
+    catalog_version = sa.table('CatalogVersion', sa.column('version'))
+    op.execute(catalog_version.update().values(version=catalog_version.c.version + 1))
+
+
+def downgrade():
+    with op.batch_alter_table('ItemToAttributeDefinition', schema=None) as batch_op:
+        for name, _ in TYPED_COLUMNS:
+            batch_op.drop_index('ix_ItemToAttributeDefinition_attribute_definition_id_' + name)
+        for name, _ in TYPED_COLUMNS:
+            batch_op.drop_column(name)
@@ -0,0 +1,70 @@
+"""Add search index
+
+Revision ID: e73f930d6f45
+Revises: cd02e7f9639a
+Create Date: 2026-10-18 09:02:11.204518
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e73f930d6f45'
+down_revision = 'cd02e7f9639a'
+branch_labels = None
+depends_on = None
+
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    if not text:
+        return set()
+    return {token[:190] for token in TOKEN_PATTERN.findall(text.lower())}
+
+
+def upgrade():
+    search_term = op.create_table('SearchTerm',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('term', sa.String(length=190), nullable=False),
+    sa.Column('item_id', sa.Integer(), nullable=False),
+    sa.Column('tag_id', sa.Integer(), nullable=True),
+    sa.Column('attribute_definition_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['item_id'], ['Item.id'], name=op.f('fk_SearchTerm_item_id')),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_SearchTerm'))
+    )
+    with op.batch_alter_table('SearchTerm', schema=None) as batch_op:
+        batch_op.create_index('ix_SearchTerm_term_item_id', ['term', 'item_id'], unique=False)
+        batch_op.create_index('ix_SearchTerm_item_id', ['item_id'], unique=False)
+
+    # fill the index with the existing items
+    connection = op.get_bind()
+    rows = []
+    for item_id, name in connection.execute(sa.text('SELECT id, name FROM Item')):
+        rows.extend({'term': term, 'item_id': item_id, 'tag_id': None, 'attribute_definition_id': None}
+                    for term in tokenize(name))
+    tag_query = sa.text('SELECT ItemToTag.item_id, Tag.id, Tag.name FROM ItemToTag '
+                        'JOIN Tag ON ItemToTag.tag_id = Tag.id WHERE Tag.deleted_time IS NULL')
+    for item_id, tag_id, name in connection.execute(tag_query):
+        rows.extend({'term': term, 'item_id': item_id, 'tag_id': tag_id, 'attribute_definition_id': None}
+                    for term in tokenize(name))
+    attribute_query = sa.text('SELECT item_id, attribute_definition_id, value FROM ItemToAttributeDefinition '
+                              'WHERE deleted_time IS NULL')
+    for item_id, attribute_definition_id, value in connection.execute(attribute_query):
+        rows.extend({'term': term, 'item_id': item_id, 'tag_id': None,
+                     'attribute_definition_id': attribute_definition_id}
+                    for term in tokenize(value))
+    if rows:
+        op.bulk_insert(search_term, rows)
+
+
+def downgrade():
+    with op.batch_alter_table('SearchTerm', schema=None) as batch_op:
+        batch_op.drop_index('ix_SearchTerm_item_id')
+        batch_op.drop_index('ix_SearchTerm_term_item_id')
+
+    op.drop_table('SearchTerm')
@@ -90,6 +90,10 @@ from . import db_models
 from . import routes
 # pylint: disable=C0413
 from . import backup_and_restore
+# pylint: disable=C0413
+from . import query_counts
+# pylint: disable=C0413
+from . import benchmark
 
 # setup performance logging
 if APP.config.get('MONITOR_REQUEST_PERFORMANCE', True):
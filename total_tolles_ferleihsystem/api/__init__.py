@@ -11,7 +11,8 @@ from flask_restplus import Api, abort
 from flask_jwt_extended import get_jwt_claims
 from flask_jwt_extended.exceptions import NoAuthorizationError
 from jwt import ExpiredSignatureError, InvalidTokenError
-from .. import APP, JWT, AUTH_LOGGER
+from sqlalchemy.orm.exc import StaleDataError
+from .. import APP, DB, JWT, AUTH_LOGGER
 from ..login import User, UserRole
 
 
@@ -57,12 +58,36 @@ def satisfies_role(role: UserRole):
         return wrapper
     return has_roles_decorator
 
+
+def current_user_role() -> UserRole:
+    """
+    The role of the requesting user. Requests without token count as guest.
+    """
+    claims = get_jwt_claims()
+    if not claims:
+        return UserRole.GUEST
+    return UserRole(claims)
+
+
+def restrict_visibility(query, model):
+    """
+    Restrict the query to the objects of the model the requesting user is allowed to see.
+    """
+    role = current_user_role()
+    if role == UserRole.ADMIN:
+        return query
+    return query.filter(model.visibility_level <= role.value)
+
 API_BLUEPRINT = Blueprint('api', __name__)
 
 API = Api(API_BLUEPRINT, version='0.1', title='TTF API', doc='/doc/',
           authorizations=AUTHORIZATIONS, security='jwt',
           description='API for TTF.')
 
+# pylint: disable=C0413
+from .json_serializer import output_json
+API.representation('application/json')(output_json)
+
 
 @JWT.user_identity_loader
 def load_user_identity(user: User):
@@ -142,6 +167,15 @@ def missing_header(error):
     return {'message': error.message}, 401
 
 
+@API.errorhandler(StaleDataError)
+def concurrent_change(error):
+    """
+    Handler function for a object that was changed concurrently (version mismatch)
+    """
+    DB.session.rollback()
+    return {'message': 'The object was changed concurrently, please reload it and try again!'}, 409
+
+
 @API.errorhandler
 def default_errorhandler(error):
     """
@@ -158,6 +192,6 @@ def log_unauthorized(message):
     AUTH_LOGGER.debug('Unauthorized access: %s', message)
 
 # pylint: disable=C0413
-from . import root, authentication, catalog, lending, search, tasks
+from . import root, authentication, catalog, lending, search, tasks, debug
 
 APP.register_blueprint(API_BLUEPRINT)
@@ -0,0 +1,233 @@
+"""
+Module containing the conditional request handling and the response cache of the catalog resources.
+
+The representation of a catalog resource only depends on the catalog version and the role of the user
+(visibility), so both together form a weak ETag. Requests with a matching If-None-Match header are answered with
+304 before the view runs any query.
+
+The same holds for the response cache: its keys contain the catalog version, so every change of the catalog
+invalidates all entries and the old ones are evicted as least recently used.
+"""
+
+import json
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import wraps
+from hashlib import sha1
+from threading import Lock
+from typing import Any, Optional, Tuple, Type
+
+from flask import Response, g, request
+from werkzeug.http import quote_etag
+
+from . import current_user_role
+from .. import APP
+from ..db_models.catalogVersion import current_catalog_version
+
+# the marshalled data, the status code and the headers of a response
+CachedResponse = Tuple[Any, int, dict]
+
+
+@APP.before_request
+def _forget_catalog_version():
+    # the app context (and with it g) outlives a request in cli commands and tests
+    g.pop('ttf_catalog_version', None)
+
+
+def request_catalog_version() -> int:
+    """
+    The catalog version, read once per request.
+    """
+    if 'ttf_catalog_version' not in g:
+        g.ttf_catalog_version = current_catalog_version()
+    return g.ttf_catalog_version
+
+
+def catalog_etag() -> str:
+    """
+    The (unquoted) ETag of the catalog as seen by the requesting user.
+    """
+    return 'catalog-{}-{}'.format(request_catalog_version(), current_user_role().value)
+
+
+def _add_headers(result, headers):
+    if isinstance(result, Response):
+        result.headers.extend(headers)
+        return result
+    if not isinstance(result, tuple):
+        return result, 200, headers
+    if len(result) == 2:
+        return result[0], result[1], headers
+    data, code, result_headers = result
+    return data, code, {**headers, **(result_headers or {})}
+
+
+def conditional_get(func):
+    """
+    Answer conditional GET requests of catalog resources with 304 Not Modified.
+
+    Must be applied after the jwt decorators (the ETag depends on the role) and before the marshal decorators!
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        """
+        Wrapper function
+        """
+        etag = catalog_etag()
+        headers = {
+            'ETag': quote_etag(etag, weak=True),
+            'Cache-Control': 'private, no-cache',
+            'Vary': 'Authorization',
+        }
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers=headers)
+        return _add_headers(func(*args, **kwargs), headers)
+    return wrapper
+
+
+class ResponseCache(ABC):
+    """
+    Abstract class for the backends of the response cache.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """
+        The cached response or None.
+        """
+        pass
+
+    @abstractmethod
+    def set(self, key: str, response: CachedResponse) -> None:
+        """
+        Cache the response, evicting the least recently used entries.
+        """
+        pass
+
+
+class LocalResponseCache(ResponseCache):
+    """
+    Response cache in the memory of this worker process.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._entries: 'OrderedDict[str, CachedResponse]' = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self._lock:
+            response = self._entries.get(key)
+            if response is not None:
+                self._entries.move_to_end(key)
+            return response
+
+    def set(self, key: str, response: CachedResponse) -> None:
+        with self._lock:
+            self._entries[key] = response
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+class RedisResponseCache(ResponseCache):
+    """
+    Response cache shared by all workers in a redis compatible server.
+
+    The entries expire after the timeout, the size is bounded by the maxmemory (allkeys-lru) setting of the server.
+    If the server is not reachable (the given errors), the cache is skipped and the error logged.
+    """
+
+    def __init__(self, client, timeout: int, errors: Tuple[Type[Exception], ...]):
+        self.client = client
+        self.timeout = timeout
+        self.errors = errors
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        try:
+            cached = self.client.get(key)
+        except self.errors as err:
+            APP.logger.error('Could not read from the response cache: %s', err)
+            return None
+        if cached is None:
+            return None
+        data, code, headers = json.loads(cached)
+        return data, code, headers
+
+    def set(self, key: str, response: CachedResponse) -> None:
+        try:
+            self.client.set(key, json.dumps(response), ex=self.timeout)
+        except self.errors as err:
+            APP.logger.error('Could not write to the response cache: %s', err)
+
+
+def get_response_cache(name: Optional[str]) -> Optional[ResponseCache]:
+    """
+    Get the response cache backend with the given name ('local', 'redis' or None to disable the cache).
+
+    Falls back to the local cache if the redis package is not installed.
+    """
+    if not name:
+        return None
+    if name == 'redis':
+        try:
+            import redis
+        except ImportError:
+            APP.logger.warning('The redis package is not installed, using the local response cache instead.')
+        else:
+            return RedisResponseCache(redis.Redis.from_url(APP.config.get('RESPONSE_CACHE_REDIS_URL')),
+                                      APP.config.get('RESPONSE_CACHE_TIMEOUT', 3600),
+                                      (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError))
+    elif name != 'local':
+        raise KeyError('Unknown response cache: {}'.format(name))
+    return LocalResponseCache(APP.config.get('RESPONSE_CACHE_SIZE', 256))
+
+
+RESPONSE_CACHE = get_response_cache(APP.config.get('RESPONSE_CACHE', 'local'))
+
+
+def response_cache_key() -> str:
+    """
+    The cache key of the current request: catalog version, role, endpoint and the normalised arguments.
+    """
+    view_args = sorted((request.view_args or {}).items())
+    args = sorted((key, sorted(values)) for key, values in request.args.lists())
+    arguments = sha1(json.dumps([view_args, args], default=str).encode()).hexdigest()
+    return 'ttf:response:{}:{}:{}:{}'.format(request_catalog_version(), current_user_role().value,
+                                             request.endpoint, arguments)
+
+
+def _split_result(result) -> CachedResponse:
+    if not isinstance(result, tuple):
+        return result, 200, {}
+    if len(result) == 2:
+        return result[0], result[1], {}
+    data, code, headers = result
+    return data, code, dict(headers or {})
+
+
+def cached_response(func):
+    """
+    Cache the marshalled responses of catalog resources for all users with the same role.
+
+    Must be applied after the jwt decorators and before the marshal decorators!
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        """
+        Wrapper function
+        """
+        if RESPONSE_CACHE is None:
+            return func(*args, **kwargs)
+        key = response_cache_key()
+        cached = RESPONSE_CACHE.get(key)
+        if cached is not None:
+            return cached
+        result = func(*args, **kwargs)
+        if isinstance(result, Response):
+            return result
+        response = _split_result(result)
+        if response[1] == 200:
+            RESPONSE_CACHE.set(key, response)
+        return response
+    return wrapper
@@ -2,18 +2,23 @@
 This module contains all API endpoints for the namespace 'attribute_definition'
 """
 import time
+from json import dumps
 
 from flask import request
 from flask_restplus import Resource, abort, marshal
-from flask_jwt_extended import jwt_required, get_jwt_claims
-from sqlalchemy.orm import joinedload
+from flask_jwt_extended import jwt_required
+from sqlalchemy import inspect
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import func
 
-from .. import API, satisfies_role
+from .. import API, satisfies_role, restrict_visibility
+from ..caching import cached_response, conditional_get
 from ..models import ATTRIBUTE_DEFINITION_GET, ATTRIBUTE_DEFINITION_POST, ATTRIBUTE_DEFINITION_PUT, ATTRIBUTE_DEFINITION_VALUES
+from ..models import ATTRIBUTE_DEFINITION_VALUE_COUNT
+from ..search import escape_like
 from ... import DB, APP
 from ...login import UserRole
-from ...db_models.item import ItemToAttributeDefinition
+from ...db_models.item import Item, ItemToAttributeDefinition
 from ...db_models.attributeDefinition import AttributeDefinition
 
 from ...db_models.tag import TagToAttributeDefinition
@@ -30,6 +35,8 @@ class AttributeDefinitionList(Resource):
     """
 
     @jwt_required
+    @conditional_get
+    @cached_response
     @API.param('deleted', 'get all deleted attributes (and only these)', type=bool, required=False, default=False)
     @API.marshal_list_with(ATTRIBUTE_DEFINITION_GET)
     # pylint: disable=R0201
@@ -45,11 +52,7 @@ class AttributeDefinitionList(Resource):
             base_query = base_query.filter(AttributeDefinition.deleted_time == None)
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((AttributeDefinition.visible_for == 'all') | (AttributeDefinition.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(AttributeDefinition.visible_for == 'all')
+        base_query = restrict_visibility(base_query, AttributeDefinition)
 
         return base_query.order_by(AttributeDefinition.name).all()
 
@@ -83,6 +86,7 @@ class AttributeDefinitionDetail(Resource):
     """
 
     @jwt_required
+    @conditional_get
     @API.marshal_with(ATTRIBUTE_DEFINITION_GET)
     @ANS.response(404, 'Requested attribute not found!')
     # pylint: disable=R0201
@@ -93,11 +97,7 @@ class AttributeDefinitionDetail(Resource):
         base_query = AttributeDefinition.query.filter(AttributeDefinition.id == definition_id)
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((AttributeDefinition.visible_for == 'all') | (AttributeDefinition.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(AttributeDefinition.visible_for == 'all')
+        base_query = restrict_visibility(base_query, AttributeDefinition)
 
         attribute = base_query.first()
         if attribute is None:
@@ -132,11 +132,10 @@ class AttributeDefinitionDetail(Resource):
 
         #Maybe it's better to not delete the associations like with all other objects. But here this would mean a
         # lot of work on undelte. So for now, all associations of this attribute definition are deleted. -neumantm
-        for ttad in ttads:
-            DB.session.delete(ttad)
-
-        for ittad in ittads:
-            DB.session.delete(ittad)
+        # unassociate_attr_def already deleted (and flushed) most of them
+        for association in ttads + ittads:
+            if inspect(association).persistent:
+                DB.session.delete(association)
 
         attribute.deleted = True
         DB.session.commit()
@@ -192,25 +191,63 @@ class AttributeDefinitionValues(Resource):
     The current values of a attribute
     """
     @jwt_required
+    @conditional_get
+    @cached_response
+    @API.param('prefix', 'only values starting with this string (for strings without the quote)', type=str,
+               required=False, default='')
+    @API.param('limit', 'the maximum number of values', type=int, required=False, default=100)
+    @API.param('counts', 'return the values with the number of items having that value', type=bool,
+               required=False, default=False)
     @ANS.doc(model=ATTRIBUTE_DEFINITION_VALUES)
+    @ANS.response(200, 'Success (with counts=true)', [ATTRIBUTE_DEFINITION_VALUE_COUNT])
+    @ANS.response(400, 'The limit has to be at least 1!')
     @ANS.response(404, 'Requested attribute not found!')
     # pylint: disable=R0201
     def get(self, definition_id):
         """
-        Get all values of this attribute definition
+        Get the distinct values of this attribute definition (ordered by value, with counts by frequency)
         """
-        base_query = AttributeDefinition.query.options(joinedload('_item_to_attribute_definitions').joinedload('item')).filter(AttributeDefinition.id == definition_id)
+        base_query = AttributeDefinition.query.filter(AttributeDefinition.id == definition_id)
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((AttributeDefinition.visible_for == 'all') | (AttributeDefinition.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(AttributeDefinition.visible_for == 'all')
-
-        attributeDefinition = base_query.first()
-        if attributeDefinition is None:
+        base_query = restrict_visibility(base_query, AttributeDefinition)
+
+        attribute_definition = base_query.first()
+        if attribute_definition is None:
             APP.logger.debug('Requested attribute not found for id: %s !', definition_id)
             abort(404, 'Requested attribute not found!')
 
-        return list(set([itad.value for itad in attributeDefinition._item_to_attribute_definitions])).sort()
+        prefix = request.args.get('prefix', default='', type=str)
+        limit = request.args.get('limit', default=100, type=int)
+        if limit < 1:
+            abort(400, 'The limit has to be at least 1!')
+        with_counts = request.args.get('counts', 'false') == 'true'
+
+        count = func.count(ItemToAttributeDefinition.item_id)
+        # pylint: disable=C0121
+        values_query = (DB.session.query(ItemToAttributeDefinition.value, count)
+                        .join(Item, Item.id == ItemToAttributeDefinition.item_id)
+                        .filter(ItemToAttributeDefinition.attribute_definition_id == definition_id)
+                        .filter(ItemToAttributeDefinition.deleted_time == None)
+                        .filter(ItemToAttributeDefinition.value != '')
+                        .filter(Item.deleted_time == None))
+        values_query = restrict_visibility(values_query, Item)
+
+        if prefix:
+            # the values are stored as json, string values start with a quote
+            if attribute_definition.type == 'string':
+                prefix = dumps(prefix, ensure_ascii=False)[:-1]
+            pattern = escape_like(prefix) + '%'
+            values_query = values_query.filter(ItemToAttributeDefinition.value.like(pattern, escape='\\'))
+
+        values_query = values_query.group_by(ItemToAttributeDefinition.value)
+        if with_counts:
+            values_query = values_query.order_by(count.desc(), ItemToAttributeDefinition.value)
+        else:
+            values_query = values_query.order_by(ItemToAttributeDefinition.value)
+        values = values_query.limit(limit).all()
+
+        if with_counts:
+            return marshal([{'value': value, 'count': value_count} for value, value_count in values],
+                           ATTRIBUTE_DEFINITION_VALUE_COUNT)
+        return [value for value, _ in values]
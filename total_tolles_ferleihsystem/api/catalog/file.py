@@ -3,21 +3,24 @@ This module contains all API endpoints for the namespace 'file'
 """
 
 import os
-from typing import Tuple
-# pylint: disable=E0611
-from hashlib import sha3_256
-from flask import request, make_response
+import mimetypes
+import unicodedata
+from flask import request, make_response, send_file, url_for
 from flask_restplus import Resource, abort, marshal
-from flask_jwt_extended import jwt_required, get_jwt_claims
+from flask_jwt_extended import jwt_required
 from sqlalchemy.orm import joinedload
 from sqlalchemy.exc import IntegrityError
+from werkzeug.urls import url_quote
 
 from total_tolles_ferleihsystem.tasks.file import create_archive
+from ...file_store import BLOB_STORE, store_stream, release_file
 from ..models import FILE_GET, FILE_PUT
 from ...login import UserRole
 from ...db_models.item import Item, File
 
-from .. import API, satisfies_role
+from .. import API, satisfies_role, restrict_visibility
+from ..pagination import paginate
+from ..load_plans import load_plan
 from ... import APP, DB
 
 
@@ -25,6 +28,20 @@ from ... import APP, DB
 PATH: str = '/catalog/files'
 ANS = API.namespace('file', description='The file Endpoints', path=PATH)
 
+
+def attachment_filenames(attachment_name: str) -> dict:
+    """
+    The filename parameters of the Content-Disposition header.
+
+    Contains a ascii fallback and the utf-8 encoded name (RFC 5987), quoting is done by the headers.
+    """
+    ascii_name = unicodedata.normalize('NFKD', attachment_name).encode('ascii', 'ignore').decode('ascii')
+    return {
+        'filename': ascii_name,
+        'filename*': "UTF-8''" + url_quote(attachment_name, safe=''),
+    }
+
+
 @ANS.route('/')
 class FileList(Resource):
     """
@@ -32,21 +49,19 @@ class FileList(Resource):
     """
 
     @jwt_required
+    @API.param('limit', 'the maximum number of files per page', type=int, required=False)
+    @API.param('cursor', 'the cursor of the page to get (taken from the next link)', type=str, required=False)
     @API.marshal_list_with(FILE_GET)
     def get(self):
         """
         Get a list of files
         """
-        base_query = File.query.options(joinedload('item'))
+        base_query = File.query.options(*load_plan(FILE_GET))
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((File.visible_for == 'all') | (File.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(File.visible_for == 'all')
+        base_query = restrict_visibility(base_query, File)
 
-        return base_query.all()
+        return paginate(base_query, (File.name, File.id), request.args.get('limit', default=None, type=int))
 
     @jwt_required
     @satisfies_role(UserRole.ADMIN)
@@ -73,21 +88,15 @@ class FileList(Resource):
         if Item.query.filter(Item.id == item_id).first() is None:
             abort(404, 'Requested item was not found!')
 
-        # calculate the file hash and reset the file read pointer
-        file_hash = sha3_256(file.stream.read()).hexdigest()
-        file.stream.seek(0)
+        # save the file to disk (hashing it on the way)
+        with store_stream(file.stream) as file_hash:
+            # generate the item object
+            __name, ext = os.path.splitext(file.filename)
+            new = File(item_id=item_id, name='', file_type=ext, file_hash=file_hash)
 
-        # generate the item object
-        __name, ext = os.path.splitext(file.filename)
-        new = File(item_id=item_id, name='', file_type=ext, file_hash=file_hash)
-
-        # save the file to disk
-        with open(os.path.join(APP.config['DATA_DIRECTORY'], file_hash), mode='wb') as file_on_disk:
-            file_on_disk.write(file.stream.read())
-
-        # add the file to the sql database
-        DB.session.add(new)
-        DB.session.commit()
+            # add the file to the sql database (while the stored blob is locked)
+            DB.session.add(new)
+            DB.session.commit()
         return marshal(new, FILE_GET), 201
 
 
@@ -104,14 +113,10 @@ class FileDetail(Resource):
         """
         Get a single file object
         """
-        base_query = File.query.filter(File.id == file_id).options(joinedload('item'))
+        base_query = File.query.filter(File.id == file_id).options(*load_plan(FILE_GET))
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((File.visible_for == 'all') | (File.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(File.visible_for == 'all')
+        base_query = restrict_visibility(base_query, File)
 
         file = base_query.first()
 
@@ -137,6 +142,7 @@ class FileDetail(Resource):
 
         DB.session.delete(file)
         DB.session.commit()
+        release_file(file.file_hash)
         return "", 204
 
     @jwt_required
@@ -149,7 +155,7 @@ class FileDetail(Resource):
         """
         Replace a file object
         """
-        file = File.query.filter(File.id == file_id).options(joinedload('item')).first()
+        file = File.query.filter(File.id == file_id).options(*load_plan(FILE_GET)).first()
 
         if file is None:
             APP.logger.debug('Requested file not found for id: %s !', file_id)
@@ -172,36 +178,43 @@ class ArchiveHandler(Resource):
     @API.param('name', 'The name of the archive file', type=str, required=False, default='archive')
     @API.param('file', 'The file_ids to be added to the archive', type=str, required=True)
     @ANS.response(202, 'Archive is currently generated.')
+    @ANS.response(400, 'No files or unfinished files given!')
+    @ANS.response(404, 'Requested files not found!')
     @ANS.response(500, 'SQL Error!')
     def post(self):
         """
         Create a Archive of files
         """
-        abort(501, 'Currently not implemented!!') # TODO fix archive endpoint
-
         file_name = request.args.get('name', default='archive', type=str)
         file_ids = request.args.getlist('file', type=int)
 
-        def map_function(file_id: int) -> Tuple[str, str]:
-            """
-            Inline function which maps the id to its file entry
-            """
-            file = File.query.filter(File.id == file_id).first()
-            return (file.file_hash, file.name + file.file_type)
+        if not file_ids:
+            abort(400, 'No files to archive given!')
+
+        files = {file.id: file for file in File.query.filter(File.id.in_(file_ids)).all()}
+        missing = [file_id for file_id in file_ids if file_id not in files]
+        if missing:
+            abort(404, 'Requested files not found: {}'.format(missing))
+        if any(file.file_hash is None for file in files.values()):
+            abort(400, 'Archives can only contain finished files!')
 
         new = File(name=file_name, file_type='.zip', file_hash=None)
 
         try:
             DB.session.add(new)
             DB.session.commit()
-
-            # Run task
-            create_archive.delay(new.id, list(map(map_function, file_ids)))
-
-            return marshal(new, FILE_GET), 202
         except IntegrityError:
             abort(500, 'SQL Error!')
 
+        archive = marshal(new, FILE_GET)
+
+        # Run task
+        entries = [(files[file_id].file_hash, files[file_id].name + files[file_id].file_type)
+                   for file_id in dict.fromkeys(file_ids)]
+        task = create_archive.delay(new.id, entries)
+
+        return archive, 202, {'Location': url_for('api.tasks_task_detail', task_id=task.id)}
+
 
 PATH2: str = '/file-store'
 ANS2 = API.namespace('file', description='The download Endpoint to download any file from the system.', path=PATH2)
@@ -214,6 +227,9 @@ class FileData(Resource):
 
     @jwt_required
     @ANS.response(404, 'Requested file not found!')
+    @ANS.response(409, 'The file is not available yet!')
+    @ANS.response(304, 'Not modified.')
+    @ANS.response(206, 'Partial content.')
     @ANS.response(500, 'Something crashed while reading file!')
     def get(self, file_id):
         """
@@ -222,11 +238,7 @@ class FileData(Resource):
         base_query = File.query.filter(File.id == file_id).options(joinedload('item'))
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((File.visible_for == 'all') | (File.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(File.visible_for == 'all')
+        base_query = restrict_visibility(base_query, File)
 
         file = base_query.first()
 
@@ -234,12 +246,37 @@ class FileData(Resource):
             APP.logger.debug('Requested file not found for id: %s !', file_id)
             abort(404, 'Requested file was not found!')
 
-        headers = {
-            "Content-Disposition": "attachment; filename={}".format(file.item.name + file.name + file.file_type)
-        }
-
-        with open(os.path.join(APP.config['DATA_DIRECTORY'], file.file_hash), mode='rb') as file_on_disk:
-            return make_response(file_on_disk.read(), headers)
-
-        APP.logger.error('Crash while downloading file: %s !', file_id)
-        abort(500, 'Something crashed while reading file!')
+        if file.file_hash is None:
+            abort(409, 'The file is not available yet!')
+
+        file_path = BLOB_STORE.path(file.file_hash)
+        if not os.path.isfile(file_path):
+            APP.logger.error('Crash while downloading file: %s ! The stored file %s is missing.', file_id,
+                             file.file_hash)
+            abort(500, 'Something crashed while reading file!')
+
+        item_name = file.item.name if file.item is not None else ''
+        attachment_name = item_name + file.name + file.file_type
+
+        accel_prefix = APP.config.get('X_ACCEL_REDIRECT_PREFIX')
+        if accel_prefix:
+            # let the reverse proxy send the actual bytes (including range requests)
+            response = make_response('')
+            response.headers.set('Content-Disposition', 'attachment', **attachment_filenames(attachment_name))
+            response.headers['X-Accel-Redirect'] = accel_prefix + BLOB_STORE.relative_path(file.file_hash)
+            response.mimetype = mimetypes.guess_type(attachment_name)[0] or 'application/octet-stream'
+        else:
+            # streams the file in chunks; uses X-Sendfile if USE_X_SENDFILE is set
+            response = send_file(file_path, as_attachment=True, attachment_filename=attachment_name,
+                                 add_etags=False, conditional=False)
+            response.headers.set('Content-Disposition', 'attachment', **attachment_filenames(attachment_name))
+
+        # stored files are content addressed, the hash is a strong etag
+        response.set_etag(file.file_hash)
+        response.expires = None
+        response.headers['Cache-Control'] = 'private, max-age={}, immutable'.format(
+            APP.config.get('FILE_CACHE_MAX_AGE', 31536000))
+
+        if accel_prefix:
+            return response.make_conditional(request)
+        return response.make_conditional(request, accept_ranges=True, complete_length=os.path.getsize(file_path))
@@ -4,11 +4,15 @@ This module contains all API endpoints for the namespace 'item'
 
 from flask import request
 from flask_restplus import Resource, abort, marshal
-from flask_jwt_extended import jwt_required, get_jwt_claims
+from flask_jwt_extended import jwt_required
 from sqlalchemy.orm import joinedload
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import select
 
-from .. import API, satisfies_role
+from .. import API, satisfies_role, restrict_visibility
+from ..caching import cached_response, conditional_get
+from ..pagination import paginate
+from ..load_plans import load_plan
 from ..models import ITEM_GET, ITEM_POST, ID, ITEM_PUT, ITEM_TAG_GET, ATTRIBUTE_GET, FILE_GET, LENDING_GET
 from ... import DB, APP
 from ...login import UserRole
@@ -16,7 +20,8 @@ from ...performance import record_view_performance
 
 from ...db_models.item import Item, ItemToTag, ItemToAttributeDefinition, ItemToItem, File, Lending
 from ...db_models.itemType import ItemType, ItemTypeToItemType
-from ...db_models.tag import Tag
+from ...db_models.tag import Tag, TagToAttributeDefinition
+from ...db_models.attributeReconciliation import add_attributes, remove_orphaned_attributes
 from ...db_models.attributeDefinition import AttributeDefinition
 
 PATH: str = '/catalog/items'
@@ -30,8 +35,12 @@ class ItemList(Resource):
     """
 
     @jwt_required
+    @conditional_get
+    @cached_response
     @API.param('deleted', 'get all deleted elements (and only these)', type=bool, required=False, default=False)
     @API.param('lent', 'get all currently lent items', type=bool, required=False, default=False)
+    @API.param('limit', 'the maximum number of items per page', type=int, required=False)
+    @API.param('cursor', 'the cursor of the page to get (taken from the next link)', type=str, required=False)
     @API.marshal_list_with(ITEM_GET)
     @record_view_performance()
     # pylint: disable=R0201
@@ -39,7 +48,7 @@ class ItemList(Resource):
         """
         Get a list of all items currently in the system
         """
-        base_query = Item.query.options(joinedload('lending'), joinedload("_tags"))
+        base_query = Item.query.options(*load_plan(ITEM_GET))
         test_for = request.args.get('deleted', 'false') == 'true'
         if test_for:
             base_query = base_query.filter(Item.deleted_time != None)
@@ -47,16 +56,12 @@ class ItemList(Resource):
             base_query = base_query.filter(Item.deleted_time == None)
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((Item.visible_for == 'all') | (Item.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(Item.visible_for == 'all')
+        base_query = restrict_visibility(base_query, Item)
 
         if request.args.get('lent', 'false') == 'true':
             base_query = base_query.filter(Item.lending_id != None)
 
-        return base_query.order_by(Item.name).all()
+        return paginate(base_query, (Item.name, Item.id), request.args.get('limit', default=None, type=int))
 
     @jwt_required
     @satisfies_role(UserRole.ADMIN)
@@ -98,6 +103,7 @@ class ItemDetail(Resource):
     """
 
     @jwt_required
+    @conditional_get
     @ANS.response(404, 'Requested item not found!')
     @API.marshal_with(ITEM_GET)
     # pylint: disable=R0201
@@ -108,13 +114,9 @@ class ItemDetail(Resource):
         base_query = Item.query
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((Item.visible_for == 'all') | (Item.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(Item.visible_for == 'all')
+        base_query = restrict_visibility(base_query, Item)
 
-        item = base_query.filter(Item.id == item_id).first()
+        item = base_query.options(*load_plan(ITEM_GET)).filter(Item.id == item_id).first()
         if item is None:
             abort(404, 'Requested item not found!')
 
@@ -207,6 +209,7 @@ class ItemItemTags(Resource):
     """
 
     @jwt_required
+    @conditional_get
     @ANS.response(404, 'Requested item not found!')
     @API.marshal_with(ITEM_TAG_GET)
     # pylint: disable=R0201
@@ -217,11 +220,7 @@ class ItemItemTags(Resource):
         base_query = Item.query
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((Item.visible_for == 'all') | (Item.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(Item.visible_for == 'all')
+        base_query = restrict_visibility(base_query, Item)
 
         # pylint: disable=C0121
         if base_query.filter(Item.id == item_id).filter(Item.deleted_time == None).first() is None:
@@ -254,12 +253,10 @@ class ItemItemTags(Resource):
 
         new = ItemToTag(item_id, tag_id)
 
-        attributes_to_add, _, attributes_to_undelete = item.get_attribute_changes_from_tag(tag_id)
         try:
             DB.session.add(new)
-            DB.session.add_all(attributes_to_add)
-            for attr in attributes_to_undelete:
-                attr.deleted = False
+            add_attributes([item_id], select([TagToAttributeDefinition.attribute_definition_id])
+                           .where(TagToAttributeDefinition.tag_id == tag_id))
             DB.session.commit()
             associations = ItemToTag.query.filter(ItemToTag.item_id == item_id).all()
             return [e.tag for e in associations]
@@ -300,12 +297,10 @@ class ItemItemTags(Resource):
         if association is None:
             return '', 204
 
-        _, attributes_to_delete, _ = item.get_attribute_changes_from_tag(tag_id, True)
-
         try:
             DB.session.delete(association)
-            for attr in attributes_to_delete:
-                attr.deleted = True
+            remove_orphaned_attributes([item_id], select([TagToAttributeDefinition.attribute_definition_id])
+                                       .where(TagToAttributeDefinition.tag_id == tag_id))
             DB.session.commit()
             return '', 204
         except IntegrityError:
@@ -318,6 +313,7 @@ class ItemAttributeList(Resource):
     """
 
     @jwt_required
+    @conditional_get
     @ANS.response(404, 'Requested item not found!')
     @API.marshal_with(ATTRIBUTE_GET)
     # pylint: disable=R0201
@@ -328,11 +324,7 @@ class ItemAttributeList(Resource):
         base_query = Item.query
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((Item.visible_for == 'all') | (Item.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(Item.visible_for == 'all')
+        base_query = restrict_visibility(base_query, Item)
 
         # pylint: disable=C0121
         if base_query.filter(Item.id == item_id).filter(Item.deleted_time == None).first() is None:
@@ -356,6 +348,7 @@ class ItemAttributeDetail(Resource):
     """
 
     @jwt_required
+    @conditional_get
     @ANS.response(404, 'Requested item not found!')
     @ANS.response(400, "This item doesn't have that type of attribute!")
     @API.marshal_with(ATTRIBUTE_GET)
@@ -367,11 +360,7 @@ class ItemAttributeDetail(Resource):
         base_query = Item.query
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((Item.visible_for == 'all') | (Item.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(Item.visible_for == 'all')
+        base_query = restrict_visibility(base_query, Item)
 
         # pylint: disable=C0121
         if base_query.filter(Item.id == item_id).filter(Item.deleted_time == None).first() is None:
@@ -436,6 +425,7 @@ class ItemParentItems(Resource):
     """
 
     @jwt_required
+    @conditional_get
     @ANS.response(404, 'Requested item not found!')
     @API.marshal_list_with(ITEM_GET)
     # pylint: disable=R0201
@@ -446,18 +436,19 @@ class ItemParentItems(Resource):
         base_query = Item.query
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((Item.visible_for == 'all') | (Item.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(Item.visible_for == 'all')
+        base_query = restrict_visibility(base_query, Item)
 
         # pylint: disable=C0121
         if base_query.filter(Item.id == item_id).filter(Item.deleted_time == None).first() is None:
             abort(404, 'Requested item not found!')
 
-        associations = ItemToItem.query.filter(ItemToItem.item_id == item_id).options(joinedload('parent')).all()
-        return [e.parent for e in associations if not e.item.deleted]
+        # pylint: disable=C0121
+        return (Item.query
+                .join(ItemToItem, ItemToItem.parent_id == Item.id)
+                .filter(ItemToItem.item_id == item_id)
+                .filter(Item.deleted_time == None)
+                .options(*load_plan(ITEM_GET))
+                .all())
 
 
 @ANS.route('/<int:item_id>/contained/')
@@ -467,6 +458,7 @@ class ItemContainedItems(Resource):
     """
 
     @jwt_required
+    @conditional_get
     @ANS.response(404, 'Requested item not found!')
     @API.marshal_list_with(ITEM_GET)
     # pylint: disable=R0201
@@ -477,18 +469,19 @@ class ItemContainedItems(Resource):
         base_query = Item.query
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((Item.visible_for == 'all') | (Item.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(Item.visible_for == 'all')
+        base_query = restrict_visibility(base_query, Item)
 
         # pylint: disable=C0121
         if base_query.filter(Item.id == item_id).filter(Item.deleted_time == None).first() is None:
             abort(404, 'Requested item not found!')
 
-        associations = ItemToItem.query.filter(ItemToItem.parent_id == item_id).options(joinedload('item')).all()
-        return [e.item for e in associations if not e.item.deleted]
+        # pylint: disable=C0121
+        return (Item.query
+                .join(ItemToItem, ItemToItem.item_id == Item.id)
+                .filter(ItemToItem.parent_id == item_id)
+                .filter(Item.deleted_time == None)
+                .options(*load_plan(ITEM_GET))
+                .all())
 
     @jwt_required
     @satisfies_role(UserRole.ADMIN)
@@ -527,8 +520,11 @@ class ItemContainedItems(Resource):
         try:
             DB.session.add(new)
             DB.session.commit()
-            associations = ItemToItem.query.filter(ItemToItem.parent_id == item_id).options(joinedload('item')).all()
-            return [e.item for e in associations]
+            return (Item.query
+                    .join(ItemToItem, ItemToItem.item_id == Item.id)
+                    .filter(ItemToItem.parent_id == item_id)
+                    .options(*load_plan(ITEM_GET))
+                    .all())
         except IntegrityError as err:
             message = str(err)
             if APP.config['DB_UNIQUE_CONSTRAIN_FAIL'] in message:
@@ -578,6 +574,7 @@ class ItemFile(Resource):
     """
 
     @jwt_required
+    @conditional_get
     @ANS.response(404, 'Requested item not found!')
     @API.marshal_list_with(FILE_GET)
     # pylint: disable=R0201
@@ -588,17 +585,13 @@ class ItemFile(Resource):
         base_query = Item.query
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((Item.visible_for == 'all') | (Item.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(Item.visible_for == 'all')
+        base_query = restrict_visibility(base_query, Item)
 
         # pylint: disable=C0121
         if base_query.filter(Item.id == item_id).filter(Item.deleted_time == None).first() is None:
             abort(404, 'Requested item not found!')
 
-        return File.query.filter(File.item_id == item_id).options(joinedload('item')).all()
+        return File.query.filter(File.item_id == item_id).options(*load_plan(FILE_GET)).all()
 
 @ANS.route('/<int:item_id>/lending/')
 class ItemLendings(Resource):
@@ -607,6 +600,7 @@ class ItemLendings(Resource):
     """
 
     @jwt_required
+    @conditional_get
     @ANS.response(404, 'Requested item not found!')
     @API.marshal_list_with(LENDING_GET)
     # pylint: disable=R0201
@@ -617,14 +611,14 @@ class ItemLendings(Resource):
         base_query = Item.query
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((Item.visible_for == 'all') | (Item.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(Item.visible_for == 'all')
+        base_query = restrict_visibility(base_query, Item)
 
         # pylint: disable=C0121
-        item = base_query.filter(Item.id == item_id).filter(Item.deleted_time == None).first()
+        item = (base_query
+                .filter(Item.id == item_id)
+                .filter(Item.deleted_time == None)
+                .options(*load_plan(LENDING_GET, joinedload('lending')))
+                .first())
         if item is None:
             abort(404, 'Requested item not found!')
 
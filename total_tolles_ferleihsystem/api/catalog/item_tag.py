@@ -4,18 +4,24 @@ This module contains all API endpoints for the namespace 'item_tag'
 
 from flask import request
 from flask_restplus import Resource, abort, marshal
-from flask_jwt_extended import jwt_required, get_jwt_claims
+from flask_jwt_extended import jwt_required
 from sqlalchemy.orm import joinedload
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import select
 
-from .. import API, satisfies_role
-from ..models import ITEM_TAG_GET, ITEM_TAG_POST, ATTRIBUTE_DEFINITION_GET, ID, ITEM_TAG_PUT
+from .. import API, satisfies_role, restrict_visibility
+from ..caching import cached_response, conditional_get
+from ..models import ITEM_TAG_GET, ITEM_TAG_POST, ATTRIBUTE_DEFINITION_GET, ID, ITEM_TAG_PUT, TASK_STATUS
+from ..tasks import async_requested, enqueue
 from ... import DB
 from ...login import UserRole
 
 from ...db_models.tag import Tag, TagToAttributeDefinition
 from ...db_models.attributeDefinition import AttributeDefinition
 from ...db_models.item import ItemToTag
+from ...db_models.attributeReconciliation import add_attributes
+from ...tasks import catalog as catalog_tasks
+from ... import catalog_maintenance
 
 PATH: str = '/catalog/item_tags'
 ANS = API.namespace('item_tag', description='ItemTags', path=PATH)
@@ -28,6 +34,8 @@ class ItemTagList(Resource):
     """
 
     @jwt_required
+    @conditional_get
+    @cached_response
     @API.param('deleted', 'get all deleted item tags (and only these)', type=bool, required=False, default=False)
     @API.marshal_list_with(ITEM_TAG_GET)
     # pylint: disable=R0201
@@ -43,11 +51,7 @@ class ItemTagList(Resource):
             base_query = base_query.filter(Tag.deleted_time == None)
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((Tag.visible_for == 'all') | (Tag.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(Tag.visible_for == 'all')
+        base_query = restrict_visibility(base_query, Tag)
 
         return base_query.order_by(Tag.name).all()
 
@@ -82,6 +86,7 @@ class ItemTagDetail(Resource):
     """
 
     @jwt_required
+    @conditional_get
     @ANS.response(404, 'Requested item tag not found!')
     @API.marshal_with(ITEM_TAG_GET)
     # pylint: disable=R0201
@@ -92,11 +97,7 @@ class ItemTagDetail(Resource):
         base_query = Tag.query.filter(Tag.id == tag_id)
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((Tag.visible_for == 'all') | (Tag.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(Tag.visible_for == 'all')
+        base_query = restrict_visibility(base_query, Tag)
 
         item_tag = base_query.first()
 
@@ -107,8 +108,10 @@ class ItemTagDetail(Resource):
 
     @jwt_required
     @satisfies_role(UserRole.ADMIN)
+    @API.param('async', 'Update the tagged items in a background task', type=bool, required=False, default=False)
     @ANS.response(404, 'Requested item tag not found!')
     @ANS.response(204, 'Success.')
+    @ANS.response(202, 'Item tag is deleted in the background.', TASK_STATUS)
     # pylint: disable=R0201
     def delete(self, tag_id):
         """
@@ -119,23 +122,19 @@ class ItemTagDetail(Resource):
             APP.logger.debug('Requested item tag not found for id: %s !', tag_id)
             abort(404, 'Requested item tag not found!')
 
-        itts = ItemToTag.query.filter(ItemToTag.tag_id == tag_id).all()
-        items = [itt.item for itt in itts]
-
-        for item in items:
-            _, attributes_to_delete, _ = item.get_attribute_changes_from_tag(tag_id, True)
-            for attr in attributes_to_delete:
-                attr.deleted = True
-
-        item_tag.deleted = True
+        if async_requested():
+            return enqueue(catalog_tasks.set_tag_deleted, tag_id, True)
 
+        catalog_maintenance.set_tag_deleted(tag_id, True)
         DB.session.commit()
         return "", 204
 
     @jwt_required
     @satisfies_role(UserRole.ADMIN)
+    @API.param('async', 'Update the tagged items in a background task', type=bool, required=False, default=False)
     @ANS.response(404, 'Requested item tag not found!')
     @ANS.response(204, 'Success.')
+    @ANS.response(202, 'Item tag is undeleted in the background.', TASK_STATUS)
     # pylint: disable=R0201
     def post(self, tag_id):
         """
@@ -146,16 +145,10 @@ class ItemTagDetail(Resource):
             APP.logger.debug('Requested item tag not found for id: %s !', tag_id)
             abort(404, 'Requested item tag not found!')
 
-        itts = ItemToTag.query.filter(ItemToTag.tag_id == tag_id).all()
-        items = [itt.item for itt in itts]
+        if async_requested():
+            return enqueue(catalog_tasks.set_tag_deleted, tag_id, False)
 
-        for item in items:
-            attributes_to_add, _, attributes_to_undelete = item.get_attribute_changes_from_tag(tag_id)
-            for attr in attributes_to_undelete:
-                attr.deleted = False
-            DB.session.add_all(attributes_to_add)
-
-        item_tag.deleted = False
+        catalog_maintenance.set_tag_deleted(tag_id, False)
         DB.session.commit()
         return "", 204
 
@@ -196,6 +189,7 @@ class ItemTagAttributes(Resource):
     """
 
     @jwt_required
+    @conditional_get
     @ANS.response(404, 'Requested item tag not found!')
     @API.marshal_with(ATTRIBUTE_DEFINITION_GET)
     # pylint: disable=R0201
@@ -206,11 +200,7 @@ class ItemTagAttributes(Resource):
         base_query = Tag.query.options(joinedload('_tag_to_attribute_definitions')).filter(Tag.id == tag_id).filter(Tag.deleted_time == None)
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((Tag.visible_for == 'all') | (Tag.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(Tag.visible_for == 'all')
+        base_query = restrict_visibility(base_query, Tag)
 
         tag = base_query.first()
         if tag is None:
@@ -241,16 +231,10 @@ class ItemTagAttributes(Resource):
             APP.logger.debug('Requested attribute definition not found for id: %s !', attribute_definition_id)
             abort(400, 'Requested attribute definition not found!')
 
-        items = [itt.item for itt in ItemToTag.query.filter(ItemToTag.tag_id == tag_id).options(joinedload('item')).all()]
-
         new = TagToAttributeDefinition(tag_id, attribute_definition_id)
         try:
             DB.session.add(new)
-            for item in items:
-                attributes_to_add, _, attributes_to_undelete = item.get_attribute_changes([attribute_definition_id])
-                DB.session.add_all(attributes_to_add)
-                for attr in attributes_to_undelete:
-                    attr.deleted = False
+            add_attributes(select([ItemToTag.item_id]).where(ItemToTag.tag_id == tag_id), [attribute_definition_id])
             DB.session.commit()
             associations = TagToAttributeDefinition.query.filter(TagToAttributeDefinition.tag_id == tag_id).all()
             return [e.attribute_definition for e in associations]
@@ -4,23 +4,41 @@ This module contains all API endpoints for the namespace 'item_type'
 
 from flask import request
 from flask_restplus import Resource, abort, marshal
-from flask_jwt_extended import jwt_required, get_jwt_claims
+from flask_jwt_extended import jwt_required
+from kombu.exceptions import OperationalError as BrokerError
 from sqlalchemy.orm import joinedload
 from sqlalchemy.exc import IntegrityError
 
-from .. import API, satisfies_role
-from ..models import ITEM_TYPE_GET, ITEM_TYPE_POST, ATTRIBUTE_DEFINITION_GET, ID, ITEM_TYPE_PUT
+from .. import API, satisfies_role, restrict_visibility
+from ..caching import cached_response, conditional_get
+from ..models import ITEM_TYPE_GET, ITEM_TYPE_POST, ATTRIBUTE_DEFINITION_GET, ID, ITEM_TYPE_PUT, TASK_STATUS
+from ..tasks import async_requested, enqueue
 from ... import DB, APP
 from ...login import UserRole
 
 from ...db_models.attributeDefinition import AttributeDefinition
+from ...db_models.item import rerender_item_names
 from ...db_models.itemType import ItemType, ItemTypeToAttributeDefinition, ItemTypeToItemType
-from ...db_models.item import Item
+from ...tasks.item import rerender_names
+from ...tasks import catalog as catalog_tasks
+from ... import catalog_maintenance
 
 
 PATH: str = '/catalog/item_types'
 ANS = API.namespace('item_type', description='ItemTypes', path=PATH)
 
+
+def rerender_names_of_type(type_id: int) -> None:
+    """
+    Render the item names of the type again in a background task (right away if the broker is unreachable).
+    """
+    try:
+        rerender_names.delay(type_id)
+    except BrokerError as err:
+        APP.logger.error('Could not start the task rendering the item names of item type %s: %s', type_id, err)
+        rerender_item_names(type_id)
+
+
 @ANS.route('/')
 class ItemTypeList(Resource):
     """
@@ -28,6 +46,8 @@ class ItemTypeList(Resource):
     """
 
     @jwt_required
+    @conditional_get
+    @cached_response
     @API.param('deleted', 'get all deleted objects (and only these)', type=bool, required=False, default=False)
     @API.marshal_list_with(ITEM_TYPE_GET)
     # pylint: disable=R0201
@@ -43,11 +63,7 @@ class ItemTypeList(Resource):
             base_query = base_query.filter(ItemType.deleted_time == None)
         
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((ItemType.visible_for == 'all') | (ItemType.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(ItemType.visible_for == 'all')
+        base_query = restrict_visibility(base_query, ItemType)
 
         return base_query.order_by(ItemType.name).all()
 
@@ -82,6 +98,7 @@ class ItemTypeDetail(Resource):
     """
 
     @jwt_required
+    @conditional_get
     @ANS.response(404, 'Requested item type not found!')
     @API.marshal_with(ITEM_TYPE_GET)
     # pylint: disable=R0201
@@ -92,11 +109,7 @@ class ItemTypeDetail(Resource):
         base_query = ItemType.query.filter(ItemType.id == type_id)
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((ItemType.visible_for == 'all') | (ItemType.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(ItemType.visible_for == 'all')
+        base_query = restrict_visibility(base_query, ItemType)
 
         item_type = base_query.first()
 
@@ -108,8 +121,11 @@ class ItemTypeDetail(Resource):
 
     @jwt_required
     @satisfies_role(UserRole.ADMIN)
+    @API.param('async', 'Delete the items in a background task', type=bool, required=False, default=False)
     @ANS.response(404, 'Requested item type not found!')
+    @ANS.response(400, 'Requested item is currently lent!')
     @ANS.response(204, 'Success.')
+    @ANS.response(202, 'Item type is deleted in the background.', TASK_STATUS)
     # pylint: disable=R0201
     def delete(self, type_id):
         """
@@ -121,15 +137,16 @@ class ItemTypeDetail(Resource):
             APP.logger.debug('Requested item type (id: %s) not found!', type_id)
             abort(404, 'Requested item type not found!')
 
-        item_type.deleted = True
+        if async_requested():
+            return enqueue(catalog_tasks.delete_item_type, type_id)
 
-        items = Item.query.filter(Item.type_id == type_id).all()
-        for item in items:
-            code, msg, commit = item.delete()
-            if not commit:
-                 abort(code, msg)
+        try:
+            # commits the deletion itself
+            catalog_maintenance.delete_item_type(type_id)
+        except ValueError as err:
+            DB.session.rollback()
+            abort(400, str(err))
 
-        DB.session.commit()
         return "", 204
 
     @jwt_required
@@ -168,11 +185,16 @@ class ItemTypeDetail(Resource):
             APP.logger.debug('Requested item type (id: %s) not found!', type_id)
             abort(404, 'Requested item type not found!')
 
+        old_name_parts = (item_type.name, item_type.name_schema)
         item_type.update(**request.get_json())
 
         try:
             DB.session.commit()
-            return marshal(item_type, ITEM_TYPE_GET), 200
+            result = marshal(item_type, ITEM_TYPE_GET)
+            if old_name_parts != (item_type.name, item_type.name_schema):
+                # the item names depend on both, render them again in one batched pass
+                rerender_names_of_type(type_id)
+            return result, 200
         except IntegrityError as err:
             message = str(err)
             if APP.config['DB_UNIQUE_CONSTRAIN_FAIL'] in message:
@@ -189,6 +211,7 @@ class ItemTypeAttributes(Resource):
     """
 
     @jwt_required
+    @conditional_get
     @ANS.response(404, 'Requested item type not found!')
     @API.marshal_with(ATTRIBUTE_DEFINITION_GET)
     # pylint: disable=R0201
@@ -199,11 +222,7 @@ class ItemTypeAttributes(Resource):
         base_query = ItemType.query.options(joinedload('_item_type_to_attribute_definitions')).filter(ItemType.id == type_id).filter(ItemType.deleted_time == None)
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((ItemType.visible_for == 'all') | (ItemType.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(ItemType.visible_for == 'all')
+        base_query = restrict_visibility(base_query, ItemType)
 
         item_type = base_query.first()
 
@@ -215,11 +234,13 @@ class ItemTypeAttributes(Resource):
 
     @jwt_required
     @satisfies_role(UserRole.ADMIN)
-    @ANS.doc(body=ID)
+    @ANS.doc(model=[ATTRIBUTE_DEFINITION_GET], body=ID)
+    @API.param('async', 'Add the attribute to the items in a background task', type=bool, required=False,
+               default=False)
     @ANS.response(404, 'Requested item type not found!')
     @ANS.response(400, 'Requested attribute definition not found!')
     @ANS.response(409, 'Attribute definition is already associated with this item type!')
-    @API.marshal_with(ATTRIBUTE_DEFINITION_GET)
+    @ANS.response(202, 'The attribute is added to the items in the background.', TASK_STATUS)
     # pylint: disable=R0201
     def post(self, type_id):
         """
@@ -236,22 +257,24 @@ class ItemTypeAttributes(Resource):
             APP.logger.debug('Requested item type (id: %s) not found!', type_id)
             abort(400, 'Requested attribute definition not found!')
 
-        items = Item.query.filter(Item.type_id == type_id).all()
-        new = ItemTypeToAttributeDefinition(type_id, attribute_definition_id)
+        if async_requested():
+            association = (ItemTypeToAttributeDefinition
+                           .query
+                           .filter(ItemTypeToAttributeDefinition.item_type_id == type_id)
+                           .filter(ItemTypeToAttributeDefinition.attribute_definition_id == attribute_definition_id)
+                           .first())
+            if association is not None:
+                abort(409, 'Attribute definition is already asociated with item type!')
+            return enqueue(catalog_tasks.associate_type_attribute, type_id, attribute_definition_id)
 
         try:
-            DB.session.add(new)
-            for item in items:
-                attributes_to_add, _, attributes_to_undelete = item.get_attribute_changes([attribute_definition_id])
-                DB.session.add_all(attributes_to_add)
-                for attr in attributes_to_undelete:
-                    attr.deleted = False
+            catalog_maintenance.associate_type_attribute(type_id, attribute_definition_id)
             DB.session.commit()
             associations = (ItemTypeToAttributeDefinition
                             .query
                             .filter(ItemTypeToAttributeDefinition.item_type_id == type_id)
                             .all())
-            return [e.attribute_definition for e in associations]
+            return marshal([e.attribute_definition for e in associations], ATTRIBUTE_DEFINITION_GET)
         except IntegrityError as err:
             message = str(err)
             if APP.config['DB_UNIQUE_CONSTRAIN_FAIL'] in message:
@@ -297,6 +320,7 @@ class ItemTypeContainedTypes(Resource):
     """
 
     @jwt_required
+    @conditional_get
     @ANS.response(404, 'Requested item type not found!')
     @API.marshal_with(ITEM_TYPE_GET)
     # pylint: disable=R0201
@@ -307,11 +331,7 @@ class ItemTypeContainedTypes(Resource):
         base_query = ItemType.query.options(joinedload('_contained_item_types').joinedload('item_type')).filter(ItemType.id == type_id).filter(ItemType.deleted_time == None)
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((ItemType.visible_for == 'all') | (ItemType.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(ItemType.visible_for == 'all')
+        base_query = restrict_visibility(base_query, ItemType)
 
         item_type = base_query.first()
         if item_type is None:
@@ -395,6 +415,7 @@ class ItemTypeParentTypes(Resource):
     """
 
     @jwt_required
+    @conditional_get
     @ANS.response(404, 'Requested item type not found!')
     @API.marshal_with(ITEM_TYPE_GET)
     # pylint: disable=R0201
@@ -405,11 +426,7 @@ class ItemTypeParentTypes(Resource):
         base_query = ItemType.query.options(joinedload('_possible_parent_item_types').joinedload('parent')).filter(ItemType.id == type_id).filter(ItemType.deleted_time == None)
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                base_query = base_query.filter((ItemType.visible_for == 'all') | (ItemType.visible_for == 'moderator'))
-            else:
-                base_query = base_query.filter(ItemType.visible_for == 'all')
+        base_query = restrict_visibility(base_query, ItemType)
 
         item_type = base_query.first()
         if item_type is None:
@@ -0,0 +1,49 @@
+"""
+Module containing the debug resources of the API.
+"""
+
+from flask import Response
+from flask_restplus import Resource
+from flask_jwt_extended import jwt_required
+
+from . import API, satisfies_role
+from .models import ENDPOINT_PERFORMANCE
+from ..login import UserRole
+from ..performance import aggregate_performance, prometheus_exposition
+
+PATH: str = '/debug'
+ANS = API.namespace('debug', description='Debug information', path=PATH)
+
+
+@ANS.route('/performance/')
+class PerformanceResource(Resource):
+    """
+    Performance of the recent requests of this worker
+    """
+
+    @jwt_required
+    @satisfies_role(UserRole.ADMIN)
+    @API.marshal_list_with(ENDPOINT_PERFORMANCE)
+    # pylint: disable=R0201
+    def get(self):
+        """
+        Get the latency quantiles, query counts and slowest statements per endpoint.
+        """
+        return aggregate_performance()
+
+
+@ANS.route('/performance/metrics/')
+class PerformanceMetricsResource(Resource):
+    """
+    Performance of the recent requests of this worker for prometheus
+    """
+
+    @jwt_required
+    @satisfies_role(UserRole.ADMIN)
+    @ANS.produces(['text/plain'])
+    # pylint: disable=R0201
+    def get(self):
+        """
+        Get the request durations in the prometheus text exposition format.
+        """
+        return Response(prometheus_exposition(), mimetype='text/plain', content_type='text/plain; version=0.0.4')
@@ -0,0 +1,95 @@
+"""
+Module containing the JSON serializers for api responses.
+
+orjson and ujson are optional, the serializer is selected with the JSON_SERIALIZER option.
+"""
+
+import json
+from typing import Any, Callable, Dict, Optional
+
+from flask import make_response
+
+from .. import APP
+
+# pylint: disable=C0103
+Serializer = Callable[[Any], bytes]
+
+
+def _orjson_serializer() -> Optional[Serializer]:
+    try:
+        import orjson
+    except ImportError:
+        return None
+
+    options = orjson.OPT_NON_STR_KEYS
+    if APP.debug:
+        options |= orjson.OPT_INDENT_2
+
+    def dumps(data: Any) -> bytes:
+        return orjson.dumps(data, option=options)
+    return dumps
+
+
+def _ujson_serializer() -> Optional[Serializer]:
+    try:
+        import ujson
+    except ImportError:
+        return None
+
+    indent = 4 if APP.debug else 0
+
+    def dumps(data: Any) -> bytes:
+        return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False, indent=indent).encode()
+    return dumps
+
+
+def _stdlib_serializer() -> Serializer:
+    settings = dict(APP.config.get('RESTPLUS_JSON', {}))
+    if APP.debug:
+        settings.setdefault('indent', 4)
+
+    def dumps(data: Any) -> bytes:
+        return json.dumps(data, **settings).encode()
+    return dumps
+
+
+SERIALIZERS: Dict[str, Callable[[], Optional[Serializer]]] = {
+    'orjson': _orjson_serializer,
+    'ujson': _ujson_serializer,
+    'json': _stdlib_serializer,
+}
+
+
+def get_serializer(name: str) -> Serializer:
+    """
+    Get the serializer with the given name ('auto' selects the fastest installed one).
+
+    Falls back to the json module of the standard library if the serializer is not installed.
+    """
+    if name == 'auto':
+        for candidate in ('orjson', 'ujson'):
+            serializer = SERIALIZERS[candidate]()
+            if serializer is not None:
+                APP.logger.info('Using %s to serialize api responses.', candidate)
+                return serializer
+        return _stdlib_serializer()
+
+    if name not in SERIALIZERS:
+        raise KeyError('Unknown JSON serializer: {}'.format(name))
+    serializer = SERIALIZERS[name]()
+    if serializer is None:
+        APP.logger.warning('The JSON serializer %s is not installed, using json instead.', name)
+        return _stdlib_serializer()
+    return serializer
+
+
+SERIALIZE = get_serializer(APP.config.get('JSON_SERIALIZER', 'auto'))
+
+
+def output_json(data, code, headers=None):
+    """
+    Makes a Flask response with a JSON encoded body
+    """
+    response = make_response(SERIALIZE(data) + b'\n', code)
+    response.headers.extend(headers or {})
+    return response
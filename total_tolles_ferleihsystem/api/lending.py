@@ -7,11 +7,13 @@ from flask import request
 from flask_restplus import Resource, abort, marshal
 from flask_jwt_extended import jwt_required
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.exc import StaleDataError
 
 from . import API, satisfies_role
-from .. import DB
+from .. import APP, DB, LENDING_LOGGER
 
+from .pagination import paginate
+from .load_plans import load_plan
 from .models import LENDING_GET, LENDING_POST, LENDING_PUT, ID_LIST
 from ..login import UserRole
 from ..db_models.item import Lending, Item
@@ -19,6 +21,37 @@ from ..db_models.item import Lending, Item
 PATH: str = '/lending'
 ANS = API.namespace('lending', description='Lendings', path=PATH)
 
+
+def commit_with_retries(action):
+    """
+    Run the action and commit the session.
+
+    If one of the items was changed concurrently (version mismatch) the transaction is rolled back and the
+    action is run again with fresh data, at most LENDING_RETRIES times. Aborts with 409 afterwards.
+    """
+    retries = APP.config.get('LENDING_RETRIES', 3)
+    for attempt in range(retries + 1):
+        try:
+            result = action()
+            DB.session.commit()
+            return result
+        except StaleDataError:
+            DB.session.rollback()
+            LENDING_LOGGER.info('Items were changed concurrently (attempt %d of %d).', attempt + 1, retries + 1)
+    abort(409, 'The items were changed concurrently, please try again!')
+
+
+def requested_item_ids():
+    """
+    The item ids of a ID_LIST request body. Aborts with 400 if the body is malformed.
+    """
+    data = request.get_json(silent=True)
+    ids = data.get('ids') if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not all(isinstance(item_id, int) and not isinstance(item_id, bool)
+                                            for item_id in ids):
+        abort(400, 'Expected a list of item ids!')
+    return ids
+
 @ANS.route('/')
 class LendingList(Resource):
     """
@@ -26,14 +59,16 @@ class LendingList(Resource):
     """
 
     @jwt_required
+    @API.param('limit', 'the maximum number of lendings per page', type=int, required=False)
+    @API.param('cursor', 'the cursor of the page to get (taken from the next link)', type=str, required=False)
     @API.marshal_list_with(LENDING_GET)
     # pylint: disable=R0201
     def get(self):
         """
         Get a list of all lendings currently in the system
         """
-
-        return Lending.query.options(joinedload('_items')).all()
+        base_query = Lending.query.options(*load_plan(LENDING_GET))
+        return paginate(base_query, (Lending.date, Lending.id), request.args.get('limit', default=None, type=int))
 
     @jwt_required
     @satisfies_role(UserRole.MODERATOR)
@@ -42,19 +77,21 @@ class LendingList(Resource):
     @ANS.response(400, "Item not found")
     @ANS.response(400, "Item not lendable")
     @ANS.response(400, "Item already lent")
+    @ANS.response(409, "Items were changed concurrently")
     # pylint: disable=R0201
     def post(self):
         """
         Add a new lending to the system
         """
-        try:
-            new = Lending(** request.get_json())
-        except ValueError as err:
-            abort(400, str(err))
-        
-        DB.session.add(new)
-        DB.session.commit()
-        return marshal(new, LENDING_GET), 201
+        def lend():
+            try:
+                new = Lending(** request.get_json())
+            except ValueError as err:
+                abort(400, str(err))
+            DB.session.add(new)
+            return new
+
+        return marshal(commit_with_retries(lend), LENDING_GET), 201
 
 @ANS.route('/<int:lending_id>/')
 class LendingDetail(Resource):
@@ -71,7 +108,7 @@ class LendingDetail(Resource):
         """
         Get a single lending object
         """
-        lending = Lending.query.filter(Lending.id == lending_id).options(joinedload('_items')).first()
+        lending = Lending.query.filter(Lending.id == lending_id).options(*load_plan(LENDING_GET)).first()
         if lending is None:
             abort(404, 'Requested lending not found!')
         return lending
@@ -80,17 +117,20 @@ class LendingDetail(Resource):
     @satisfies_role(UserRole.MODERATOR)
     @ANS.response(404, 'Requested lending not found!')
     @ANS.response(204, 'Success.')
+    @ANS.response(409, "Items were changed concurrently")
     # pylint: disable=R0201
     def delete(self, lending_id):
         """
         Delete a lending object
         """
-        lending = Lending.query.filter(Lending.id == lending_id).first()
-        if lending is None:
-            abort(404, 'Requested lending not found!')
-        lending.pre_delete()
-        DB.session.delete(lending)
-        DB.session.commit()
+        def delete():
+            lending = Lending.query.filter(Lending.id == lending_id).first()
+            if lending is None:
+                abort(404, 'Requested lending not found!')
+            lending.pre_delete()
+            DB.session.delete(lending)
+
+        commit_with_retries(delete)
         return "", 204
 
     @jwt_required
@@ -100,44 +140,130 @@ class LendingDetail(Resource):
     @ANS.response(400, "Item not found")
     @ANS.response(400, "Item not lendable")
     @ANS.response(400, "Item already lent")
+    @ANS.response(409, "Items were changed concurrently")
     # pylint: disable=R0201
     def put(self, lending_id):
         """
         Replace a lending object
         """
-        lending = Lending.query.filter(Lending.id == lending_id).options(joinedload('_items')).first()
-        if lending is None:
-            abort(404, 'Requested lending not found!')
-        try:
-            lending.update(**request.get_json())
-        except ValueError as err:
-            abort(400, str(err))
+        def update():
+            lending = Lending.query.filter(Lending.id == lending_id).options(*load_plan(LENDING_GET)).first()
+            if lending is None:
+                abort(404, 'Requested lending not found!')
+            try:
+                lending.update(**request.get_json())
+            except ValueError as err:
+                abort(400, str(err))
+            return lending
 
-        DB.session.commit()
-        return marshal(lending, LENDING_GET), 200
+        return marshal(commit_with_retries(update), LENDING_GET), 200
 
     @jwt_required
     @satisfies_role(UserRole.MODERATOR)
     @ANS.doc(body=ID_LIST)
     @ANS.response(404, 'Requested lending not found!')
+    @ANS.response(400, 'Expected a list of item ids!')
     @ANS.response(400, "Item not found")
     @ANS.response(201, "Lending would be empty. Was deleted.")
+    @ANS.response(409, "Items were changed concurrently")
     # pylint: disable=R0201
     def post(self, lending_id):
         """
         Give back a list of items.
         """
-        lending = Lending.query.filter(Lending.id == lending_id).options(joinedload('_items')).first()
+        item_ids = requested_item_ids()
+
+        def give_back():
+            lending = Lending.query.filter(Lending.id == lending_id).options(*load_plan(LENDING_GET)).first()
+            if lending is None:
+                abort(404, 'Requested lending not found!')
+            try:
+                lending.remove_items(item_ids)
+            except ValueError as err:
+                abort(400, str(err))
+            if len(lending._items) <= 0:
+                lending.pre_delete()
+                DB.session.delete(lending)
+                return None
+            return lending
+
+        lending = commit_with_retries(give_back)
         if lending is None:
-            abort(404, 'Requested lending not found!')
-        try:
-            lending.remove_items(request.get_json()["ids"])
-        except ValueError as err:
-            abort(400, str(err))
-        DB.session.commit()
-        if len(lending._items) <= 0: 
-            lending.pre_delete()
-            DB.session.delete(lending)
-            DB.session.commit()
             return None, 201
         return marshal(lending, LENDING_GET)
+
+
+@ANS.route('/bulk/')
+class LendingBulk(Resource):
+    """
+    Create many lendings at once
+    """
+
+    @jwt_required
+    @satisfies_role(UserRole.MODERATOR)
+    @ANS.doc(model=[LENDING_GET], body=[LENDING_POST])
+    @ANS.response(201, 'Created.')
+    @ANS.response(400, "Item not found")
+    @ANS.response(400, "Item not lendable")
+    @ANS.response(400, "Item already lent")
+    @ANS.response(409, "Items were changed concurrently")
+    # pylint: disable=R0201
+    def post(self):
+        """
+        Add a list of new lendings to the system
+        """
+        data = request.get_json()
+        if not isinstance(data, list):
+            abort(400, 'Expected a list of lendings!')
+
+        def lend():
+            try:
+                new = Lending.create_many(data)
+            except (KeyError, TypeError):
+                abort(400, 'Every lending needs moderator, user, deposit and item_ids!')
+            except ValueError as err:
+                abort(400, str(err))
+            DB.session.add_all(new)
+            return new
+
+        return marshal(commit_with_retries(lend), LENDING_GET), 201
+
+
+@ANS.route('/return/')
+class LendingReturn(Resource):
+    """
+    Give back items of many lendings at once
+    """
+
+    @jwt_required
+    @satisfies_role(UserRole.MODERATOR)
+    @ANS.doc(model=[LENDING_GET], body=ID_LIST)
+    @ANS.response(200, 'The remaining items of the affected lendings. Empty lendings are deleted.')
+    @ANS.response(400, 'Expected a list of item ids!')
+    @ANS.response(400, "Item not found")
+    @ANS.response(400, "Item not lent")
+    @ANS.response(409, "Items were changed concurrently")
+    # pylint: disable=R0201
+    def post(self):
+        """
+        Give back a list of items (from any lending).
+        """
+        item_ids = requested_item_ids()
+
+        def give_back():
+            try:
+                lending_ids = Lending.return_items(item_ids)
+            except ValueError as err:
+                abort(400, str(err))
+
+            lendings = Lending.query.filter(Lending.id.in_(lending_ids)).options(*load_plan(LENDING_GET)).all()
+            remaining = []
+            for lending in lendings:
+                if lending._items:
+                    remaining.append(lending)
+                else:
+                    lending.pre_delete()
+                    DB.session.delete(lending)
+            return remaining
+
+        return marshal(commit_with_retries(give_back), LENDING_GET), 200
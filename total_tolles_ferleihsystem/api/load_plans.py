@@ -0,0 +1,48 @@
+"""
+Module containing the load plans of the api models.
+
+A load plan lists the relationships a api model reads while marshalling, together with the loader strategy
+used to load them. Endpoints apply the plan of the model they marshal with, so marshalling never triggers
+lazy loads for single objects (N+1 queries).
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+from flask_restplus import Model
+from sqlalchemy import orm
+
+from .models import ITEM_GET, FILE_GET, LENDING_GET
+
+# (loader strategy, relationship name, api model of the related objects)
+LoadStep = Tuple[str, str, Optional[Model]]
+
+LOAD_PLANS: Dict[str, List[LoadStep]] = {}
+
+
+def register_load_plan(api_model: Model, *steps: LoadStep) -> None:
+    """
+    Register the relationships read when marshalling with the given api model.
+    """
+    LOAD_PLANS[api_model.name] = list(steps)
+
+
+def load_plan(api_model: Model, parent=None) -> list:
+    """
+    The loader options for a query whose results are marshalled with the given api model.
+
+    If a parent loader option is given the options are chained to it (for objects nested in other objects).
+    """
+    options = []
+    for strategy, relationship, nested_model in LOAD_PLANS.get(api_model.name, []):
+        option = getattr(orm if parent is None else parent, strategy)(relationship)
+        nested = load_plan(nested_model, option) if nested_model is not None else []
+        options.extend(nested if nested else [option])
+    if not options and parent is not None:
+        options.append(parent)
+    return options
+
+
+# is_currently_lent and lending_id only need the lending_id column, the tag lending duration is a column property
+register_load_plan(ITEM_GET, ('joinedload', 'type', None))
+register_load_plan(FILE_GET, ('joinedload', 'item', ITEM_GET))
+register_load_plan(LENDING_GET, ('selectinload', '_items', ITEM_GET))
@@ -171,6 +171,10 @@ ATTRIBUTE_DEFINITION_VALUES = API.schema_model('AttributeDefinitionVALUE', {
         "type": "string",
     }
 })
+ATTRIBUTE_DEFINITION_VALUE_COUNT = API.model('AttributeDefinitionValueCount', {
+    'value': fields.String(readonly=True, description='The value as json'),
+    'count': fields.Integer(readonly=True, title='Number of items with this value'),
+})
 
 
 #
@@ -252,6 +256,46 @@ FILE_GET = API.inherit('FileGET', FILE_BASIC, ID, {
 })
 
 
+#
+# --- Tasks ---
+#
+
+TASK_STATUS = API.model('TaskStatus', {
+    'id': fields.String(readonly=True),
+    'state': fields.String(readonly=True, example='PROGRESS'),
+    'current': fields.Integer(readonly=True, title='Processed elements'),
+    'total': fields.Integer(readonly=True, title='Total elements'),
+    'result': fields.Raw(readonly=True, title='Result of a successful task'),
+    'error': fields.String(readonly=True, title='Error of a failed task'),
+})
+
+
+#
+# --- Debug ---
+#
+
+PERFORMANCE_QUERY = API.model('PerformanceQuery', {
+    'duration': fields.Float(readonly=True, title='Longest duration in seconds'),
+    'statement': fields.String(readonly=True, title='Normalized sql statement'),
+})
+
+ENDPOINT_PERFORMANCE = API.model('EndpointPerformance', {
+    'endpoint': fields.String(readonly=True, example='api.item_item_list'),
+    'method': fields.String(readonly=True, example='GET'),
+    'count': fields.Integer(readonly=True, title='Number of recorded requests'),
+    'errors': fields.Integer(readonly=True, title='Number of requests answered with 5xx'),
+    'duration_sum': fields.Float(readonly=True),
+    'duration_max': fields.Float(readonly=True),
+    'p50': fields.Float(readonly=True),
+    'p95': fields.Float(readonly=True),
+    'p99': fields.Float(readonly=True),
+    'queries_mean': fields.Float(readonly=True),
+    'writes_mean': fields.Float(readonly=True),
+    'slowest_queries': fields.List(fields.Nested(PERFORMANCE_QUERY), readonly=True),
+    'profiles': fields.List(fields.String, readonly=True, title='Recent profiles (folded stacks) of this endpoint'),
+})
+
+
 #
 # --- Lending ---
 #
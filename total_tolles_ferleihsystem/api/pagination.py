@@ -0,0 +1,76 @@
+"""
+Module containing the keyset (cursor) pagination used by the list endpoints.
+"""
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as Base64Error
+from json import dumps, loads
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from flask import request, url_for
+from flask_restplus import abort
+from sqlalchemy import and_, or_
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    """
+    Encode the sort values of the last returned row as opaque cursor.
+    """
+    return urlsafe_b64encode(dumps(list(values), separators=(',', ':')).encode()).decode()
+
+
+def decode_cursor(cursor: str, length: int) -> List[Any]:
+    """
+    Decode a cursor created by encode_cursor. Aborts with 400 for invalid cursors.
+    """
+    try:
+        values = loads(urlsafe_b64decode(cursor.encode()).decode())
+    except (Base64Error, UnicodeDecodeError, ValueError):
+        abort(400, 'Invalid cursor!')
+    if not isinstance(values, list) or len(values) != length:
+        abort(400, 'Invalid cursor!')
+    return values
+
+
+def after_cursor(columns: Sequence, values: Sequence[Any]):
+    """
+    The condition selecting all rows after the given sort values.
+
+    NULL values are sorted first (as in SQLite and MySQL).
+    """
+    conditions = []
+    for index, (column, value) in enumerate(zip(columns, values)):
+        # pylint: disable=C0121
+        greater = column != None if value is None else column > value
+        conditions.append(and_(*[col == val for col, val in zip(columns[:index], values[:index])], greater))
+    return or_(*conditions)
+
+
+def paginate(query, columns: Sequence, limit: Optional[int] = None) -> Tuple[list, int, Dict[str, str]]:
+    """
+    Order the query by the given (unique) columns and return the requested page.
+
+    The cursor is taken from the 'cursor' request argument. If a limit is given and more rows exist,
+    a link to the next page is added as 'Link' header.
+    """
+    if limit is not None and limit < 1:
+        abort(400, 'The limit has to be positive!')
+
+    cursor = request.args.get('cursor', default=None, type=str)
+    if cursor:
+        query = query.filter(after_cursor(columns, decode_cursor(cursor, len(columns))))
+    query = query.order_by(*columns)
+
+    if limit is None:
+        return query.all(), 200, {}
+
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, 200, {}
+
+    rows = rows[:limit]
+    next_cursor = encode_cursor(getattr(rows[-1], column.key) for column in columns)
+    args = request.args.to_dict(flat=False)
+    args['cursor'] = [next_cursor]
+    args.update(request.view_args)
+    return rows, 200, {'Link': '<{}>; rel="next"'.format(url_for(request.endpoint, **args))}
@@ -2,20 +2,74 @@
 This is the module containing the search endpoint.
 """
 
+import operator
+from json import dumps
+from typing import Optional
+
 from flask import request
-from flask_restplus import Resource
-from flask_jwt_extended import jwt_optional, get_jwt_claims
-from sqlalchemy.orm import joinedload
-from . import API
+from flask_restplus import Resource, abort
+from sqlalchemy.sql import select
+from flask_jwt_extended import jwt_optional
+from . import API, restrict_visibility
+from .caching import cached_response, conditional_get
+from .. import DB
+from ..db_models.attributeDefinition import AttributeDefinition
 from ..db_models.item import Item, ItemToTag, ItemToAttributeDefinition
 from ..db_models.itemType import ItemType
-from ..db_models.tag import Tag
+from ..db_models.searchIndex import SearchTerm, tokenize
+from ..db_models.typedAttributeValues import parse_typed_value, typed_column
+from .pagination import paginate
+from .search_planner import IdFilter, plan_item_ids
+from .load_plans import load_plan
 from .models import ITEM_GET
-from ..login import UserRole
 
 PATH: str = '/search'
 ANS = API.namespace('search', description='The search resource', path=PATH)
 
+
+COMPARISONS = (
+    ('>=', operator.ge),
+    ('<=', operator.le),
+    ('>', operator.gt),
+    ('<', operator.lt),
+)
+
+
+def attribute_condition(definition: Optional[AttributeDefinition], search_value: str):
+    """
+    The condition on the item attribute for a attrib search value (e.g. '>= 5' or 'red').
+
+    Numbers, booleans and dates are compared in their typed column, other values as (json) strings.
+    Aborts with 400 if the value does not fit the type of the attribute definition.
+    """
+    compare, operand = operator.eq, search_value
+    for prefix, comparison in COMPARISONS:
+        if search_value.startswith(prefix):
+            compare, operand = comparison, search_value[len(prefix):].strip()
+            break
+
+    column = typed_column(definition.type, definition.jsonschema) if definition is not None else None
+    if column == 'value_int' and compare is not operator.eq:
+        # range bounds of integers need not be integers (e.g. '>= 2.5')
+        column = 'value_num'
+    if column is not None:
+        try:
+            return compare(getattr(ItemToAttributeDefinition, column), parse_typed_value(column, operand))
+        except ValueError as err:
+            abort(400, 'The attrib value does not fit the attribute type: {}'.format(err))
+    if compare is operator.eq:
+        # string values are stored with quotes
+        return ItemToAttributeDefinition.value.in_([operand, dumps(operand, ensure_ascii=False)])
+    return compare(ItemToAttributeDefinition.value, operand)
+
+
+def escape_like(value: str) -> str:
+    """
+    Escape all wildcard characters of a LIKE pattern.
+    """
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
 @ANS.route('/')
 class Search(Resource):
     """
@@ -23,8 +77,13 @@ class Search(Resource):
     """
     @API.doc(security=None)
     @jwt_optional
-    @API.param('search', 'the string to search for', type=str, required=False, default='')
+    @conditional_get
+    @cached_response
+    @API.param('search', 'the words to search for, every word has to match the start of a word in the name, a ' +
+               'tag or a attribute of the item (e.g. "cab" finds "Cable", "able" does not)', type=str,
+               required=False, default='')
     @API.param('limit', 'limit the amount of return values', type=int, required=False, default=1000)
+    @API.param('cursor', 'the cursor of the page to get (taken from the next link)', type=str, required=False)
     @API.param('tag', 'Only show items with a tag of the given tag id', type=int, required=False, default='')
     @API.param('attrib', 'Filter the results on specific attributes with a search string in the format: &lt;' +
                'attribute-id&gt;-&lt;search-string&gt;', type=str, required=False, default='')
@@ -37,6 +96,9 @@ class Search(Resource):
     def get(self):
         """
         The actual search endpoint definition
+
+        The search words are matched as prefixes of the indexed words, a word in the middle of a name (substring
+        match) is not found.
         """
         search = request.args.get('search', default='', type=str)
         limit = request.args.get('limit', default=1000, type=int)
@@ -47,42 +109,50 @@ class Search(Resource):
         lent = request.args.get('lent', default=False, type=lambda x: x == 'true')
         lendable = request.args.get('lendable', default=False, type=lambda x: x == 'true')
 
-        def generate_keyword_search_condition(search_string_param, search_condition_param = None):
-            search_string_param = search_string_param.strip()
-
-            if search_condition_param is None:
-                search_condition_param = Item.name.like('%' + search_string_param + '%');
-            else:
-                search_condition_param = search_condition_param | Item.name.like('%' + search_string_param + '%');
-
-            if not tags:
-                search_condition_param = search_condition_param | Tag.name.like('%' + search_string_param + '%')
-
-            search_condition_param = search_condition_param | ItemToAttributeDefinition.value.like('%' + search_string_param.strip() + '%')
-
+        try:
+            attribute_ids = [int(attribute.split('-', 1)[0]) for attribute in attributes if '-' in attribute]
+        except ValueError:
+            abort(400, 'The attrib parameter has to be of the format <attribute-id>-<search-string>!')
+        if len(attribute_ids) != len(attributes):
+            abort(400, 'The attrib parameter has to be of the format <attribute-id>-<search-string>!')
+
+        def generate_keyword_search_condition(search_string_param):
+            """
+            All tokens of the search string have to match a indexed term of the item (as prefix).
+            """
+            search_condition_param = None
+            for token in tokenize(search_string_param):
+                term_query = DB.session.query(SearchTerm.item_id).filter(SearchTerm.term.like(escape_like(token) + '%',
+                                                                                              escape='\\'))
+                if tags:
+                    # pylint: disable=C0121
+                    term_query = term_query.filter(SearchTerm.tag_id == None)
+                if attribute_ids:
+                    # pylint: disable=C0121
+                    term_query = term_query.filter((SearchTerm.attribute_definition_id == None) |
+                                                   ~SearchTerm.attribute_definition_id.in_(attribute_ids))
+                token_condition = Item.id.in_(term_query)
+                if search_condition_param is None:
+                    search_condition_param = token_condition
+                else:
+                    search_condition_param = search_condition_param & token_condition
             return search_condition_param
 
-        search_result = Item.query.options(joinedload('lending'), joinedload("_tags"))
+        search_result = Item.query.options(*load_plan(ITEM_GET))
 
         # auth check
-        if UserRole(get_jwt_claims()) != UserRole.ADMIN:
-            if UserRole(get_jwt_claims()) == UserRole.MODERATOR:
-                search_result = search_result.filter((Item.visible_for == 'all') | (Item.visible_for == 'moderator'))
-            else:
-                search_result = search_result.filter(Item.visible_for == 'all')
+        search_result = restrict_visibility(search_result, Item)
 
         if search:
-            search_array = search.split('|') #TODO make character configurable
+            search_conditions = [generate_keyword_search_condition(search_string)
+                                 for search_string in search.split('|')] #TODO make character configurable
 
-            if not tags:
-                search_result = search_result.join(ItemToTag, isouter=True).join(Tag, isouter=True)
-            search_result = search_result.join(ItemToAttributeDefinition, isouter=True).filter(~ItemToAttributeDefinition.attribute_definition_id.in_([attribute.split('-', 1)[0] for attribute in attributes]))
-
-            search_condition = generate_keyword_search_condition(search_array[0])
-            for search_string in search_array[1:]:
-                search_condition = generate_keyword_search_condition(search_string, search_condition)
-
-            search_result = search_result.filter(search_condition)
+            # a search string without any token matches everything
+            if all(condition is not None for condition in search_conditions):
+                search_condition = search_conditions[0]
+                for condition in search_conditions[1:]:
+                    search_condition = search_condition | condition
+                search_result = search_result.filter(search_condition)
 
         if not deleted:
             search_result = search_result.filter(Item.deleted_time == None)
@@ -97,26 +167,24 @@ class Search(Resource):
         if item_type != -1:
             search_result = search_result.filter(Item.type_id == item_type)
 
+        # tags and attributes are filtered by item id subqueries, see search_planner.py
+        filters = []
         if tags:
-            search_result = search_result.join(ItemToTag)
-            search_result = search_result.filter(ItemToTag.tag_id.in_(tags))
+            filters.append(IdFilter(ItemToTag.item_id,
+                                    select([ItemToTag.item_id]).where(ItemToTag.tag_id.in_(tags))))
 
         if attributes:
-            for attribute in attributes:
-                search_result = search_result.join(ItemToAttributeDefinition, aliased=True)
-                search_result = search_result.filter(ItemToAttributeDefinition.attribute_definition_id ==
-                                                     attribute.split('-', 1)[0])
-
+            definitions = {definition.id: definition for definition
+                           in AttributeDefinition.query.filter(AttributeDefinition.id.in_(attribute_ids))}
+            for definition_id, attribute in zip(attribute_ids, attributes):
                 search_value = attribute.split('-', 1)[1].strip()
-                if search_value[:2] == '>=':
-                    search_result = search_result.filter(ItemToAttributeDefinition.value >= search_value[2:].strip())
-                elif search_value[:2] == '<=':
-                    search_result = search_result.filter(ItemToAttributeDefinition.value <= search_value[2:].strip())
-                elif search_value[:1] == '>':
-                    search_result = search_result.filter(ItemToAttributeDefinition.value > search_value[1:].strip())
-                elif search_value[:1] == '<':
-                    search_result = search_result.filter(ItemToAttributeDefinition.value < search_value[1:].strip())
-                else:
-                    search_result = search_result.filter(ItemToAttributeDefinition.value == search_value)
+                filters.append(IdFilter(ItemToAttributeDefinition.item_id,
+                                        select([ItemToAttributeDefinition.item_id])
+                                        .where(ItemToAttributeDefinition.attribute_definition_id == definition_id)
+                                        .where(attribute_condition(definitions.get(definition_id), search_value))))
+
+        item_ids = plan_item_ids(filters)
+        if item_ids is not None:
+            search_result = search_result.filter(Item.id.in_(item_ids))
 
-        return search_result.order_by(Item.name).limit(limit).all()
+        return paginate(search_result, (Item.name, Item.id), limit)
@@ -0,0 +1,65 @@
+"""
+Module containing the planner of the search filters.
+
+Every filter (tags, a single attribute) is evaluated as a independent subquery of item ids. The planner estimates
+the number of ids of every subquery and intersects them starting with the most selective one. Only the
+intersected ids are joined to the items for ordering, pagination and loading, instead of joining the items with a
+copy of the attribute table per filter.
+"""
+
+from typing import List, NamedTuple, Optional
+
+from sqlalchemy.sql import ColumnElement, func, intersect, select
+from sqlalchemy.sql.expression import Select
+
+from .. import APP, DB
+
+# the estimates only have to order the filters, counting more ids than this does not change the order much
+ESTIMATE_LIMIT = 10000
+
+# the other databases (e.g. MySQL before 8.0.31) get nested IN subqueries instead of INTERSECT
+INTERSECT_DIALECTS = {'sqlite', 'postgresql', 'mssql', 'oracle'}
+
+
+class IdFilter(NamedTuple):
+    """
+    A select of item ids (the selected item id column is needed to chain the filters).
+    """
+    column: ColumnElement
+    ids: Select
+
+
+def estimate_ids(id_filter: IdFilter, limit: int = ESTIMATE_LIMIT) -> int:
+    """
+    The number of item ids of the filter, counted up to the limit.
+    """
+    limited = id_filter.ids.limit(limit).alias()
+    return DB.session.execute(select([func.count()]).select_from(limited)).scalar()
+
+
+def plan_item_ids(filters: List[IdFilter]) -> Optional[Select]:
+    """
+    A select of the item ids matching all filters (None without filters).
+
+    The filters are ordered by their estimated number of ids, the most selective one comes first. If a filter
+    matches no item, only that filter is returned.
+    """
+    if not filters:
+        return None
+    if len(filters) == 1:
+        return filters[0].ids
+
+    estimates = sorted(((estimate_ids(id_filter), index) for index, id_filter in enumerate(filters)))
+    APP.logger.debug('Search filter estimates: %s', estimates)
+    ordered = [filters[index] for _, index in estimates]
+    if estimates[0][0] == 0:
+        return ordered[0].ids
+
+    if DB.engine.dialect.name in INTERSECT_DIALECTS:
+        return intersect(*(id_filter.ids for id_filter in ordered))
+
+    ids = ordered[0].ids
+    for id_filter in ordered[1:]:
+        # the filters may select from the same table, so the nested select must not be correlated
+        ids = id_filter.ids.where(id_filter.column.in_(ids.correlate(None)))
+    return ids
@@ -1,13 +1,31 @@
-from flask import request
+from flask import request, url_for
 from flask_restplus import Resource, abort, marshal
 from flask_jwt_extended import jwt_required
 
 from . import API, satisfies_role
+from .models import TASK_STATUS
+from ..login import UserRole
 from total_tolles_ferleihsystem.tasks.sample_task import sample
 
 PATH: str = '/tasks'
 ANS = API.namespace('tasks', description='Tasks', path=PATH)
 
+
+def async_requested() -> bool:
+    """
+    If the client asked to run the request as a background task (?async=true).
+    """
+    return request.args.get('async', '').lower() in ('true', '1', 'yes')
+
+
+def enqueue(task, *args):
+    """
+    Start the task in the background and answer with 202 and the location of the task status.
+    """
+    result = task.delay(*args)
+    status = {'id': result.id, 'state': result.state}
+    return marshal(status, TASK_STATUS), 202, {'Location': url_for('api.tasks_task_detail', task_id=result.id)}
+
 @ANS.route('/')
 class Taks(Resource):
 
@@ -26,3 +44,29 @@ class TestTaks(Resource):
     def get(self):
         sample.delay(1, 2)
         return 'task run'
+
+
+@ANS.route('/<string:task_id>/')
+class TaskDetail(Resource):
+    """
+    Status of a single background task
+    """
+
+    @jwt_required
+    @satisfies_role(UserRole.ADMIN)
+    @ANS.marshal_with(TASK_STATUS)
+    def get(self, task_id):
+        """
+        Get the state and progress or the result of a task
+        """
+        from .. import celery
+        result = celery.AsyncResult(task_id)
+        info = result.info if isinstance(result.info, dict) else {}
+        return {
+            'id': task_id,
+            'state': result.state,
+            'current': info.get('current'),
+            'total': info.get('total'),
+            'result': result.result if result.successful() else None,
+            'error': str(result.result) if result.failed() else None,
+        }
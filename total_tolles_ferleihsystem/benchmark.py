@@ -0,0 +1,342 @@
+"""
+This module contains a benchmark of the api hot paths on a synthetic catalog.
+
+The catalog generator fills all tables of the db_models with reproducible (seeded) data of a given scale.
+The benchmark drops all tables first, so it only runs in the TEST mode.
+"""
+
+import json
+import tracemalloc
+from random import Random
+from time import perf_counter, time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+import click
+from flask_jwt_extended import create_access_token
+
+from . import APP, DB
+from .login import User, UserRole
+from .performance import quantile
+from .query_counts import count_queries
+from .api import caching
+from .db_models.attributeDefinition import AttributeDefinition
+from .db_models.item import Item, File, Lending, ItemToItem, ItemToTag, ItemToAttributeDefinition
+from .db_models.itemType import ItemType, ItemTypeToItemType, ItemTypeToAttributeDefinition
+from .db_models.tag import Tag, TagToAttributeDefinition
+from .db_models.searchIndex import rebuild_search_index
+from .db_models.typedAttributeValues import retype_attribute_values
+from .db_models.visibility import visibility_level
+
+INSERT_CHUNK_SIZE = 5000
+
+ITEM_TYPE_COUNT = 20
+TAG_COUNT = 50
+TAGS_PER_ITEM = 2
+ATTRIBUTES_PER_TYPE = 3
+# every block of items forms a hierarchy: one box containing shelves which contain the other items
+HIERARCHY_BLOCK_SIZE = 100
+SHELVES_PER_BLOCK = 10
+ITEMS_PER_LENDING = 5
+LENT_ITEMS_FRACTION = 0.05
+ITEMS_PER_FILE = 20
+
+NOUNS = ('cable', 'adapter', 'projector', 'speaker', 'microphone', 'camera', 'tripod', 'laptop', 'monitor', 'lamp')
+COLORS = ('red', 'green', 'blue', 'black', 'white', 'yellow')
+
+ATTRIBUTE_DEFINITIONS = (
+    ('color', 'string', {'enum': list(COLORS)}),
+    ('length', 'number', {'minimum': 0}),
+    ('inventory number', 'integer', {'minimum': 0}),
+    ('manufacturer', 'string', {}),
+    ('broken', 'boolean', {}),
+    ('purchase date', 'string', {'format': 'date'}),
+)
+
+
+class Catalog(NamedTuple):
+    """
+    The ids of the generated catalog used by the benchmark scenarios.
+    """
+    item_ids: List[int]
+    tag_ids: List[int]
+    attribute_definition_ids: Dict[str, int]
+    container_id: int
+    free_item_ids: List[int]
+
+
+class Scenario(NamedTuple):
+    """
+    A benchmarked request, body may create a new json body for every run.
+    """
+    name: str
+    method: str
+    url: str
+    body: Optional[Callable[[], Any]] = None
+
+
+def _insert(model, rows: List[Dict[str, Any]]) -> None:
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+        DB.session.execute(model.__table__.insert(), rows[start:start + INSERT_CHUNK_SIZE])
+
+
+def _visible_for(index: int) -> Dict[str, Any]:
+    visible_for = 'moderator' if index % 10 == 0 else 'all'
+    return {'visible_for': visible_for, 'visibility_level': visibility_level(visible_for)}
+
+
+def _attribute_value(name: str, rand: Random) -> str:
+    if name == 'color':
+        return json.dumps(rand.choice(COLORS))
+    if name == 'length':
+        return json.dumps(round(rand.uniform(0.5, 50), 1))
+    if name == 'inventory number':
+        return json.dumps(rand.randrange(100000))
+    if name == 'manufacturer':
+        return json.dumps('manufacturer {}'.format(rand.randrange(50)))
+    if name == 'broken':
+        return json.dumps(rand.random() < 0.1)
+    return json.dumps('20{:02d}-{:02d}-01'.format(rand.randrange(10, 20), rand.randrange(1, 13)))
+
+
+def generate_catalog(item_count: int, seed: int = 0) -> Catalog:
+    """
+    Fill the (empty) database with a synthetic catalog of item_count items and commit it.
+
+    Generates item types, tags, attribute definitions with values, nested item hierarchies, lendings and files.
+    The rows are inserted with bulk statements, so the search index and the typed values are rebuilt at the end.
+    """
+    rand = Random(seed)
+    now = int(time())
+
+    definitions = [{'id': index + 1, 'name': name, 'type': type_, 'jsonschema': json.dumps(schema),
+                    'visible_for': 'all', 'visibility_level': visibility_level('all')}
+                   for index, (name, type_, schema) in enumerate(ATTRIBUTE_DEFINITIONS)]
+    _insert(AttributeDefinition, definitions)
+    definition_names = {definition['id']: definition['name'] for definition in definitions}
+
+    # the first item type is the box type containing all other types
+    item_types = [{'id': 1, 'name': 'box', 'name_schema': 'box', 'lendable': False, 'lending_duration': 0,
+                   'how_to': '', **_visible_for(1)}]
+    item_types += [{'id': index, 'name': '{} {}'.format(NOUNS[index % len(NOUNS)], index),
+                    'name_schema': '$type $color', 'lendable': True, 'lending_duration': 7 * 24 * 3600,
+                    'how_to': '', **_visible_for(index)}
+                   for index in range(2, ITEM_TYPE_COUNT + 1)]
+    _insert(ItemType, item_types)
+    _insert(ItemTypeToItemType, [{'parent_id': 1, 'item_type_id': item_type['id']} for item_type in item_types])
+    type_definitions = {item_type['id']: rand.sample(sorted(definition_names), ATTRIBUTES_PER_TYPE)
+                        for item_type in item_types}
+    _insert(ItemTypeToAttributeDefinition, [{'item_type_id': type_id, 'attribute_definition_id': definition_id}
+                                            for type_id, definition_ids in type_definitions.items()
+                                            for definition_id in definition_ids])
+
+    tags = [{'id': index, 'name': 'tag {}'.format(index), 'lending_duration': 3 * 24 * 3600, **_visible_for(index)}
+            for index in range(1, TAG_COUNT + 1)]
+    _insert(Tag, tags)
+    tag_definitions = {tag['id']: [rand.choice(sorted(definition_names))] for tag in tags if tag['id'] % 5 == 0}
+    _insert(TagToAttributeDefinition, [{'tag_id': tag_id, 'attribute_definition_id': definition_ids[0]}
+                                       for tag_id, definition_ids in tag_definitions.items()])
+
+    items = []
+    item_to_item = []
+    for index in range(1, item_count + 1):
+        position = (index - 1) % HIERARCHY_BLOCK_SIZE
+        block_start = index - position
+        if position == 0:
+            type_id = 1
+        else:
+            type_id = rand.randrange(2, ITEM_TYPE_COUNT + 1)
+            # shelves are in the box, all other items on one of the shelves of the block
+            parent = block_start if position <= SHELVES_PER_BLOCK else block_start + 1 + position % SHELVES_PER_BLOCK
+            item_to_item.append({'parent_id': parent, 'item_id': index})
+        items.append({'id': index, 'name': '{} {}'.format(rand.choice(NOUNS), index),
+                      'update_name_from_schema': False, 'type_id': type_id, 'lending_duration': -1,
+                      # every row needs the same keys, executemany only inserts the columns of the first row
+                      'lending_id': None, 'due': -1, **_visible_for(index)})
+
+    item_tags = []
+    attributes = []
+    for item in items:
+        tag_ids = rand.sample(range(1, TAG_COUNT + 1), TAGS_PER_ITEM)
+        item_tags += [{'item_id': item['id'], 'tag_id': tag_id} for tag_id in tag_ids]
+        definition_ids = set(type_definitions[item['type_id']])
+        for tag_id in tag_ids:
+            definition_ids.update(tag_definitions.get(tag_id, []))
+        attributes += [{'item_id': item['id'], 'attribute_definition_id': definition_id,
+                        'value': _attribute_value(definition_names[definition_id], rand)}
+                       for definition_id in sorted(definition_ids)]
+
+    lendable_ids = [item['id'] for item in items if item['type_id'] != 1]
+    lent_ids = rand.sample(lendable_ids, int(len(lendable_ids) * LENT_ITEMS_FRACTION))
+    lendings = []
+    for number, start in enumerate(range(0, len(lent_ids), ITEMS_PER_LENDING), start=1):
+        lendings.append({'id': number, 'moderator': 'benchmark', 'user': 'user {}'.format(number),
+                         'date': now - rand.randrange(30 * 24 * 3600), 'deposit': 'Studentenausweis'})
+        for item_id in lent_ids[start:start + ITEMS_PER_LENDING]:
+            item = items[item_id - 1]
+            item['lending_id'] = number
+            item['due'] = now + rand.randrange(-7 * 24 * 3600, 14 * 24 * 3600)
+
+    files = [{'name': 'manual {}'.format(item['id']), 'file_type': '.pdf', 'file_hash': None,
+              'item_id': item['id'], 'creation': now, **_visible_for(item['id'])}
+             for item in items[::ITEMS_PER_FILE]]
+
+    _insert(Lending, lendings)
+    _insert(Item, items)
+    _insert(ItemToItem, item_to_item)
+    _insert(ItemToTag, item_tags)
+    _insert(ItemToAttributeDefinition, attributes)
+    _insert(File, files)
+    rebuild_search_index(DB.session.connection())
+    retype_attribute_values(DB.session.connection())
+    DB.session.commit()
+
+    lent = set(lent_ids)
+    return Catalog(
+        item_ids=[item['id'] for item in items],
+        tag_ids=[tag['id'] for tag in tags],
+        attribute_definition_ids={definition['name']: definition['id'] for definition in definitions},
+        container_id=1,
+        free_item_ids=[item_id for item_id in lendable_ids if item_id not in lent],
+    )
+
+
+def _scenarios(catalog: Catalog, rand: Random) -> List[Scenario]:
+    color_id = catalog.attribute_definition_ids['color']
+    length_id = catalog.attribute_definition_ids['length']
+    broken_id = catalog.attribute_definition_ids['broken']
+
+    def new_lending():
+        return {'moderator': 'benchmark', 'user': 'benchmark', 'deposit': 'Studentenausweis',
+                'item_ids': [catalog.free_item_ids.pop(rand.randrange(len(catalog.free_item_ids)))]}
+
+    return [
+        Scenario('item list', 'GET', '/catalog/items/'),
+        Scenario('item list (100)', 'GET', '/catalog/items/?limit=100'),
+        Scenario('contained items', 'GET', '/catalog/items/{}/contained/'.format(catalog.container_id)),
+        Scenario('search keyword', 'GET', '/search/?search=cable&limit=100'),
+        Scenario('search tag', 'GET', '/search/?tag={}&limit=100'.format(catalog.tag_ids[0])),
+        Scenario('search attribute', 'GET', '/search/?attrib={}-red&limit=100'.format(color_id)),
+        Scenario('search range', 'GET', '/search/?attrib={}->=25&limit=100'.format(length_id)),
+        Scenario('search faceted', 'GET', '/search/?attrib={}->=25&attrib={}-<40&attrib={}-false&tag={}&limit=100'
+                 .format(length_id, length_id, broken_id, catalog.tag_ids[1])),
+        Scenario('search combined', 'GET',
+                 '/search/?search=cable&tag={}&attrib={}-red&limit=100'.format(catalog.tag_ids[0], color_id)),
+        Scenario('lending list', 'GET', '/lending/'),
+        Scenario('attribute values', 'GET', '/catalog/attribute_definitions/{}/values/'.format(color_id)),
+        Scenario('create lending', 'POST', '/lending/', new_lending),
+    ]
+
+
+def _run(client, scenario: Scenario, headers: Dict[str, str]) -> None:
+    body = scenario.body() if scenario.body is not None else None
+    response = client.open(scenario.url, method=scenario.method, json=body, headers=headers)
+    if response.status_code >= 400:
+        raise click.ClickException('{} {} answered with {}'.format(scenario.method, scenario.url,
+                                                                    response.status_code))
+
+
+def run_scenario(client, scenario: Scenario, headers: Dict[str, str], repeat: int) -> Dict[str, float]:
+    """
+    Run the scenario repeat times and return its latency percentiles (in ms), query count and peak memory (in KiB).
+    """
+    # warm up caches (compiled statements, name schemas) first, the memory is measured in a separate run
+    # because tracemalloc slows down every allocation
+    _run(client, scenario, headers)
+    tracemalloc.start()
+    _run(client, scenario, headers)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    durations = []
+    with count_queries() as counter:
+        for _ in range(repeat):
+            start = perf_counter()
+            _run(client, scenario, headers)
+            durations.append((perf_counter() - start) * 1000)
+    durations.sort()
+    return {
+        'p50': quantile(durations, 0.5),
+        'p95': quantile(durations, 0.95),
+        'max': durations[-1],
+        'queries': counter[0] / repeat,
+        'peak_kib': peak / 1024,
+    }
+
+
+def compare_to_baseline(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+                        tolerance: float) -> List[str]:
+    """
+    The regressions of the results: slower p50/p95 (more than tolerance) or more queries than the baseline.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key in ('p50', 'p95'):
+            if result[key] > base[key] * (1 + tolerance):
+                regressions.append('{}: {} {:.1f}ms (baseline {:.1f}ms)'.format(name, key, result[key], base[key]))
+        if result['queries'] > base['queries']:
+            regressions.append('{}: {:.1f} queries (baseline {:.1f})'.format(name, result['queries'],
+                                                                            base['queries']))
+    return regressions
+
+
+@APP.cli.command('benchmark')
+@click.option('--items', default=1000, help='Number of generated items (e.g. 1000, 10000, 100000).')
+@click.option('--repeat', default=20, help='Number of measured requests per scenario.')
+@click.option('--seed', default=0, help='Seed of the catalog generator.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the results to this json file.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False),
+              help='Compare the results to a json file written by --output.')
+@click.option('--tolerance', default=0.2, help='Allowed relative slowdown compared to the baseline.')
+@click.option('--response-cache/--no-response-cache', default=False,
+              help='Measure with the response cache (only the first request of a scenario hits the database).')
+def benchmark(items: int, repeat: int, seed: int, output: str, baseline: str, tolerance: float,
+              response_cache: bool):
+    """Benchmark the api hot paths on a generated catalog."""
+    if not APP.config.get('TESTING'):
+        raise click.ClickException('The benchmark drops all tables and only runs in the TEST mode!')
+    if items < HIERARCHY_BLOCK_SIZE:
+        raise click.ClickException('--items has to be at least {}!'.format(HIERARCHY_BLOCK_SIZE))
+
+    DB.drop_all()
+    DB.create_all()
+    start = perf_counter()
+    catalog = generate_catalog(items, seed)
+    click.echo('Generated {} items in {:.1f}s.'.format(items, perf_counter() - start))
+
+    user = User('benchmark')
+    user.role = UserRole.ADMIN
+    with APP.test_request_context():
+        headers = {'Authorization': 'Bearer ' + create_access_token(user)}
+
+    if not response_cache:
+        caching.RESPONSE_CACHE = None
+
+    client = APP.test_client()
+    rand = Random(seed)
+    results = {}
+    click.echo('{:18} {:>9} {:>9} {:>9} {:>8} {:>10}'.format('scenario', 'p50 ms', 'p95 ms', 'max ms', 'queries',
+                                                            'peak KiB'))
+    for scenario in _scenarios(catalog, rand):
+        result = run_scenario(client, scenario, headers, repeat)
+        results[scenario.name] = result
+        click.echo('{:18} {p50:9.1f} {p95:9.1f} {max:9.1f} {queries:8.1f} {peak_kib:10.0f}'.format(scenario.name,
+                                                                                                  **result))
+
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump({'items': items, 'repeat': repeat, 'seed': seed, 'results': results}, output_file, indent=2)
+
+    if baseline:
+        with open(baseline) as baseline_file:
+            baseline_data = json.load(baseline_file)
+        if baseline_data.get('items') != items:
+            click.echo('The baseline was measured with {} items!'.format(baseline_data.get('items')))
+        regressions = compare_to_baseline(results, baseline_data.get('results', {}), tolerance)
+        for regression in regressions:
+            click.echo(regression)
+        if regressions:
+            raise click.ClickException('The benchmark is slower than the baseline!')
+        click.echo('No regressions compared to the baseline.')
@@ -0,0 +1,98 @@
+"""
+This module contains catalog changes which touch many items.
+
+They are used directly by the api endpoints and by the background tasks (?async=true).
+Only delete_item_type commits (once per batch), the other functions leave the commit to the caller.
+"""
+
+from typing import Callable
+
+from sqlalchemy.orm import selectinload
+from sqlalchemy.sql import select
+
+from . import DB
+from .db_models.attributeReconciliation import add_attributes, remove_orphaned_attributes
+from .db_models.item import Item, ItemToTag
+from .db_models.itemType import ItemType, ItemTypeToAttributeDefinition
+from .db_models.tag import Tag, TagToAttributeDefinition
+
+BATCH_SIZE = 500
+
+
+def delete_item_type(type_id: int, progress: Callable[[int, int], None] = None) -> int:
+    """
+    Delete the item type together with all its items.
+
+    The item type is deleted first, then its items in batches. Every batch is committed on its own and removed
+    from the session, so the memory use does not grow with the number of items. If a batch fails, the already
+    deleted items stay deleted and calling the function again continues with the remaining items.
+    The optional progress callback gets the number of done and total items.
+    Raises a ValueError if the item type does not exist or one of its items is lent.
+    Returns the number of deleted items.
+    """
+    item_type = ItemType.query.filter(ItemType.id == type_id).first()
+    if item_type is None:
+        raise ValueError('Requested item type not found!')
+
+    # pylint: disable=C0121
+    items_of_type = Item.query.filter(Item.type_id == type_id).filter(Item.deleted_time == None)
+    if DB.session.query(items_of_type.filter(Item.lending_id != None).exists()).scalar():
+        raise ValueError('Requested item is currently lent!')
+
+    item_type.deleted = True
+    DB.session.commit()
+
+    total = items_of_type.count()
+    done = 0
+    last_id = None
+    while True:
+        batch_query = items_of_type
+        if last_id is not None:
+            batch_query = batch_query.filter(Item.id > last_id)
+        items = batch_query.options(selectinload(Item._attributes)).order_by(Item.id).limit(BATCH_SIZE).all()
+        if not items:
+            break
+        last_id = items[-1].id
+
+        for item in items:
+            code, msg, commit = item.delete()
+            if not commit:
+                raise ValueError(msg)
+        DB.session.commit()
+        DB.session.expunge_all()
+
+        done += len(items)
+        if progress is not None:
+            progress(done, total)
+    return done
+
+
+def set_tag_deleted(tag_id: int, deleted: bool) -> None:
+    """
+    Delete or undelete the tag and update the attributes of all items with that tag.
+
+    Raises a ValueError if the tag does not exist.
+    """
+    tag = Tag.query.filter(Tag.id == tag_id).first()
+    if tag is None:
+        raise ValueError('Requested item tag not found!')
+
+    tag.deleted = deleted
+
+    item_ids = select([ItemToTag.item_id]).where(ItemToTag.tag_id == tag_id)
+    definition_ids = (select([TagToAttributeDefinition.attribute_definition_id])
+                      .where(TagToAttributeDefinition.tag_id == tag_id))
+    if deleted:
+        remove_orphaned_attributes(item_ids, definition_ids)
+    else:
+        add_attributes(item_ids, definition_ids)
+
+
+def associate_type_attribute(type_id: int, attribute_definition_id: int) -> None:
+    """
+    Associate the attribute definition with the item type and add the attribute to all items of that type.
+
+    Raises a IntegrityError if the attribute definition is already associated with the item type.
+    """
+    DB.session.add(ItemTypeToAttributeDefinition(type_id, attribute_definition_id))
+    add_attributes(select([Item.id]).where(Item.type_id == type_id), [attribute_definition_id])
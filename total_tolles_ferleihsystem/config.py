@@ -111,6 +111,9 @@ class Config(object):
     CELERY_RESULT_BACKEND = 'rpc://'
     TMP_DIRECTORY = '/tmp'
     DATA_DIRECTORY = '/tmp'
+    FILE_STORE = 'Sharded'
+    FILE_CACHE_MAX_AGE = 31536000
+    X_ACCEL_REDIRECT_PREFIX = None
 
     LOGIN_PROVIDERS = ['Basic']
 
@@ -133,10 +136,26 @@ class Config(object):
 
     MONITOR_REQUEST_PERORMANCE = True
     LONG_REQUEST_THRESHHOLD = 1
+    PERFORMANCE_RECORDS = 1000
+    PERFORMANCE_SLOWEST_QUERIES = 5
+    N_PLUS_ONE_THRESHOLD = 0
+    N_PLUS_ONE_RAISE = False
+    PROFILE_REQUESTS = False
+    PROFILE_SAMPLE_INTERVAL = 0.005
+    PROFILE_SAMPLE_RATE = 0
+    PROFILE_DIRECTORY = None
 
     JSON_SORT_KEYS = False
     JSONIFY_PRETTYPRINT_REGULAR = False
     RESTPLUS_JSON = {'indent': None}
+    JSON_SERIALIZER = 'auto'
+
+    LENDING_RETRIES = 3
+
+    RESPONSE_CACHE = 'local'
+    RESPONSE_CACHE_SIZE = 256
+    RESPONSE_CACHE_REDIS_URL = 'redis://localhost:6379/0'
+    RESPONSE_CACHE_TIMEOUT = 3600
 
 
 class ProductionConfig(Config):
@@ -147,6 +166,7 @@ class DebugConfig(Config):
     DEBUG = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:////tmp/test.db'
     LONG_REQUEST_THRESHHOLD = 0
+    N_PLUS_ONE_THRESHOLD = 10
     JWT_SECRET_KEY = 'debug'
     JWT_ACCESS_TOKEN_EXPIRES = False
     CORS_ORIGINS = ["http://localhost:*", "http://127.0.0.1:*"]
@@ -169,3 +189,5 @@ class DebugConfig(Config):
 
 class TestingConfig(Config):
     TESTING = True
+    N_PLUS_ONE_THRESHOLD = 10
+    N_PLUS_ONE_RAISE = True
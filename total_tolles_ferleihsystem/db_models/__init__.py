@@ -13,7 +13,8 @@ DB_COMMAND_LOGGER = getLogger('flask.app.db')  # type: Logger
 STD_STRING_SIZE = 190  # Max size that allows Indices while using utf8mb4 in MySql DB
 
 
-from . import attributeDefinition, blacklist, item, itemType, tag, settings
+from . import attributeDefinition, blacklist, item, itemType, tag, settings, searchIndex, catalogVersion
+from . import typedAttributeValues
 
 
 if APP.config.get('SQLALCHEMY_DATABASE_URI', '').startswith('sqlite://'):
@@ -47,3 +48,19 @@ def drop_db():
 def drop_db_function():
     DB.drop_all()
     APP.logger.info('Dropped Database.')
+
+
+@APP.cli.command('rebuild_search_index')
+def rebuild_search_index():
+    """Recompute the search index of all items."""
+    with DB.engine.begin() as connection:
+        searchIndex.rebuild_search_index(connection)
+    click.echo('Search index rebuilt.')
+
+
+@APP.cli.command('retype_attribute_values')
+def retype_attribute_values():
+    """Recompute the typed columns of all attribute values."""
+    with DB.engine.begin() as connection:
+        updated = typedAttributeValues.retype_attribute_values(connection)
+    click.echo('Typed values of {} attributes recomputed.'.format(updated))
@@ -1,9 +1,12 @@
+import time
+
 from .. import DB
 from . import STD_STRING_SIZE
+from .visibility import VisibilityMixin
 
 __all__=['AttributeDefinition']
 
-class AttributeDefinition (DB.Model):
+class AttributeDefinition (VisibilityMixin, DB.Model):
 
     __tablename__ = 'AttributeDefinition'
 
@@ -0,0 +1,131 @@
+"""
+Module containing the set based reconciliation of item attributes.
+
+Items get their attributes from their item type and their tags. When one of these sources changes, the
+attributes of all affected items are added, undeleted or deleted with a few statements instead of checking
+every single item.
+"""
+import time
+from typing import List, Union
+
+from sqlalchemy.sql import and_, exists, literal, select
+from sqlalchemy.sql.expression import Select
+
+from .. import DB
+from .attributeDefinition import AttributeDefinition
+from .item import Item, ItemToAttributeDefinition, ItemToTag
+from .itemType import ItemTypeToAttributeDefinition
+from .tag import Tag, TagToAttributeDefinition
+from .searchIndex import reindex_items
+from .catalogVersion import bump_catalog_version
+
+__all__ = ['add_attributes', 'remove_orphaned_attributes']
+
+# a list of ids or a select of a single id column
+IdSelection = Union[List[int], Select]
+
+
+def _is_empty(ids: IdSelection) -> bool:
+    return isinstance(ids, (list, set, tuple)) and not ids
+
+
+def _uncorrelated(ids: IdSelection) -> IdSelection:
+    # a select of item ids must not be correlated with the item table of the surrounding statement
+    return ids.correlate(None) if isinstance(ids, Select) else ids
+
+
+def add_attributes(item_ids: IdSelection, definition_ids: IdSelection) -> None:
+    """
+    Make sure that all given items have a (not deleted) attribute for every given attribute definition.
+
+    Missing attributes are inserted with an empty value, deleted ones are undeleted. Does not commit the changes.
+    """
+    if _is_empty(item_ids) or _is_empty(definition_ids):
+        return
+    item_ids = _uncorrelated(item_ids)
+    definition_ids = _uncorrelated(definition_ids)
+
+    # the statements below bypass the session, pending changes (e.g. new associations) have to be written first
+    DB.session.flush()
+    connection = DB.session.connection()
+    item = Item.__table__
+    attribute_definition = AttributeDefinition.__table__
+    item_to_attribute = ItemToAttributeDefinition.__table__
+
+    # pylint: disable=C0121
+    deleted = and_(item_to_attribute.c.item_id.in_(item_ids),
+                   item_to_attribute.c.attribute_definition_id.in_(definition_ids),
+                   item_to_attribute.c.deleted_time != None)
+    undeleted_item_ids = [row[0] for row in connection.execute(select([item_to_attribute.c.item_id])
+                                                               .where(deleted).distinct())]
+    if undeleted_item_ids:
+        connection.execute(item_to_attribute.update().where(deleted).values(deleted_time=None))
+
+    missing = (select([item.c.id, attribute_definition.c.id, literal('')])
+               .where(item.c.id.in_(item_ids))
+               .where(attribute_definition.c.id.in_(definition_ids))
+               .where(~exists().where(item_to_attribute.c.item_id == item.c.id)
+                      .where(item_to_attribute.c.attribute_definition_id == attribute_definition.c.id)))
+    result = connection.execute(item_to_attribute.insert()
+                                .from_select(['item_id', 'attribute_definition_id', 'value'], missing))
+    if undeleted_item_ids or result.rowcount != 0:
+        bump_catalog_version(connection)
+
+    # new attributes have no value yet, only the undeleted ones change the search index
+    reindex_items(connection, undeleted_item_ids)
+
+
+def remove_orphaned_attributes(item_ids: IdSelection, definition_ids: IdSelection) -> None:
+    """
+    Delete the attributes of the given items and attribute definitions which are not provided anymore.
+
+    A attribute is provided by the item type of the item or by a (not deleted) tag of the item, if that source is
+    associated with the (not deleted) attribute definition. Does not commit the changes.
+    """
+    if _is_empty(item_ids) or _is_empty(definition_ids):
+        return
+    item_ids = _uncorrelated(item_ids)
+    definition_ids = _uncorrelated(definition_ids)
+
+    # the statements below bypass the session, removed sources have to be written first
+    DB.session.flush()
+    connection = DB.session.connection()
+    item = Item.__table__
+    tag = Tag.__table__
+    attribute_definition = AttributeDefinition.__table__
+    item_to_attribute = ItemToAttributeDefinition.__table__
+    item_to_tag = ItemToTag.__table__
+    item_type_to_attribute = ItemTypeToAttributeDefinition.__table__
+    tag_to_attribute = TagToAttributeDefinition.__table__
+
+    # pylint: disable=C0121
+    type_source = (exists()
+                   .where(item.c.id == item_to_attribute.c.item_id)
+                   .where(item_type_to_attribute.c.item_type_id == item.c.type_id)
+                   .where(item_type_to_attribute.c.attribute_definition_id
+                          == item_to_attribute.c.attribute_definition_id)
+                   .where(attribute_definition.c.id == item_type_to_attribute.c.attribute_definition_id)
+                   .where(attribute_definition.c.deleted_time == None))
+    # pylint: disable=C0121
+    tag_source = (exists()
+                  .where(item_to_tag.c.item_id == item_to_attribute.c.item_id)
+                  .where(tag.c.id == item_to_tag.c.tag_id)
+                  .where(tag.c.deleted_time == None)
+                  .where(tag_to_attribute.c.tag_id == tag.c.id)
+                  .where(tag_to_attribute.c.attribute_definition_id == item_to_attribute.c.attribute_definition_id)
+                  .where(attribute_definition.c.id == tag_to_attribute.c.attribute_definition_id)
+                  .where(attribute_definition.c.deleted_time == None))
+    # pylint: disable=C0121
+    orphaned = and_(item_to_attribute.c.item_id.in_(item_ids),
+                    item_to_attribute.c.attribute_definition_id.in_(definition_ids),
+                    item_to_attribute.c.deleted_time == None,
+                    ~type_source,
+                    ~tag_source)
+
+    affected_item_ids = [row[0] for row in connection.execute(select([item_to_attribute.c.item_id])
+                                                              .where(orphaned).distinct())]
+    if not affected_item_ids:
+        return
+    connection.execute(item_to_attribute.update().where(orphaned).values(deleted_time=int(time.time())))
+    bump_catalog_version(connection)
+    reindex_items(connection, affected_item_ids)
@@ -0,0 +1,109 @@
+"""
+Module containing the catalog version, a counter bumped by every transaction changing the catalog.
+
+The api answers conditional requests of catalog resources with the version (see api/caching.py), so unchanged
+resources cost a single primary key lookup.
+
+Lending items only changes their availability. Bumping the version in those transactions would hold the lock of
+the version row until their commit, serialising all lendings (and risking deadlocks with the item row locks of the
+lendings). Such transactions bump the version after their commit in a short transaction of its own instead.
+"""
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from .. import DB
+from .attributeDefinition import AttributeDefinition
+from .item import Item, File, Lending, ItemToItem, ItemToTag, ItemToAttributeDefinition
+from .itemType import ItemType, ItemTypeToItemType, ItemTypeToAttributeDefinition
+from .tag import Tag, TagToAttributeDefinition
+
+__all__ = ['CatalogVersion', 'current_catalog_version', 'bump_catalog_version']
+
+CATALOG_VERSION_ID = 1
+
+CATALOG_MODELS = (Item, File, Lending, ItemToItem, ItemToTag, ItemToAttributeDefinition, ItemType,
+                  ItemTypeToItemType, ItemTypeToAttributeDefinition, Tag, TagToAttributeDefinition,
+                  AttributeDefinition)
+
+# item attributes changed by lending and returning items
+AVAILABILITY_ATTRIBUTES = {'lending', 'lending_id', 'due', 'version_id'}
+
+# session.info key of a pending bump after the commit
+BUMP_AFTER_COMMIT = 'ttf_bump_catalog_version_after_commit'
+
+
+class CatalogVersion(DB.Model):
+    """
+    The single row of this table holds the current catalog version.
+    """
+    __tablename__ = 'CatalogVersion'
+
+    id = DB.Column(DB.Integer, primary_key=True)
+    version = DB.Column(DB.Integer, nullable=False, default=1)
+
+
+def current_catalog_version() -> int:
+    """
+    The version of the catalog as seen by the current transaction.
+    """
+    version = DB.session.query(CatalogVersion.version).filter(CatalogVersion.id == CATALOG_VERSION_ID).scalar()
+    return version if version is not None else 0
+
+
+def bump_catalog_version(connection) -> None:
+    """
+    Increment the catalog version in the transaction of the connection.
+
+    Must be called by every core statement changing catalog tables, the orm changes are tracked automatically.
+    """
+    catalog_version = CatalogVersion.__table__
+    result = connection.execute(catalog_version.update()
+                                .where(catalog_version.c.id == CATALOG_VERSION_ID)
+                                .values(version=catalog_version.c.version + 1))
+    if result.rowcount == 0:
+        # databases created with create_all instead of the migrations have no version row yet
+        connection.execute(catalog_version.insert().values(id=CATALOG_VERSION_ID, version=1))
+
+
+def _availability_change(obj, modified: bool) -> bool:
+    if isinstance(obj, Lending):
+        return True
+    if not modified or not isinstance(obj, Item):
+        return False
+    changed = {attribute.key for attribute in inspect(obj).attrs if attribute.history.has_changes()}
+    return changed <= AVAILABILITY_ATTRIBUTES
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_catalog_version_on_change(session: Session, flush_context):
+    """
+    Bump the catalog version if this flush wrote one of the catalog models.
+
+    Flushes which only lend or return items bump the version after the commit.
+    """
+    changed = [(obj, False) for obj in session.new if isinstance(obj, CATALOG_MODELS)]
+    changed += [(obj, False) for obj in session.deleted if isinstance(obj, CATALOG_MODELS)]
+    changed += [(obj, True) for obj in session.dirty
+                if isinstance(obj, CATALOG_MODELS) and session.is_modified(obj)]
+    if not changed:
+        return
+    if all(_availability_change(obj, modified) for obj, modified in changed):
+        session.info[BUMP_AFTER_COMMIT] = True
+    else:
+        bump_catalog_version(session.connection())
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_catalog_version_after_commit(session: Session):
+    """
+    Bump the catalog version for the committed lendings in a separate transaction.
+    """
+    if session.info.pop(BUMP_AFTER_COMMIT, False):
+        with DB.engine.begin() as connection:
+            bump_catalog_version(connection)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_bump_after_commit(session: Session):
+    session.info.pop(BUMP_AFTER_COMMIT, None)
@@ -1,18 +1,22 @@
 """
 The database models of the item and all connected tables
 """
-from sqlalchemy.sql import func
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.sql import func, select
 from sqlalchemy.schema import UniqueConstraint
 import string
 from json import loads
 import time
 from datetime import date
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Set
 
 from .. import DB, LENDING_LOGGER
 from . import STD_STRING_SIZE
 
 from . import itemType
-from .tag import TagToAttributeDefinition
+from .tag import Tag
+from .visibility import VisibilityMixin
 
 __all__ = [
     'Item',
@@ -24,7 +28,7 @@ __all__ = [
 ]
 
 
-class Item(DB.Model):
+class Item(VisibilityMixin, DB.Model):
     """
     This data model represents a single lendable item
     """
@@ -34,11 +38,12 @@ class Item(DB.Model):
     name = DB.Column(DB.String(STD_STRING_SIZE))
     update_name_from_schema = DB.Column(DB.Boolean, default=True, nullable=False)
     type_id = DB.Column(DB.Integer, DB.ForeignKey('ItemType.id'))
-    lending_id = DB.Column(DB.Integer, DB.ForeignKey('Lending.id'), default=None, nullable=True)
+    lending_id = DB.Column(DB.Integer, DB.ForeignKey('Lending.id'), default=None, nullable=True, index=True)
     lending_duration = DB.Column(DB.Integer, nullable=True)  # in seconds
     due = DB.Column(DB.Integer, default=-1) # unix time
     deleted_time = DB.Column(DB.Integer, default=None)
     visible_for = DB.Column(DB.String(STD_STRING_SIZE), nullable=True)
+    version_id = DB.Column(DB.Integer, nullable=False, server_default='1')
 
     type = DB.relationship('ItemType', lazy='joined')
     lending = DB.relationship('Lending', lazy='select',
@@ -46,8 +51,14 @@ class Item(DB.Model):
 
     __table_args__ = (
         UniqueConstraint('name', 'type_id', name='_name_type_id_uc'),
+        DB.Index('ix_Item_deleted_time_visibility_level_name', 'deleted_time', 'visibility_level', 'name'),
     )
 
+    # every update checks and increments the version, concurrent changes raise a StaleDataError
+    __mapper_args__ = {
+        'version_id_col': version_id,
+    }
+
     def __init__(self, update_name_from_schema: bool, name: str, type_id: int, lending_duration: int = -1,
                  visible_for: str = ''):
         self.update_name_from_schema = update_name_from_schema
@@ -94,7 +105,8 @@ class Item(DB.Model):
         """
         If the item is currently lent.
         """
-        return self.lending is not None
+        # avoid loading the lending if the foreign key already tells
+        return self.lending_id is not None or self.lending is not None
 
     @property
     def parent(self):
@@ -110,16 +122,21 @@ class Item(DB.Model):
         if self.lending_duration and (self.lending_duration >= 0):
             return self.lending_duration
 
-        tag_lending_duration = min((t.tag.lending_duration for t in self._tags if t.tag.lending_duration > 0), default=-1)
-
-        if tag_lending_duration >= 0:
-            return tag_lending_duration
+        # loaded together with the item, see tag_lending_duration below
+        if self.tag_lending_duration is not None:
+            return self.tag_lending_duration
 
         return self.type.lending_duration
 
     @property
     def name_schema_name(self):
-        template = string.Template(self.type.name_schema)
+        parent = "".join(link.parent.name for link in self._parents)
+        return self.render_name_schema(parent)
+
+    def render_name_schema(self, parent: str, times: Dict[str, Any] = None) -> str:
+        """
+        Render the name schema of the item type with the attributes of this item and the given parent names.
+        """
         attributes = {}
         for attr in self._attributes:
             if attr.value:
@@ -128,19 +145,11 @@ class Item(DB.Model):
                 except:
                     pass
             else:
-                attr_def = loads(attr.attribute_definition.jsonschema)
-                attributes[attr.attribute_definition.name] = attr_def.get('default', '')
-
-        parent = "".join(item.parent.name for item in ItemToItem.query.filter(ItemToItem.item_id == self.id).all())
-
-        today = date.today()
-        times = {
-            'c_year': today.year,
-            'c_month': today.month,
-            'c_day': today.day,
-            'c_date': today.strftime('%d.%b.%Y'),
-            'c_date_iso': today.isoformat(),
-        }
+                attributes[attr.attribute_definition.name] = schema_default(attr.attribute_definition.jsonschema)
+
+        if times is None:
+            times = name_schema_times()
+        template = compile_name_schema(self.type.name_schema)
         return template.safe_substitute(attributes, type=self.type.name, parent=parent, **times)
 
     def delete(self):
@@ -231,20 +240,8 @@ class Item(DB.Model):
 
         return attributes_to_add, attributes_to_delete, attributes_to_undelete
 
-    def get_attribute_changes_from_tag(self, tag_id: int, remove: bool = False):
-        """
-        Get a list of attributes to add, to delete and to undelete,
-        when this item would now get that tag or loose that tag.
-        """
-
-        tag_attribute_definitions = (TagToAttributeDefinition
-                                     .query
-                                     .filter(TagToAttributeDefinition.tag_id == tag_id)
-                                     .all())
-        return self.get_attribute_changes([ttad.attribute_definition_id for ttad in tag_attribute_definitions], remove)
-
 
-class File(DB.Model):
+class File(VisibilityMixin, DB.Model):
     """
     This data model represents a file attached to a item
     """
@@ -252,10 +249,10 @@ class File(DB.Model):
     __tablename__ = 'File'
 
     id = DB.Column(DB.Integer, primary_key=True)
-    item_id = DB.Column(DB.Integer, DB.ForeignKey('Item.id'), nullable=True)
+    item_id = DB.Column(DB.Integer, DB.ForeignKey('Item.id'), nullable=True, index=True)
     name = DB.Column(DB.String(STD_STRING_SIZE), nullable=True)
     file_type = DB.Column(DB.String(STD_STRING_SIZE))
-    file_hash = DB.Column(DB.String(STD_STRING_SIZE), nullable=True)
+    file_hash = DB.Column(DB.String(STD_STRING_SIZE), nullable=True, index=True)
     creation = DB.Column(DB.Integer)
     invalidation = DB.Column(DB.Integer, nullable=True)
     visible_for = DB.Column(DB.String(STD_STRING_SIZE), nullable=True)
@@ -317,18 +314,37 @@ class Lending(DB.Model):
         self.user = user
         self.date = int(time.time())
         self.deposit = deposit
+        self.lend_items(item_ids, load_items_for_lending(item_ids))
+        LENDING_LOGGER.info("New lending: %s", repr(self))
+
+    @staticmethod
+    def create_many(lendings: List[Dict[str, Any]]) -> List['Lending']:
+        """
+        Create many lendings at once. The items of all lendings are validated with a single query.
+        """
+        items = load_items_for_lending([item_id for lending in lendings for item_id in lending['item_ids']])
+        new_lendings = []
+        for data in lendings:
+            lending = Lending(data['moderator'], data['user'], data['deposit'], [])
+            lending.lend_items(data['item_ids'], items)
+            new_lendings.append(lending)
+            LENDING_LOGGER.info("New lending: %s", repr(lending))
+        return new_lendings
+
+    def lend_items(self, item_ids: list, items: Dict[int, 'Item']):
+        """
+        Add the items (already loaded by load_items_for_lending) to this lending.
+        """
         for element in item_ids:
-            item = Item.query.filter(Item.id == element).filter(Item.deleted_time == None).first()
+            item = items.get(element)
             if item is None:
                 raise ValueError("Item not found:" + str(element))
             if not item.type.lendable:
                 raise ValueError("Item not lendable:" + str(element))
             if item.is_currently_lent:
-               raise ValueError("Item already lent:" + str(element))
+                raise ValueError("Item already lent:" + str(element))
             item.lending = self
             item.due = self.date + item.effective_lending_duration
-        LENDING_LOGGER.info("New lending: %s", repr(self))
-
 
     def update(self, moderator: str, user: str, deposit: str, item_ids: list):
         """
@@ -338,13 +354,12 @@ class Lending(DB.Model):
         self.user = user
         self.deposit = deposit
         old_items = self._items
-        new_items = []
+        items = load_items_for_lending(item_ids)
 
         for element in item_ids:
-            item = Item.query.filter(Item.id == element).filter(Item.deleted_time == None).first()
-            if item is None:
+            if element not in items:
                 raise ValueError("Item not found:" + str(element))
-            new_items.append(item)
+        new_items = [items[element] for element in item_ids]
 
         items_to_remove = [item for item in old_items if item not in new_items]
         items_to_add = [item for item in new_items if item not in old_items]
@@ -353,13 +368,7 @@ class Lending(DB.Model):
             item.lending = None
             item.due = -1
 
-        for item in items_to_add:
-            if not item.type.lendable:
-                raise ValueError("Item not lendable:" + str(item))
-            if item.is_currently_lent:
-                raise ValueError("Item already lent:" + str(item))
-            item.lending = self
-            item.due = self.date + item.effective_lending_duration
+        self.lend_items([item.id for item in items_to_add], items)
         LENDING_LOGGER.info("Updated lending: %s", repr(self))
 
 
@@ -367,20 +376,143 @@ class Lending(DB.Model):
         """
         Function to remove a list of items from this lending
         """
+        items = {item.id: item for item in self._items}
         for element in item_ids:
-            item = Item.query.filter(Item.id == element).first()
+            item = items.get(element)
             if item is None:
                 raise ValueError("Item not found:" + str(element))
             item.lending = None
             item.due = -1
         LENDING_LOGGER.info("Updated lending(remove items): %s", repr(self))
 
+    @staticmethod
+    def return_items(item_ids: list) -> Set[int]:
+        """
+        Give back items of any lendings. Returns the ids of the affected lendings.
+        """
+        items = load_items_for_lending(item_ids)
+        lending_ids = set()
+        for element in item_ids:
+            item = items.get(element)
+            if item is None:
+                raise ValueError("Item not found:" + str(element))
+            if item.lending_id is None:
+                raise ValueError("Item not lent:" + str(element))
+            lending_ids.add(item.lending_id)
+            item.lending = None
+            item.due = -1
+        LENDING_LOGGER.info("Returned items %s of lendings %s", item_ids, sorted(lending_ids))
+        return lending_ids
+
     def pre_delete(self):
         LENDING_LOGGER.info("Deleting lending: %s", repr(self))
         for item in list(self._items):
             item.lending = None
             item.due = -1
 
+@lru_cache(maxsize=256)
+def compile_name_schema(name_schema: str) -> string.Template:
+    """
+    The compiled template of a name schema.
+
+    Cached by the schema itself, so a changed schema of a item type is compiled again automatically.
+    """
+    return string.Template(name_schema)
+
+
+@lru_cache(maxsize=1024)
+def schema_default(jsonschema: str) -> Any:
+    """
+    The default value of a attribute definition jsonschema (cached by the jsonschema).
+    """
+    return loads(jsonschema).get('default', '')
+
+
+def name_schema_times() -> Dict[str, Any]:
+    """
+    The current date values usable in name schemas.
+    """
+    today = date.today()
+    return {
+        'c_year': today.year,
+        'c_month': today.month,
+        'c_day': today.day,
+        'c_date': today.strftime('%d.%b.%Y'),
+        'c_date_iso': today.isoformat(),
+    }
+
+
+def rerender_item_names(type_id: int, batch_size: int = 500,
+                        progress: Callable[[int, int], None] = None) -> int:
+    """
+    Render the names of all items of the type which follow the name schema again.
+
+    The items are processed in batches of batch_size. Every batch loads its items, attributes and parent
+    names with a constant number of queries and is committed on its own. The optional progress callback gets
+    the number of done and total items. Returns the number of renamed items.
+    """
+    # pylint: disable=C0121
+    query = (Item.query
+             .filter(Item.type_id == type_id)
+             .filter(Item.update_name_from_schema == True)
+             .filter(Item.deleted_time == None))
+    total = query.count()
+    times = name_schema_times()
+    done = 0
+    renamed = 0
+    last_id = None
+    while True:
+        batch_query = query
+        if last_id is not None:
+            batch_query = batch_query.filter(Item.id > last_id)
+        items = (batch_query
+                 .options(selectinload(Item._attributes).joinedload(ItemToAttributeDefinition.attribute_definition))
+                 .order_by(Item.id)
+                 .limit(batch_size)
+                 .all())
+        if not items:
+            break
+        last_id = items[-1].id
+
+        parents: Dict[int, List[str]] = {}
+        parent_names = (DB.session.query(ItemToItem.item_id, Item.name)
+                        .join(Item, Item.id == ItemToItem.parent_id)
+                        .filter(ItemToItem.item_id.in_([item.id for item in items])))
+        for item_id, parent_name in parent_names:
+            parents.setdefault(item_id, []).append(parent_name)
+
+        for item in items:
+            name = item.render_name_schema("".join(parents.get(item.id, [])), times)
+            if name != item.name:
+                item.name = name
+                renamed += 1
+        DB.session.commit()
+
+        done += len(items)
+        if progress is not None:
+            progress(done, total)
+    return renamed
+
+
+def load_items_for_lending(item_ids: list) -> Dict[int, Item]:
+    """
+    Load the (not deleted) items with their type in a single query.
+
+    The rows are locked until the end of the transaction where the database supports SELECT ... FOR UPDATE.
+    """
+    if not item_ids:
+        return {}
+    # pylint: disable=C0121
+    items = (Item.query
+             .filter(Item.id.in_(set(item_ids)))
+             .filter(Item.deleted_time == None)
+             .order_by(Item.id)
+             .with_for_update(of=Item)
+             .populate_existing()
+             .all())
+    return {item.id: item for item in items}
+
+
 class ItemToItem(DB.Model):
 
     __tablename__ = 'ItemToItem'
@@ -405,7 +537,7 @@ class ItemToTag (DB.Model):
     __tablename__ = 'ItemToTag'
 
     item_id = DB.Column(DB.Integer, DB.ForeignKey('Item.id'), primary_key=True)
-    tag_id = DB.Column(DB.Integer, DB.ForeignKey('Tag.id'), primary_key=True)
+    tag_id = DB.Column(DB.Integer, DB.ForeignKey('Tag.id'), primary_key=True, index=True)
 
     item = DB.relationship('Item', lazy='select', backref=DB.backref('_tags', lazy='select',
                                                                      single_parent=True, cascade="all, delete-orphan"))
@@ -416,6 +548,18 @@ class ItemToTag (DB.Model):
         self.tag_id = tag_id
 
 
+# The shortest positive lending duration of all tags of the item (or None).
+# Computed by a correlated subquery in the same query that loads the items.
+Item.tag_lending_duration = DB.column_property(
+    select([func.min(Tag.lending_duration)])
+    .where(ItemToTag.item_id == Item.id)
+    .where(ItemToTag.tag_id == Tag.id)
+    .where(Tag.lending_duration > 0)
+    .correlate_except(ItemToTag, Tag)
+    .as_scalar()
+)
+
+
 class ItemToAttributeDefinition (DB.Model):
 
     __tablename__ = 'ItemToAttributeDefinition'
@@ -424,12 +568,29 @@ class ItemToAttributeDefinition (DB.Model):
     attribute_definition_id = DB.Column(DB.Integer, DB.ForeignKey('AttributeDefinition.id'), primary_key=True)
     value = DB.Column(DB.String(STD_STRING_SIZE))
     deleted_time = DB.Column(DB.Integer, default=None)
+    # typed copies of the json value for range queries, kept up to date by db_models/typedAttributeValues.py
+    value_int = DB.Column(DB.BigInteger, nullable=True)
+    value_num = DB.Column(DB.Float, nullable=True)
+    value_bool = DB.Column(DB.Boolean, nullable=True)
+    value_date = DB.Column(DB.Date, nullable=True)
 
     item = DB.relationship('Item', lazy='select', backref=DB.backref('_attributes', lazy='select',
                                                                      single_parent=True, cascade="all, delete-orphan"))
     attribute_definition = DB.relationship('AttributeDefinition', lazy='select',
                                            backref=DB.backref('_item_to_attribute_definitions', lazy='select'))
 
+    __table_args__ = (
+        DB.Index('ix_ItemToAttributeDefinition_attribute_definition_id_value', 'attribute_definition_id', 'value'),
+        DB.Index('ix_ItemToAttributeDefinition_attribute_definition_id_value_int', 'attribute_definition_id',
+                 'value_int'),
+        DB.Index('ix_ItemToAttributeDefinition_attribute_definition_id_value_num', 'attribute_definition_id',
+                 'value_num'),
+        DB.Index('ix_ItemToAttributeDefinition_attribute_definition_id_value_bool', 'attribute_definition_id',
+                 'value_bool'),
+        DB.Index('ix_ItemToAttributeDefinition_attribute_definition_id_value_date', 'attribute_definition_id',
+                 'value_date'),
+    )
+
     def __init__(self, item_id: int, attribute_definition_id: int, value: str):
         self.item_id = item_id
         self.attribute_definition_id = attribute_definition_id
@@ -1,14 +1,17 @@
 import time
 
+from sqlalchemy.sql import select
+
 from .. import DB
 from . import STD_STRING_SIZE
+from .visibility import VisibilityMixin
 from .attributeDefinition import AttributeDefinition
 from . import item
 
 __all__ = ['ItemType', 'ItemTypeToItemType', 'ItemTypeToAttributeDefinition']
 
 
-class ItemType (DB.Model):
+class ItemType (VisibilityMixin, DB.Model):
 
     __tablename__ = 'ItemType'
 
@@ -66,17 +69,13 @@ class ItemType (DB.Model):
         if association is None:
             return(204, '', False)
 
-        itads = item.ItemToAttributeDefinition.query.filter(
-            item.ItemToAttributeDefinition.attribute_definition_id == attribute_definition_id).all()
-
-        items = [itad.item for itad in itads]
+        # imported here, the reconciliation needs the completely loaded models
+        from .attributeReconciliation import remove_orphaned_attributes
 
         DB.session.delete(association)
 
-        for i in items:
-            _, attributes_to_delete, _ = i.get_attribute_changes([attribute_definition_id], True)
-            for attr in attributes_to_delete:
-                attr.deleted = True
+        remove_orphaned_attributes(select([item.Item.id]).where(item.Item.type_id == self.id),
+                                   [attribute_definition_id])
         return(204, '', True)
 
 
@@ -0,0 +1,161 @@
+"""
+Module containing the inverted search index for items.
+
+Every item is split into tokens (its name, the names of its tags and the values of its attributes).
+The tokens are kept in the SearchTerm table which is updated whenever a flush touches one of the sources.
+"""
+import re
+from typing import Iterable, Set, List, Dict, Any
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.sql import select
+
+from .. import DB
+from . import STD_STRING_SIZE
+from .item import Item, ItemToTag, ItemToAttributeDefinition
+from .tag import Tag
+
+__all__ = ['SearchTerm', 'tokenize', 'reindex_items', 'rebuild_search_index']
+
+TOKEN_PATTERN = re.compile(r'\w+')
+REINDEX_CHUNK_SIZE = 500
+
+
+class SearchTerm(DB.Model):
+    """
+    A single token of a item. Tokens from tags and attributes remember their source.
+    """
+
+    __tablename__ = 'SearchTerm'
+
+    id = DB.Column(DB.Integer, primary_key=True)
+    term = DB.Column(DB.String(STD_STRING_SIZE), nullable=False)
+    item_id = DB.Column(DB.Integer, DB.ForeignKey('Item.id'), nullable=False)
+    tag_id = DB.Column(DB.Integer, nullable=True)
+    attribute_definition_id = DB.Column(DB.Integer, nullable=True)
+
+    __table_args__ = (
+        DB.Index('ix_SearchTerm_term_item_id', 'term', 'item_id'),
+        DB.Index('ix_SearchTerm_item_id', 'item_id'),
+    )
+
+
+def tokenize(text: str) -> Set[str]:
+    """
+    Split a text into lowercase search tokens.
+    """
+    if not text:
+        return set()
+    return {token[:STD_STRING_SIZE] for token in TOKEN_PATTERN.findall(text.lower())}
+
+
+def _chunks(ids: List[int]):
+    for start in range(0, len(ids), REINDEX_CHUNK_SIZE):
+        yield ids[start:start + REINDEX_CHUNK_SIZE]
+
+
+def reindex_items(connection, item_ids: Iterable[int]) -> None:
+    """
+    Recompute the search terms of the given items.
+
+    Only uses core statements on the given connection, so it is safe to call during a flush.
+    """
+    search_term = SearchTerm.__table__
+    item = Item.__table__
+    item_to_tag = ItemToTag.__table__
+    tag = Tag.__table__
+    item_to_attribute = ItemToAttributeDefinition.__table__
+
+    for ids in _chunks(sorted({item_id for item_id in item_ids if item_id is not None})):
+        connection.execute(search_term.delete().where(search_term.c.item_id.in_(ids)))
+
+        rows: List[Dict[str, Any]] = []
+        for item_id, name in connection.execute(select([item.c.id, item.c.name]).where(item.c.id.in_(ids))):
+            rows.extend({'term': term, 'item_id': item_id, 'tag_id': None, 'attribute_definition_id': None}
+                        for term in tokenize(name))
+
+        # pylint: disable=C0121
+        tag_query = (select([item_to_tag.c.item_id, tag.c.id, tag.c.name])
+                     .select_from(item_to_tag.join(tag, item_to_tag.c.tag_id == tag.c.id))
+                     .where(item_to_tag.c.item_id.in_(ids))
+                     .where(tag.c.deleted_time == None))
+        for item_id, tag_id, name in connection.execute(tag_query):
+            rows.extend({'term': term, 'item_id': item_id, 'tag_id': tag_id, 'attribute_definition_id': None}
+                        for term in tokenize(name))
+
+        # pylint: disable=C0121
+        attribute_query = (select([item_to_attribute.c.item_id,
+                                   item_to_attribute.c.attribute_definition_id,
+                                   item_to_attribute.c.value])
+                           .where(item_to_attribute.c.item_id.in_(ids))
+                           .where(item_to_attribute.c.deleted_time == None))
+        for item_id, attribute_definition_id, value in connection.execute(attribute_query):
+            rows.extend({'term': term, 'item_id': item_id, 'tag_id': None,
+                         'attribute_definition_id': attribute_definition_id}
+                        for term in tokenize(value))
+
+        if rows:
+            connection.execute(search_term.insert(), rows)
+
+
+def rebuild_search_index(connection) -> None:
+    """
+    Recompute the search terms of all items.
+    """
+    item_ids = [row[0] for row in connection.execute(select([Item.__table__.c.id]))]
+    connection.execute(SearchTerm.__table__.delete())
+    reindex_items(connection, item_ids)
+
+
+def _changed(obj, *keys: str) -> bool:
+    return any(get_history(obj, key).has_changes() for key in keys)
+
+
+@event.listens_for(Session, 'before_flush')
+def _remove_deleted_items_from_index(session: Session, flush_context, instances):
+    """
+    Remove the terms of deleted items before the item rows are gone.
+    """
+    item_ids = [obj.id for obj in session.deleted if isinstance(obj, Item) and obj.id is not None]
+    if item_ids:
+        search_term = SearchTerm.__table__
+        session.connection().execute(search_term.delete().where(search_term.c.item_id.in_(item_ids)))
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_search_index(session: Session, flush_context):
+    """
+    Reindex all items whose searchable data was touched by this flush.
+    """
+    item_ids: Set[int] = set()
+    tag_ids: Set[int] = set()
+
+    for obj in session.new:
+        if isinstance(obj, Item):
+            item_ids.add(obj.id)
+        elif isinstance(obj, (ItemToTag, ItemToAttributeDefinition)):
+            item_ids.add(obj.item_id)
+
+    for obj in session.dirty:
+        if isinstance(obj, Item) and _changed(obj, 'name'):
+            item_ids.add(obj.id)
+        elif isinstance(obj, ItemToAttributeDefinition) and _changed(obj, 'value', 'deleted_time'):
+            item_ids.add(obj.item_id)
+        elif isinstance(obj, Tag) and _changed(obj, 'name', 'deleted_time'):
+            tag_ids.add(obj.id)
+
+    for obj in session.deleted:
+        if isinstance(obj, (ItemToTag, ItemToAttributeDefinition)):
+            item_ids.add(obj.item_id)
+
+    if not item_ids and not tag_ids:
+        return
+
+    connection = session.connection()
+    if tag_ids:
+        item_to_tag = ItemToTag.__table__
+        item_ids.update(row[0] for row in connection.execute(select([item_to_tag.c.item_id])
+                                                             .where(item_to_tag.c.tag_id.in_(tag_ids))))
+    reindex_items(connection, item_ids)
@@ -3,14 +3,17 @@ Module containing database models for everything concerning Item-Tags.
 """
 import time
 
+from sqlalchemy.sql import select
+
 from .. import DB
 from . import STD_STRING_SIZE
+from .visibility import VisibilityMixin
 from . import attributeDefinition
 from . import item
 
 __all__ = [ 'Tag', 'TagToAttributeDefinition' ]
 
-class Tag(DB.Model):
+class Tag(VisibilityMixin, DB.Model):
     """
     The representation of a Item-Tag
     """
@@ -59,16 +62,13 @@ class Tag(DB.Model):
         if association is None:
             return(204, '', False)
 
-        itads = item.ItemToAttributeDefinition.query.filter(item.ItemToAttributeDefinition.attribute_definition_id == attribute_definition_id).all()
-
-        items = [itad.item for itad in itads]
+        # imported here, the reconciliation needs the completely loaded models
+        from .attributeReconciliation import remove_orphaned_attributes
 
         DB.session.delete(association)
 
-        for i in items:
-            _, attributes_to_delete, _ = i.get_attribute_changes([attribute_definition_id], True)
-            for attr in attributes_to_delete:
-                attr.deleted = True
+        remove_orphaned_attributes(select([item.ItemToTag.item_id]).where(item.ItemToTag.tag_id == self.id),
+                                   [attribute_definition_id])
         return(204, '', True)
 
 
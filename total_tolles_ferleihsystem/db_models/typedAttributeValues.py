@@ -0,0 +1,164 @@
+"""
+Module containing the typed copies of the (json encoded) attribute values.
+
+Every item attribute keeps its value converted to the type of its attribute definition in one of the columns
+value_int, value_num, value_bool or value_date. The columns are indexed together with the attribute definition,
+so numeric and date range searches compare typed values and can use the indexes.
+"""
+from datetime import date
+from json import loads
+from typing import Any, Dict, Iterable, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.sql import and_, bindparam, select
+
+from .attributeDefinition import AttributeDefinition
+from .catalogVersion import bump_catalog_version
+from .item import ItemToAttributeDefinition
+
+__all__ = ['typed_values', 'typed_column', 'parse_typed_value', 'retype_attribute_values']
+
+TYPED_COLUMNS = ('value_int', 'value_num', 'value_bool', 'value_date')
+DATE_FORMATS = ('date', 'date-time')
+
+
+def _string_format(jsonschema: Optional[str]) -> Optional[str]:
+    try:
+        schema = loads(jsonschema) if jsonschema else {}
+    except ValueError:
+        return None
+    return schema.get('format') if isinstance(schema, dict) else None
+
+
+def typed_column(definition_type: str, jsonschema: Optional[str]) -> Optional[str]:
+    """
+    The name of the typed column holding the values of a attribute definition (None for plain strings).
+    """
+    if definition_type == 'integer':
+        return 'value_int'
+    if definition_type == 'number':
+        return 'value_num'
+    if definition_type == 'boolean':
+        return 'value_bool'
+    if definition_type == 'string' and _string_format(jsonschema) in DATE_FORMATS:
+        return 'value_date'
+    return None
+
+
+def parse_typed_value(column: str, value: Any) -> Any:
+    """
+    Convert the (decoded json or search string) value for the typed column.
+
+    Raises a ValueError if the value does not fit the column.
+    """
+    if column in ('value_int', 'value_num'):
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise ValueError('Not a number: {!r}'.format(value))
+        number = float(value)
+        if column == 'value_int':
+            if not number.is_integer():
+                raise ValueError('Not a integer: {!r}'.format(value))
+            return int(number)
+        return number
+    if column == 'value_bool':
+        if isinstance(value, bool):
+            return value
+        if value in ('true', 'false'):
+            return value == 'true'
+        raise ValueError('Not a boolean: {!r}'.format(value))
+    if column == 'value_date':
+        if not isinstance(value, str):
+            raise ValueError('Not a date: {!r}'.format(value))
+        # date-time values are compared by their date
+        return date.fromisoformat(value[:10])
+    raise ValueError('Unknown typed column: {}'.format(column))
+
+
+def typed_values(definition_type: str, jsonschema: Optional[str], value: Optional[str]) -> Dict[str, Any]:
+    """
+    The values of all typed columns for the json encoded attribute value.
+
+    Values which do not match the type of the attribute definition leave all typed columns empty.
+    """
+    result: Dict[str, Any] = dict.fromkeys(TYPED_COLUMNS)
+    column = typed_column(definition_type, jsonschema)
+    if column is None or not value:
+        return result
+    try:
+        result[column] = parse_typed_value(column, loads(value))
+    except ValueError:
+        return result
+    if column == 'value_int':
+        # integers can be compared with non integer bounds in the number column
+        result['value_num'] = float(result['value_int'])
+    return result
+
+
+def retype_attribute_values(connection, definition_ids: Iterable[int] = None) -> int:
+    """
+    Recompute the typed columns of all attributes of the given (or all) attribute definitions.
+
+    Only uses core statements on the given connection and bumps the catalog version (range searches change).
+    Returns the number of updated attributes.
+    """
+    attribute_definition = AttributeDefinition.__table__
+    item_to_attribute = ItemToAttributeDefinition.__table__
+
+    definitions_query = select([attribute_definition.c.id, attribute_definition.c.type,
+                                attribute_definition.c.jsonschema])
+    if definition_ids is not None:
+        definitions_query = definitions_query.where(attribute_definition.c.id.in_(list(definition_ids)))
+
+    update = (item_to_attribute.update()
+              .where(and_(item_to_attribute.c.item_id == bindparam('b_item_id'),
+                          item_to_attribute.c.attribute_definition_id == bindparam('b_definition_id'))))
+    updated = 0
+    for definition_id, definition_type, jsonschema in connection.execute(definitions_query).fetchall():
+        rows = connection.execute(select([item_to_attribute.c.item_id, item_to_attribute.c.value])
+                                  .where(item_to_attribute.c.attribute_definition_id == definition_id)).fetchall()
+        params = [{'b_item_id': item_id, 'b_definition_id': definition_id,
+                   **typed_values(definition_type, jsonschema, value)} for item_id, value in rows]
+        if params:
+            connection.execute(update, params)
+            updated += len(params)
+    if updated:
+        bump_catalog_version(connection)
+    return updated
+
+
+def _changed(obj, *keys: str) -> bool:
+    return any(get_history(obj, key).has_changes() for key in keys)
+
+
+@event.listens_for(Session, 'before_flush')
+def _update_typed_values(session: Session, flush_context, instances):
+    """
+    Set the typed columns of all attributes whose value is written by this flush.
+    """
+    attributes = [obj for obj in session.new if isinstance(obj, ItemToAttributeDefinition)]
+    attributes += [obj for obj in session.dirty
+                   if isinstance(obj, ItemToAttributeDefinition) and _changed(obj, 'value')]
+    if not attributes:
+        return
+
+    definition_ids = {attribute.attribute_definition_id for attribute in attributes}
+    definitions = {definition_id: (definition_type, jsonschema) for definition_id, definition_type, jsonschema
+                   in session.query(AttributeDefinition.id, AttributeDefinition.type, AttributeDefinition.jsonschema)
+                   .filter(AttributeDefinition.id.in_(definition_ids))}
+    for attribute in attributes:
+        definition_type, jsonschema = definitions.get(attribute.attribute_definition_id, (None, None))
+        for column, value in typed_values(definition_type, jsonschema, attribute.value).items():
+            setattr(attribute, column, value)
+
+
+@event.listens_for(Session, 'after_flush')
+def _retype_changed_definitions(session: Session, flush_context):
+    """
+    Recompute the typed columns of attribute definitions whose type or schema changed.
+    """
+    definition_ids = [obj.id for obj in session.dirty
+                      if isinstance(obj, AttributeDefinition) and _changed(obj, 'type', 'jsonschema')]
+    if definition_ids:
+        retype_attribute_values(session.connection(), definition_ids)
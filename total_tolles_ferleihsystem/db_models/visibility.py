@@ -0,0 +1,39 @@
+"""
+Module containing the integer visibility level kept next to every visible_for column.
+
+The level is the lowest user role allowed to see the object, so visibility checks become a single
+indexable comparison (visibility_level <= role).
+"""
+
+from sqlalchemy.orm import validates
+
+from .. import DB
+from ..login import UserRole
+
+__all__ = ['VisibilityMixin', 'visibility_level']
+
+VISIBILITY_LEVELS = {
+    'all': UserRole.GUEST.value,
+    'moderator': UserRole.MODERATOR.value,
+}
+
+
+def visibility_level(visible_for: str) -> int:
+    """
+    The lowest role value allowed to see objects with the given visible_for value.
+    """
+    return VISIBILITY_LEVELS.get(visible_for, UserRole.ADMIN.value)
+
+
+class VisibilityMixin():
+    """
+    Adds the visibility_level column which follows the visible_for column of the model.
+    """
+
+    visibility_level = DB.Column(DB.Integer, nullable=False, default=UserRole.ADMIN.value,
+                                 server_default=str(UserRole.ADMIN.value))
+
+    @validates('visible_for')
+    def _update_visibility_level(self, key, value):
+        self.visibility_level = visibility_level(value)
+        return value
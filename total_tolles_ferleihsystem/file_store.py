@@ -3,14 +3,22 @@ This module contains all file handling options
 """
 
 import os
+import re
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from fcntl import flock, LOCK_EX, LOCK_UN
+from shutil import copyfileobj
 
 # pylint: disable=E0611
 from hashlib import sha3_256
-from typing import Tuple, List
-from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
-from werkzeug.datastructures import FileStorage
+from tempfile import mkstemp
+from typing import Callable, Dict, Tuple, List, BinaryIO, Iterator, Set, Union
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
 
-from . import APP
+import click
+
+from . import APP, DB
+from .db_models.item import File
 
 
 Hash = str
@@ -18,56 +26,342 @@ Hash = str
 FileEntry = Tuple[Hash, str]
 
 
-TMP_DOWNLOAD_FILE_NAME = 'data.upload'
-TMP_DATA_FILE_NAME = 'data.tmp'
-TMP_ARCHIVE_FILE_NAME = 'archive.tmp'
-DATA_FILE_NAME = 'file-store.dat'
+LEGACY_DATA_FILE_NAME = 'file-store.dat'
 
 TMP_FOLDER = APP.config['TMP_DIRECTORY']
 DATA_FOLDER = APP.config['DATA_DIRECTORY']
 
-TMP_DOWNLOAD_FILE_PATH = os.path.join(TMP_FOLDER, TMP_DOWNLOAD_FILE_NAME)
-TMP_DATA_FILE_PATH = os.path.join(TMP_FOLDER, TMP_DATA_FILE_NAME)
-TMP_ARCHIVE_FILE_PATH = os.path.join(TMP_FOLDER, TMP_ARCHIVE_FILE_NAME)
-DATA_FILE_PATH = os.path.join(DATA_FOLDER, DATA_FILE_NAME)
+LEGACY_DATA_FILE_PATH = os.path.join(DATA_FOLDER, LEGACY_DATA_FILE_NAME)
+LOCK_FOLDER = os.path.join(DATA_FOLDER, '.locks')
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def _stored_file_mode() -> int:
+    # mkstemp creates files with mode 0600, stored files get the mode of a normally created file
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
 
 
-def save_file(file: FileStorage) -> Hash:
+# read once at import, changing the umask is not thread safe
+STORED_FILE_MODE = _stored_file_mode()
+
+
+class BlobStore(ABC):
     """
-    Save a file from a flask endpoint3
+    Abstract class for stores which keep file contents addressed by their hash.
     """
-    file.save(TMP_DOWNLOAD_FILE_PATH)
-    with open(TMP_DOWNLOAD_FILE_PATH, 'rb') as tmp_file:
-        file_hash = sha3_256(tmp_file.read()).hexdigest()
 
-    _store(TMP_DOWNLOAD_FILE_PATH, file_hash)
-    return file_hash
+    __registered_stores__: Dict[str, 'BlobStore'] = {}
+
+    def __init_subclass__(cls, store_name: str = None):
+        if store_name is None:
+            BlobStore.register_store(cls.__name__, cls())
+        else:
+            BlobStore.register_store(store_name, cls())
+
+    @staticmethod
+    def register_store(name: str, blob_store: 'BlobStore'):
+        """
+        Register an Instance of BlobStore under given name.
+
+        Arguments:
+            name {str} -- Name of the BlobStore
+            blob_store {BlobStore} -- BlobStore Instance
+
+        Raises:
+            KeyError -- If name is already registered with a different BlobStore
+        """
+        if name in BlobStore.__registered_stores__:
+            raise KeyError('Name already in use!')
+        BlobStore.__registered_stores__[name] = blob_store
+
+    @staticmethod
+    def get_blob_store(name: str) -> Union['BlobStore', None]:
+        """
+        Get a registered BlobStore by its name.
+
+        Arguments:
+            name {str} -- Name of the BlobStore
+
+        Returns:
+            Union[BlobStore, None] -- BlobStore or None
+        """
+        return BlobStore.__registered_stores__.get(name)
+
+    @abstractmethod
+    def exists(self, file_hash: Hash) -> bool:
+        """
+        Check if a blob with the given hash is stored.
+        """
+        pass
+
+    @abstractmethod
+    def path(self, file_hash: Hash) -> str:
+        """
+        The path of the stored blob in the local file system.
+        """
+        pass
+
+    @abstractmethod
+    def relative_path(self, file_hash: Hash) -> str:
+        """
+        The path of the stored blob relative to the root of the store.
+        """
+        pass
+
+    @abstractmethod
+    def store_file(self, file_path: str, file_hash: Hash) -> None:
+        """
+        Move the (temporary) file into the store under the given hash.
+        """
+        pass
 
+    @abstractmethod
+    def delete(self, file_hash: Hash) -> None:
+        """
+        Remove the blob from the store.
+        """
+        pass
 
-def _store(file_path: os.PathLike, file_hash: Hash) -> None:
-    with ZipFile(DATA_FILE_PATH, 'a', ZIP_STORED, True) as data_file:
-        data_file.write(file_path, file_hash)
+    def open(self, file_hash: Hash) -> BinaryIO:
+        """
+        Open the stored blob for reading.
+        """
+        return open(self.path(file_hash), 'rb')
 
 
-def read_file(file_hash: str) -> bytes:
+def _spool_stream(stream: BinaryIO) -> Tuple[str, Hash]:
     """
-    Read a file in the store via it's hash
+    Write the stream into a temporary file and return its path and the hash of the content.
+
+    The stream is read only once in chunks, the hash is computed while the data is written.
     """
-    with ZipFile(DATA_FILE_PATH, 'r', ZIP_STORED, True) as data_file:
-        return data_file.read(file_hash)
+    file_hash = sha3_256()
+    tmp_fd, tmp_path = mkstemp(prefix='upload-', dir=TMP_FOLDER)
+    try:
+        with os.fdopen(tmp_fd, 'wb') as tmp_file:
+            for chunk in iter(lambda: stream.read(STREAM_CHUNK_SIZE), b''):
+                file_hash.update(chunk)
+                tmp_file.write(chunk)
+        os.chmod(tmp_path, STORED_FILE_MODE)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, file_hash.hexdigest()
 
 
-def create_archive(files: List[FileEntry]) -> Hash:
+class ShardedBlobStore(BlobStore, store_name='Sharded'):
     """
-    Create a archive collection full of files from the store
+    Stores every blob in its own file in DATA_DIRECTORY/ab/cd/abcd...
+
+    Blobs in the old flat layout (DATA_DIRECTORY/abcd...) are still found.
     """
-    with ZipFile(TMP_ARCHIVE_FILE_PATH, 'w', ZIP_DEFLATED) as tmp_archive:
-        for file in files:
-            with open(TMP_DATA_FILE_PATH, 'wb') as data_file:
-                data_file.write(read_file(file[0]))
-            tmp_archive.write(TMP_DATA_FILE_PATH, file[1])
-    with open(TMP_ARCHIVE_FILE_PATH, 'rb') as tmp_archive:
-        file_hash = sha3_256(tmp_archive.read()).hexdigest()
 
-    _store(TMP_ARCHIVE_FILE_PATH, file_hash)
-    return file_hash
+    def __init__(self):
+        self.root = DATA_FOLDER
+
+    def relative_path(self, file_hash: Hash) -> str:
+        sharded_path = os.path.join(file_hash[0:2], file_hash[2:4], file_hash)
+        if not os.path.isfile(os.path.join(self.root, sharded_path)) \
+                and os.path.isfile(os.path.join(self.root, file_hash)):
+            return file_hash
+        return sharded_path
+
+    def path(self, file_hash: Hash) -> str:
+        return os.path.join(self.root, self.relative_path(file_hash))
+
+    def exists(self, file_hash: Hash) -> bool:
+        return os.path.isfile(self.path(file_hash))
+
+    def store_file(self, file_path: str, file_hash: Hash) -> None:
+        if self.exists(file_hash):
+            os.remove(file_path)
+            return
+        target_path = os.path.join(self.root, file_hash[0:2], file_hash[2:4], file_hash)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        _move_atomic(file_path, target_path)
+
+    def delete(self, file_hash: Hash) -> None:
+        for path in (os.path.join(self.root, file_hash[0:2], file_hash[2:4], file_hash),
+                     os.path.join(self.root, file_hash)):
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+BLOB_STORE = BlobStore.get_blob_store(APP.config.get('FILE_STORE', 'Sharded'))
+
+if BLOB_STORE is None:
+    raise KeyError('Unknown file store: {}'.format(APP.config.get('FILE_STORE')))
+
+
+def _move_atomic(source_path: str, target_path: str) -> None:
+    """
+    Move a file so that the target path never contains a partially written file.
+    """
+    try:
+        os.replace(source_path, target_path)
+    except OSError:
+        # source and target are on different file systems, copy next to the target first
+        target_fd, target_tmp_path = mkstemp(prefix='.tmp-', dir=os.path.dirname(target_path))
+        try:
+            with os.fdopen(target_fd, 'wb') as target_tmp, open(source_path, 'rb') as source:
+                copyfileobj(source, target_tmp, STREAM_CHUNK_SIZE)
+            os.chmod(target_tmp_path, STORED_FILE_MODE)
+            os.replace(target_tmp_path, target_path)
+        finally:
+            if os.path.exists(target_tmp_path):
+                os.remove(target_tmp_path)
+
+
+@contextmanager
+def lock_blob(file_hash: Hash) -> Iterator[None]:
+    """
+    Lock the blob against concurrent storing and releasing (in all processes using the same data directory).
+
+    The locks are striped over 256 lock files by the first byte of the hash.
+    """
+    os.makedirs(LOCK_FOLDER, exist_ok=True)
+    with open(os.path.join(LOCK_FOLDER, file_hash[0:2] + '.lock'), 'a') as lock_file:
+        flock(lock_file, LOCK_EX)
+        try:
+            yield
+        finally:
+            flock(lock_file, LOCK_UN)
+
+
+@contextmanager
+def _store_locked(tmp_path: str, file_hash: Hash) -> Iterator[Hash]:
+    try:
+        with lock_blob(file_hash):
+            BLOB_STORE.store_file(tmp_path, file_hash)
+            yield file_hash
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+@contextmanager
+def store_stream(stream: BinaryIO) -> Iterator[Hash]:
+    """
+    Store the content of a stream in the configured blob store and yield its hash.
+
+    The blob stays locked until the end of the with block, the file referencing it has to be committed inside
+    the block. Otherwise a concurrent release_file could remove the blob before it is referenced.
+    """
+    tmp_path, file_hash = _spool_stream(stream)
+    with _store_locked(tmp_path, file_hash):
+        yield file_hash
+
+
+def release_file(file_hash: Hash) -> bool:
+    """
+    Remove a blob from the store if no file references it anymore.
+
+    Has to be called after the deletion of the referencing file was committed.
+    """
+    if file_hash is None:
+        return False
+    with lock_blob(file_hash):
+        if DB.session.query(File.query.filter(File.file_hash == file_hash).exists()).scalar():
+            return False
+        BLOB_STORE.delete(file_hash)
+    return True
+
+
+class _HashingWriter:
+    """
+    Write only file wrapper which hashes everything written through it.
+
+    It deliberately offers no tell/seek, so ZipFile streams the archive with data descriptors.
+    """
+
+    def __init__(self, file: BinaryIO):
+        self._file = file
+        self.hash = sha3_256()
+
+    def write(self, data: bytes) -> int:
+        self.hash.update(data)
+        return self._file.write(data)
+
+    def flush(self) -> None:
+        self._file.flush()
+
+
+def _unique_name(name: str, used: Set[str]) -> str:
+    base, ext = os.path.splitext(name)
+    counter = 1
+    while name in used:
+        counter += 1
+        name = '{} ({}){}'.format(base, counter, ext)
+    used.add(name)
+    return name
+
+
+@contextmanager
+def create_archive(files: List[FileEntry], progress: Callable[[int, int], None] = None) -> Iterator[Hash]:
+    """
+    Create a archive collection full of files from the store and yield its hash
+
+    The archive is streamed into a temporary file and hashed while it is written, the stored files are read in
+    chunks directly from the store. The optional progress callback gets the number of done and total files.
+    Like with store_stream, the file referencing the archive has to be committed inside the with block.
+    """
+    tmp_fd, tmp_path = mkstemp(prefix='archive-', suffix='.zip', dir=TMP_FOLDER)
+    try:
+        with os.fdopen(tmp_fd, 'wb') as tmp_file:
+            writer = _HashingWriter(tmp_file)
+            used_names: Set[str] = set()
+            with ZipFile(writer, 'w', ZIP_DEFLATED) as archive:
+                for index, (file_hash, name) in enumerate(files):
+                    file_path = BLOB_STORE.path(file_hash)
+                    info = ZipInfo.from_file(file_path, _unique_name(name, used_names))
+                    info.compress_type = ZIP_DEFLATED
+                    with open(file_path, 'rb') as source, archive.open(info, 'w') as target:
+                        copyfileobj(source, target, STREAM_CHUNK_SIZE)
+                    if progress is not None:
+                        progress(index + 1, len(files))
+
+        os.chmod(tmp_path, STORED_FILE_MODE)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    with _store_locked(tmp_path, writer.hash.hexdigest()) as file_hash:
+        yield file_hash
+
+
+@APP.cli.command('migrate_file_store')
+def migrate_file_store():
+    """Move all stored files into the configured file store."""
+    moved = 0
+    if os.path.isfile(LEGACY_DATA_FILE_PATH):
+        with ZipFile(LEGACY_DATA_FILE_PATH, 'r') as data_file:
+            for name in data_file.namelist():
+                with data_file.open(name) as blob, store_stream(blob) as file_hash:
+                    if file_hash != name:
+                        # the files would reference a blob which is not stored, point them to the actual content
+                        APP.logger.error('Stored file %s has the hash %s!', name, file_hash)
+                        click.echo('Hash mismatch for {} (got {}), updating the referencing files.'.format(
+                            name, file_hash))
+                        for file in File.query.filter(File.file_hash == name):
+                            file.file_hash = file_hash
+                        DB.session.commit()
+                moved += 1
+        os.replace(LEGACY_DATA_FILE_PATH, LEGACY_DATA_FILE_PATH + '.migrated')
+        click.echo('Old file store renamed to {}.migrated'.format(LEGACY_DATA_FILE_NAME))
+
+    # files stored directly in the data folder
+    for name in os.listdir(DATA_FOLDER):
+        path = os.path.join(DATA_FOLDER, name)
+        if HASH_PATTERN.match(name) and os.path.isfile(path):
+            # rename first, the store would otherwise find the file under its old path
+            with lock_blob(name):
+                tmp_path = path + '.migrating'
+                os.replace(path, tmp_path)
+                BLOB_STORE.store_file(tmp_path, name)
+            moved += 1
+
+    click.echo('Moved {} files into the file store.'.format(moved))
@@ -2,8 +2,9 @@ from collections import OrderedDict
 from functools import wraps
 from flask_restplus import marshal
 from flask_restplus.fields import Raw, Nested, StringMixin, MarshallingError, get_value, urlparse, urlunparse
-from flask import url_for, request
-from typing import Dict, List, Union
+from flask import url_for, request, has_request_context
+from werkzeug.urls import url_quote
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from . import APP
 
@@ -54,14 +55,43 @@ if True:
     setattr(Model, '_schema', property(_schema))
 
 
+FieldPlan = List[Tuple[str, Any]]
+
+
+def compile_field_plan(model) -> Optional[FieldPlan]:
+    """
+    Resolve the fields of a model once to a list of (key, field instance) tuples.
+
+    Returns None for models which need the full marshal function (masks).
+    """
+    if getattr(model, '__mask__', None):
+        return None
+    model = getattr(model, 'resolved', model)
+    return [(key, field if isinstance(field, dict) else instance(field)) for key, field in iteritems(model)]
+
+
+def marshal_with_plan(data, model, plan: Optional[FieldPlan]):
+    """
+    Same as flask_restplus.marshal(data, model) but uses a precompiled field plan.
+    """
+    if plan is None:
+        return marshal(data, model)
+    if isinstance(data, (list, tuple)):
+        return [marshal_with_plan(element, model, plan) for element in data]
+    return {key: marshal(data, field) if isinstance(field, dict) else field.output(key, data)
+            for key, field in plan}
+
+
 class NestedFields(Nested):
 
     def __init__(self, model, **kwargs):
         super().__init__(model=model, **kwargs)
+        self._plan = None
 
     def output(self, key, obj, ordered=False):
-
-        return marshal(obj, self.nested)
+        if self._plan is None:
+            self._plan = compile_field_plan(self.nested)
+        return marshal_with_plan(obj, self.nested, self._plan)
 
 
 class NestedModel():
@@ -70,11 +100,18 @@ class NestedModel():
         self.model = model
         self.attribute = attribute
         self.as_list = as_list
+        self._plan = None
 
     @property
     def nested(self):
         return getattr(self.model, 'resolved', self.model)
 
+    @property
+    def plan(self) -> Optional[FieldPlan]:
+        if self._plan is None:
+            self._plan = compile_field_plan(self.model)
+        return self._plan
+
 
 class EmbeddedFields(Raw):
 
@@ -88,11 +125,11 @@ class EmbeddedFields(Raw):
     def output(self, key, obj, orderes=False):
         data = {}
 
-        for name in self.embedded_models:
-            key = name if not self.embedded_models[name].attribute else self.embedded_models[name].attribute
+        for name, embedded_model in self.embedded_models.items():
+            key = name if not embedded_model.attribute else embedded_model.attribute
             value = get_value(key, obj)
-            if value is not None and not (self.embedded_models[name].as_list and (len(value) == 0)):
-                data[name] = marshal(value, self.nested_model(name))
+            if value is not None and not (embedded_model.as_list and (len(value) == 0)):
+                data[name] = marshal_with_plan(value, embedded_model.nested, embedded_model.plan)
         return data
 
     def schema(self):
@@ -112,6 +149,11 @@ class EmbeddedFields(Raw):
         return schema
 
 
+# ids used while compiling link templates, they must be valid for int converters
+TEMPLATE_PLACEHOLDER_BASE = 7395820461000
+MAX_CACHED_TEMPLATES = 32
+
+
 class UrlData():
 
     def __init__(self, endpoint: str, absolute=False, scheme=None, url: str=None,
@@ -131,6 +173,8 @@ class UrlData():
         self.hashtag = ''
         if hashtag is not None:
             self.hashtag = hashtag
+        # compiled link templates by (endpoint, url root)
+        self._templates: Dict[Tuple[str, str], str] = {}
 
     def url(self, obj):
         if self._url:
@@ -142,11 +186,24 @@ class UrlData():
                 APP.logger.debug('Could not build url because some provided values were none.\n' +
                                  'UrlParam: "%s", ObjectKey: "%s"',
                                  key, self.url_data[key])
-                print(obj)
                 return None
-            url_data[key] = value
+            url_data[key] = str(value) if isinstance(value, int) else url_quote(value, safe='/:')
         endpoint = self.endpoint if self.endpoint is not None else request.endpoint
-        o = urlparse(url_for(endpoint, _external=self.absolute, **url_data))
+        cache_key = (endpoint, request.url_root if has_request_context() else '')
+        template = self._templates.get(cache_key)
+        if template is None:
+            if len(self._templates) >= MAX_CACHED_TEMPLATES:
+                self._templates.clear()
+            template = self._compile_template(endpoint)
+            self._templates[cache_key] = template
+        return template.format(**url_data)
+
+    def _compile_template(self, endpoint: str) -> str:
+        """
+        Build the url once with placeholder values and turn it into a format string.
+        """
+        placeholders = {key: TEMPLATE_PLACEHOLDER_BASE + index for index, key in enumerate(self.url_data)}
+        o = urlparse(url_for(endpoint, _external=self.absolute, **placeholders))
         path = ''
         if o.path.endswith('/'):
             path = o.path + self.path_variables
@@ -154,9 +211,13 @@ class UrlData():
             path = o.path + '/' + self.path_variables
         if self.absolute:
             scheme = self.scheme if self.scheme is not None else o.scheme
-            return urlunparse((scheme, o.netloc, path, "", "", self.hashtag))
+            url = urlunparse((scheme, o.netloc, path, "", "", self.hashtag))
         else:
-            return urlunparse(("", "", path, "", "", self.hashtag))
+            url = urlunparse(("", "", path, "", "", self.hashtag))
+        template = url.replace('{', '{{').replace('}', '}}')
+        for key, placeholder in placeholders.items():
+            template = template.replace(str(placeholder), '{' + key + '}')
+        return template
 
 
 class HaLUrl(StringMixin, Raw):
@@ -1,18 +1,85 @@
-from flask import g, request
+from flask import g, jsonify, request
 from time import time
 from functools import wraps
-from collections import namedtuple
+from collections import namedtuple, deque
+from threading import Lock
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
 from logging import getLogger, INFO
+from os import path
+from random import random
+from datetime import datetime
+from uuid import uuid4
+import math
+import re
+import sys
+
+from flask_jwt_extended import verify_jwt_in_request_optional, get_jwt_claims
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt import InvalidTokenError
 
 from . import APP
+from .login import UserRole
+from .profiler import StackSampler
 
-from typing import Any, List
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
 
 
 QueryRecord = namedtuple('QueryRecord', ['duration', 'statement', 'write', 'params'])
 
+# one finished request, slowest_queries contains (duration, normalized statement) tuples
+RequestRecord = namedtuple('RequestRecord', ['endpoint', 'method', 'status', 'duration', 'view_duration',
+                                             'query_count', 'write_count', 'slowest_queries', 'profile'])
+
+QUANTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+# recent requests of this worker process, the oldest records are dropped first
+RECORDS: Deque[RequestRecord] = deque(maxlen=APP.config.get('PERFORMANCE_RECORDS', 1000))
+RECORDS_LOCK = Lock()
+
+STRING_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL_PATTERN = re.compile(r'(?<![\w"])-?\d+(?:\.\d+)?\b')
+BIND_PARAMETER_PATTERN = re.compile(r'%\(\w+\)s|%s|(?<!:):\w+')
+PARAMETER_LIST_PATTERN = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+PACKAGE_PATH = path.dirname(path.abspath(__file__))
+MAX_CALL_SITES = 5
+
+
+class NPlusOneError(Exception):
+    """
+    The error of a request which ran the same select too often (only in DEBUG or TEST mode).
+
+    It is not raised but turned into a 500 response, raising it in a after_request handler would skip the
+    remaining handlers.
+    """
+    pass
+
+
+def normalize_statement(statement: str) -> str:
+    """
+    The shape of a sql statement without literals, parameter lists of any length are collapsed to (?).
+    """
+    statement = STRING_LITERAL_PATTERN.sub('?', statement)
+    statement = NUMBER_LITERAL_PATTERN.sub('?', statement)
+    statement = BIND_PARAMETER_PATTERN.sub('?', statement)
+    statement = PARAMETER_LIST_PATTERN.sub('(?)', statement)
+    return WHITESPACE_PATTERN.sub(' ', statement).strip()
+
+
+def _call_site() -> str:
+    """
+    The innermost frame of this package (outside of this module) in the current stack.
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = path.abspath(frame.f_code.co_filename)
+        if filename.startswith(PACKAGE_PATH) and filename != path.abspath(__file__):
+            return '{}:{} in {}'.format(path.relpath(filename, PACKAGE_PATH), frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return 'unknown'
+
 
 class RequestPerformance:
 
@@ -23,6 +90,11 @@ class RequestPerformance:
     duration: float
     query_start: float
     queries: List[QueryRecord]
+    select_shapes: Dict[str, int]
+    call_sites: Dict[str, Set[str]]
+    profiler: Optional[StackSampler]
+    profile_requested: bool
+    profile: Optional[str]
 
     def __init__(self):
         t = time()
@@ -33,16 +105,74 @@ class RequestPerformance:
         self.view_end = t
         self.duration = 0
         self.queries = []
+        self.select_shapes = {}
+        self.call_sites = {}
+        self.profiler = None
+        self.profile_requested = False
+        self.profile = None
 
-    def end_request(self):
+    def end_request(self, status: int = None) -> Optional[NPlusOneError]:
+        """
+        Log and store the performance of the finished request.
+
+        Returns a NPlusOneError if the request has to fail because of repeated selects.
+        """
         self.req_end = time()
         self.duration = self.req_end - self.req_start
         logger = getLogger("ttf.performance")
+        self.stop_profiler()
         if self.duration > APP.config.get('LONG_REQUEST_THRESHHOLD', 1):
             self.log_performance_record(logger.warning)
         elif logger.getEffectiveLevel() <= INFO :
             self.log_performance_record(logger.info)
-            
+        error = self.check_n_plus_one(logger)
+        self.store_record(500 if error is not None else status)
+        return error
+
+    def start_profiler(self, requested: bool):
+        """
+        Start sampling the stack of the request thread.
+        """
+        self.profile_requested = requested
+        self.profiler = StackSampler(APP.config.get('PROFILE_SAMPLE_INTERVAL', 0.005))
+        self.profiler.start()
+
+    def stop_profiler(self):
+        """
+        Stop the profiler and write the profile if it was requested or the request was slow.
+        """
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        if not self.profile_requested and self.duration <= APP.config.get('LONG_REQUEST_THRESHHOLD', 1):
+            return
+        file_name = 'ttf-profile-{:%Y%m%d-%H%M%S}-{}-{}.folded'.format(
+            datetime.now(), request.endpoint or 'unknown', uuid4().hex[:8])
+        self.profile = path.join(APP.config.get('PROFILE_DIRECTORY') or APP.config['TMP_DIRECTORY'], file_name)
+        self.profiler.write_folded(self.profile)
+
+    def store_record(self, status: int = None):
+        """
+        Keep a summary of this request in the ring buffer of recent requests.
+        """
+        view_duration = None
+        if self.view_end != self.view_start:
+            view_duration = self.view_end - self.view_start
+        slowest = sorted(self.queries, key=lambda q: q.duration, reverse=True)
+        slowest = slowest[:APP.config.get('PERFORMANCE_SLOWEST_QUERIES', 5)]
+        record = RequestRecord(
+            endpoint=request.endpoint or 'unknown',
+            method=request.method,
+            status=status,
+            duration=self.duration,
+            view_duration=view_duration,
+            query_count=len(self.queries),
+            write_count=sum(1 if q.write else 0 for q in self.queries),
+            slowest_queries=[(q.duration, normalize_statement(q.statement)) for q in slowest],
+            profile=self.profile,
+        )
+        with RECORDS_LOCK:
+            RECORDS.append(record)
 
     def start_query(self):
         self.query_start = time()
@@ -51,8 +181,43 @@ class RequestPerformance:
         query_end = time()
         write = not statement.upper().startswith('SELECT')
         self.queries.append(QueryRecord(query_end - self.query_start, statement, write, parameters))
+        if not write and APP.config.get('N_PLUS_ONE_THRESHOLD', 0):
+            self.count_select_shape(statement)
         self.query_start = query_end
 
+    def count_select_shape(self, statement: str):
+        """
+        Count the statement by its shape and remember where repeated shapes come from.
+        """
+        shape = normalize_statement(statement)
+        count = self.select_shapes.get(shape, 0) + 1
+        self.select_shapes[shape] = count
+        if count > 1:
+            sites = self.call_sites.setdefault(shape, set())
+            if len(sites) < MAX_CALL_SITES:
+                sites.add(_call_site())
+
+    def check_n_plus_one(self, logger) -> Optional[NPlusOneError]:
+        """
+        Report every select shape which ran more often than N_PLUS_ONE_THRESHOLD in this request.
+
+        Returns a NPlusOneError in DEBUG or TEST mode if N_PLUS_ONE_RAISE is set.
+        """
+        threshold = APP.config.get('N_PLUS_ONE_THRESHOLD', 0)
+        if not threshold:
+            return None
+        repeated = [(shape, count) for shape, count in self.select_shapes.items() if count > threshold]
+        if not repeated:
+            return None
+        for shape, count in repeated:
+            logger.warning('N+1 queries detected: %d times from %s, url %s %s, statement "%s"', count,
+                           ', '.join(sorted(self.call_sites.get(shape, []))), request.method, request.url, shape)
+        if APP.config.get('N_PLUS_ONE_RAISE', False) and (APP.debug or APP.testing):
+            shape, count = max(repeated, key=lambda entry: entry[1])
+            return NPlusOneError('{} {} ran the same select {} times (from {}): {}'.format(
+                request.method, request.url, count, ', '.join(sorted(self.call_sites.get(shape, []))), shape))
+        return None
+
     def start_view_function(self):
         t = time()
         self.view_start = t
@@ -78,7 +243,7 @@ class RequestPerformance:
             q_write_number = sum(1 if q.write else 0 for q in self.queries)
             tot_query_duration = sum(q.duration for q in self.queries)
             duration_wo_queries = self.duration - tot_query_duration
-            self.queries.sort(key=lambda q: q.duration)
+            self.queries.sort(key=lambda q: q.duration, reverse=True)
             longest_query_duration = self.queries[0].duration
             methodToLogWith(f'performance report: duration {self.duration: 2.2f}s, {time_in_view}duration without queries {duration_wo_queries: 2.2f}s, query-duration {tot_query_duration: 2.2f}s, {q_number: 2d} queries ({q_write_number: 2d} write), longest query {longest_query_duration: 2.2f}s, url {method:6} {url}')
             for q in self.queries:
@@ -86,20 +251,47 @@ class RequestPerformance:
                     methodToLogWith(f'performance report: long query detected: duration {q.duration: 2.2f}s, statement "{q.statement}", params: {q.params}')
         else:
             methodToLogWith(f'performance report: duration {self.duration: 2.2f}s, {time_in_view}url {method} {url}')
+        if self.profile is not None:
+            methodToLogWith(f'performance report: profile of url {method} {url} written to {self.profile}')
+
+
+def profile_requested() -> bool:
+    """
+    If a admin asked to profile this request (?profile=true or the X-TTF-Profile header).
+    """
+    flag = request.args.get('profile') or request.headers.get('X-TTF-Profile') or ''
+    if flag.lower() not in ('true', '1', 'yes'):
+        return False
+    try:
+        verify_jwt_in_request_optional()
+    except (JWTExtendedException, InvalidTokenError):
+        return False
+    role = get_jwt_claims()
+    return isinstance(role, int) and role >= UserRole.ADMIN
 
 
 def before_request(*args, **kwargs):
-    g.ttf_request_performance = RequestPerformance()
+    r_perf = RequestPerformance()
+    g.ttf_request_performance = r_perf
+    if APP.config.get('PROFILE_REQUESTS', False):
+        requested = profile_requested()
+        if requested or random() < APP.config.get('PROFILE_SAMPLE_RATE', 0):
+            r_perf.start_profiler(requested)
 
 
 APP.before_request(before_request)
 
 
-def aftter_request(request, *args, **kwargs):
+def aftter_request(response, *args, **kwargs):
     r_perf: RequestPerformance = g.get('ttf_request_performance')
     if r_perf is not None:
-        r_perf.end_request()
-    return request
+        error = r_perf.end_request(response.status_code)
+        if error is not None:
+            response = jsonify(message=str(error), error=type(error).__name__)
+            response.status_code = 500
+        if r_perf.profile is not None and r_perf.profile_requested:
+            response.headers['X-TTF-Profile-File'] = path.basename(r_perf.profile)
+    return response
 
 
 APP.after_request(aftter_request)
@@ -132,3 +324,83 @@ def record_view_performance():
             return result
         return wrapper
     return record_view_performance_decorator
+
+
+def recent_records() -> List[RequestRecord]:
+    """
+    A copy of the records of the recent requests of this worker.
+    """
+    with RECORDS_LOCK:
+        return list(RECORDS)
+
+
+def quantile(sorted_values: List[float], q: float) -> float:
+    """
+    The q-quantile (nearest rank) of the already sorted values.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(q * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def aggregate_performance() -> List[Dict[str, Any]]:
+    """
+    Latency quantiles, query counts and the slowest statements of the recent requests per endpoint.
+    """
+    by_endpoint: Dict[Tuple[str, str], List[RequestRecord]] = {}
+    for record in recent_records():
+        by_endpoint.setdefault((record.method, record.endpoint), []).append(record)
+
+    result = []
+    for (method, endpoint), records in sorted(by_endpoint.items(), key=lambda entry: entry[0][1]):
+        durations = sorted(record.duration for record in records)
+        slowest: Dict[str, float] = {}
+        for record in records:
+            for duration, statement in record.slowest_queries:
+                slowest[statement] = max(duration, slowest.get(statement, 0))
+        top_queries = sorted(slowest.items(), key=lambda entry: entry[1], reverse=True)
+        result.append({
+            'endpoint': endpoint,
+            'method': method,
+            'count': len(records),
+            'errors': sum(1 for record in records if record.status is not None and record.status >= 500),
+            'duration_sum': sum(durations),
+            'duration_max': durations[-1],
+            **{name: quantile(durations, q) for name, q in QUANTILES},
+            'queries_mean': sum(record.query_count for record in records) / len(records),
+            'writes_mean': sum(record.write_count for record in records) / len(records),
+            'slowest_queries': [{'duration': duration, 'statement': statement} for statement, duration
+                                in top_queries[:APP.config.get('PERFORMANCE_SLOWEST_QUERIES', 5)]],
+            'profiles': [record.profile for record in records if record.profile is not None][-5:],
+        })
+    return result
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_exposition() -> str:
+    """
+    The aggregated request performance in the prometheus text exposition format.
+    """
+    lines = [
+        '# HELP ttf_request_duration_seconds Duration of the recent requests of this worker.',
+        '# TYPE ttf_request_duration_seconds summary',
+    ]
+    aggregates = aggregate_performance()
+    for aggregate in aggregates:
+        labels = 'endpoint="{}",method="{}"'.format(_escape_label(aggregate['endpoint']), aggregate['method'])
+        for name, q in QUANTILES:
+            lines.append('ttf_request_duration_seconds{{{},quantile="{}"}} {:.6f}'.format(
+                labels, q, aggregate[name]))
+        lines.append('ttf_request_duration_seconds_sum{{{}}} {:.6f}'.format(labels, aggregate['duration_sum']))
+        lines.append('ttf_request_duration_seconds_count{{{}}} {}'.format(labels, aggregate['count']))
+
+    lines.append('# HELP ttf_request_queries_mean Mean number of sql statements per recent request.')
+    lines.append('# TYPE ttf_request_queries_mean gauge')
+    for aggregate in aggregates:
+        labels = 'endpoint="{}",method="{}"'.format(_escape_label(aggregate['endpoint']), aggregate['method'])
+        lines.append('ttf_request_queries_mean{{{}}} {:.3f}'.format(labels, aggregate['queries_mean']))
+    return '\n'.join(lines) + '\n'
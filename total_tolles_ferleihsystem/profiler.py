@@ -0,0 +1,72 @@
+"""
+This module contains a sampling profiler for single requests.
+
+The profiler samples the stack of the request thread from a background thread and writes the collapsed
+stacks ("folded" format) which flamegraph.pl, speedscope or inferno turn into flamegraphs.
+Under uwsgi the background thread only runs with enable-threads (see docker/uwsgi.ini).
+"""
+
+import sys
+from os import path
+from threading import Event, Thread, get_ident
+from typing import Dict
+
+# the sampling thread finishes its current sample within this time, the request never waits longer
+STOP_TIMEOUT = 1.0
+
+
+def _frame_name(code) -> str:
+    # the last directory and the file name are enough to tell flask_restplus, sqlalchemy and our modules apart
+    directory, filename = path.split(code.co_filename)
+    name = '{}/{}:{}'.format(path.basename(directory), filename, code.co_name)
+    return name.replace(';', ':').replace(' ', '_')
+
+
+class StackSampler:
+    """
+    Counts the stacks of one thread, sampled every interval seconds.
+    """
+
+    def __init__(self, interval: float, thread_id: int = None):
+        self.interval = interval
+        self.thread_id = get_ident() if thread_id is None else thread_id
+        self.samples = 0
+        self.stacks: Dict[str, int] = {}
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name='ttf-profiler', daemon=True)
+
+    def start(self) -> None:
+        """
+        Start sampling in the background.
+        """
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop sampling and wait (at most STOP_TIMEOUT seconds) for the sampling thread.
+        """
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join(STOP_TIMEOUT)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            stack = ';'.join(reversed(names))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def write_folded(self, file_path: str) -> None:
+        """
+        Write the counted stacks in the folded format (one "frame;frame;frame count" per line).
+        """
+        with open(file_path, 'w') as folded_file:
+            # a copy, the sampling thread may still run if stop timed out
+            for stack, count in sorted(dict(self.stacks).items()):
+                folded_file.write('{} {}\n'.format(stack, count))
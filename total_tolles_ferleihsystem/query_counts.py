@@ -0,0 +1,118 @@
+"""
+This module contains a check that the number of queries per endpoint does not depend on the result size.
+
+The check fills the database with test data, so it only runs in the TEST mode.
+"""
+
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+from uuid import uuid4
+
+import click
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event
+
+from . import APP, DB
+from .login import User, UserRole
+from .db_models.item import Item, File, Lending, ItemToItem, ItemToTag
+from .db_models.itemType import ItemType
+from .db_models.tag import Tag
+
+
+@contextmanager
+def count_queries():
+    """
+    Count all statements sent to the database inside the with block.
+
+    Yields a list whose only element is the current count.
+    """
+    counter = [0]
+
+    def count(*args):
+        counter[0] += 1
+
+    event.listen(DB.engine, 'before_cursor_execute', count)
+    try:
+        yield counter
+    finally:
+        event.remove(DB.engine, 'before_cursor_execute', count)
+
+
+def _populate(container: Item, lending: Lending, item_type: ItemType, tag: Tag, count: int) -> None:
+    """
+    Add count items (with tag, file and lending) to the container item.
+    """
+    items = [Item(False, 'querycheck item ' + uuid4().hex, item_type.id, visible_for='all') for _ in range(count)]
+    DB.session.add_all(items)
+    DB.session.flush()
+    for item in items:
+        DB.session.add(ItemToItem(container.id, item.id))
+        DB.session.add(ItemToTag(item.id, tag.id))
+        DB.session.add(File('querycheck', '.txt', None, container.id, 'all'))
+        item.lending = lending
+        item.due = lending.date
+    DB.session.commit()
+
+
+def _measure(endpoints: List[Tuple[str, str]], headers: Dict[str, str]) -> Dict[str, int]:
+    client = APP.test_client()
+    counts = {}
+    for name, url in endpoints:
+        with count_queries() as counter:
+            response = client.get(url, headers=headers)
+        if response.status_code != 200:
+            raise click.ClickException('{} answered with {}'.format(url, response.status_code))
+        counts[name] = counter[0]
+    return counts
+
+
+@APP.cli.command('check_query_counts')
+@click.option('--small', default=2, help='Number of items in the first measurement.')
+@click.option('--large', default=20, help='Number of items in the second measurement.')
+def check_query_counts(small: int, large: int):
+    """Check that the queries per endpoint do not grow with the result size."""
+    if not APP.config.get('TESTING'):
+        raise click.ClickException('The query count check writes test data and only runs in the TEST mode!')
+    if large <= small:
+        raise click.ClickException('--large has to be bigger than --small!')
+
+    DB.create_all()
+    run_id = uuid4().hex
+    item_type = ItemType('querycheck type ' + run_id, '', True, 3600, 'all')
+    tag = Tag('querycheck tag ' + run_id, 600, 'all')
+    DB.session.add_all([item_type, tag])
+    DB.session.flush()
+    container = Item(False, 'querycheck container ' + run_id, item_type.id, visible_for='all')
+    lending = Lending('querycheck', 'querycheck', 'querycheck', [])
+    DB.session.add_all([container, lending])
+    DB.session.commit()
+
+    user = User('querycheck')
+    user.role = UserRole.ADMIN
+    with APP.test_request_context():
+        headers = {'Authorization': 'Bearer ' + create_access_token(user)}
+
+    endpoints = [
+        ('item list', '/catalog/items/'),
+        ('item detail', '/catalog/items/{}/'.format(container.id)),
+        ('contained items', '/catalog/items/{}/contained/'.format(container.id)),
+        ('item files', '/catalog/items/{}/files/'.format(container.id)),
+        ('search', '/search/?search=querycheck'),
+        ('file list', '/catalog/files/'),
+        ('lending list', '/lending/'),
+        ('lending detail', '/lending/{}/'.format(lending.id)),
+    ]
+
+    _populate(container, lending, item_type, tag, small)
+    small_counts = _measure(endpoints, headers)
+    _populate(container, lending, item_type, tag, large - small)
+    large_counts = _measure(endpoints, headers)
+
+    failed = False
+    for name, _ in endpoints:
+        status = 'ok' if small_counts[name] == large_counts[name] else 'FAILED'
+        failed = failed or status != 'ok'
+        click.echo('{:16} {:3d} queries ({} items) {:3d} queries ({} items) {}'.format(
+            name, small_counts[name], small, large_counts[name], large, status))
+    if failed:
+        raise click.ClickException('The number of queries depends on the result size!')
@@ -1,12 +1,23 @@
 from logging import Logger, Formatter, DEBUG, INFO, getLogger
 from logging.handlers import RotatingFileHandler
 from os import path
-from celery import Celery
+from typing import Callable
+from celery import Celery, Task
 
 from .. import APP
 
 TASK_LOGGER: Logger = getLogger('ttf.tasks')
 
+
+def progress_reporter(task: Task) -> Callable[[int, int], None]:
+    """
+    Callback which publishes the number of processed and total elements as PROGRESS state of the task.
+    """
+    def report_progress(current: int, total: int) -> None:
+        if not task.request.is_eager:
+            task.update_state(state='PROGRESS', meta={'current': current, 'total': total})
+    return report_progress
+
 # http://docs.celeryproject.org/en/latest/userguide/configuration.html#new-lowercase-settings
 # Missing keys for automatic conversion:
 # [...]_DB_SHORT_LIVED_SESSIONS: database_short_lived_sessions
@@ -0,0 +1,56 @@
+"""
+Collection of all backgroud workers who deal with catalog maintenance
+"""
+
+from sqlalchemy.exc import IntegrityError
+from .. import celery, DB
+from .. import catalog_maintenance
+
+from . import TASK_LOGGER, progress_reporter
+
+
+@celery.task(name='ttf.tasks.catalog.delete_item_type', bind=True)
+def delete_item_type(self, type_id: int) -> int:
+    """
+    Task which deletes a item type with all its items.
+    """
+    TASK_LOGGER.info('Start deleting item type %s.', type_id)
+    try:
+        deleted = catalog_maintenance.delete_item_type(type_id, progress_reporter(self))
+    except ValueError as err:
+        DB.session.rollback()
+        TASK_LOGGER.error('Could not delete item type %s: %s', type_id, str(err))
+        raise
+    TASK_LOGGER.info('Deleted item type %s with %s items.', type_id, deleted)
+    return deleted
+
+
+@celery.task(name='ttf.tasks.catalog.set_tag_deleted')
+def set_tag_deleted(tag_id: int, deleted: bool) -> None:
+    """
+    Task which deletes or undeletes a tag and updates the attributes of the tagged items.
+    """
+    try:
+        catalog_maintenance.set_tag_deleted(tag_id, deleted)
+        DB.session.commit()
+    except ValueError as err:
+        DB.session.rollback()
+        TASK_LOGGER.error('Could not change tag %s: %s', tag_id, str(err))
+        raise
+    TASK_LOGGER.info('Tag %s is %s.', tag_id, 'deleted' if deleted else 'undeleted')
+
+
+@celery.task(name='ttf.tasks.catalog.associate_type_attribute')
+def associate_type_attribute(type_id: int, attribute_definition_id: int) -> None:
+    """
+    Task which associates a attribute definition with a item type and all items of that type.
+    """
+    try:
+        catalog_maintenance.associate_type_attribute(type_id, attribute_definition_id)
+        DB.session.commit()
+    except IntegrityError as err:
+        DB.session.rollback()
+        TASK_LOGGER.error('Could not associate attribute definition %s with item type %s: %s',
+                          attribute_definition_id, type_id, str(err))
+        raise ValueError('Attribute definition is already asociated with item type!')
+    TASK_LOGGER.info('Associated attribute definition %s with item type %s.', attribute_definition_id, type_id)
@@ -5,10 +5,10 @@ Collection of all backgroud workers who deal with files
 from typing import Tuple, List
 from sqlalchemy.exc import IntegrityError
 from .. import celery, DB
-from ..file_store import create_archive as create_file_archive
+from ..file_store import create_archive as create_file_archive, release_file
 from ..db_models.item import File
 
-from . import TASK_LOGGER
+from . import TASK_LOGGER, progress_reporter
 
 
 Hash = str
@@ -16,19 +16,26 @@ Hash = str
 FileEntry = Tuple[Hash, str]
 
 
-@celery.task(name='ttf.tasks.file.create_archive')
-def create_archive(archive_id: int, files: List[FileEntry]) -> None:
+@celery.task(name='ttf.tasks.file.create_archive', bind=True)
+def create_archive(self, archive_id: int, files: List[FileEntry]) -> None:
     """
     Task which creates a archive with the given parameters.
     """
     TASK_LOGGER.info(f'Start creating archive Nr. {archive_id} with {len(files)} Files.')
-    file_hash = create_file_archive(files)
-    TASK_LOGGER.info(f'Created Archive {archive_id}')
-    file = File.query.filter(File.id == archive_id).first()
-    file.file_hash = file_hash
-
-    try:
-        DB.session.commit()
-        TASK_LOGGER.info(f'Success on archive {archive_id}')
-    except IntegrityError as err:
-        TASK_LOGGER.error('Error occured: %s', str(err))
+
+    with create_file_archive(files, progress_reporter(self)) as file_hash:
+        TASK_LOGGER.info(f'Created Archive {archive_id}')
+        file = File.query.filter(File.id == archive_id).first()
+        if file is not None:
+            file.file_hash = file_hash
+
+            try:
+                DB.session.commit()
+                TASK_LOGGER.info(f'Success on archive {archive_id}')
+            except IntegrityError as err:
+                TASK_LOGGER.error('Error occured: %s', str(err))
+
+    if file is None:
+        # the blob lock is released, so release_file can take it
+        TASK_LOGGER.error('Archive %s was deleted while it was created.', archive_id)
+        release_file(file_hash)
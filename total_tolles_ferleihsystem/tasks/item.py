@@ -0,0 +1,27 @@
+"""
+Collection of all backgroud workers who deal with items
+"""
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from .. import celery, DB
+from ..db_models.item import rerender_item_names
+
+from . import TASK_LOGGER, progress_reporter
+
+
+@celery.task(name='ttf.tasks.item.rerender_names', bind=True)
+def rerender_names(self, type_id: int) -> int:
+    """
+    Task which renders the names of all items of a item type again (after the name schema changed).
+    """
+    TASK_LOGGER.info('Start rendering the item names of item type %s.', type_id)
+
+    try:
+        renamed = rerender_item_names(type_id, progress=progress_reporter(self))
+    except (IntegrityError, StaleDataError) as err:
+        DB.session.rollback()
+        TASK_LOGGER.error('Error occured while rendering the item names of item type %s: %s', type_id, str(err))
+        raise
+    TASK_LOGGER.info('Renamed %s items of item type %s.', renamed, type_id)
+    return renamed